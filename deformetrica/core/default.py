@@ -6,6 +6,8 @@ from ..support import utilities
 logger_format = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
 
 dtype = 'float32'
+# dtype of the kernel reductions: 'float64' with the 'mixed' dtype, i.e. float32 storage and float64 accumulation.
+accumulation_dtype = 'float32'
 random_seed = None
 tensor_scalar_type = utilities.get_torch_scalar_type(dtype)
 tensor_integer_type = utilities.get_torch_integer_type(dtype)
@@ -27,6 +29,10 @@ template_specifications = {}
 deformation_kernel_width = 1.0
 deformation_kernel_type = 'keops'
 deformation_kernel_device = 'auto'
+# extra keyword arguments of the deformation kernel, e.g. the kernel_widths and weights of the 'multiscale' type.
+deformation_kernel_options = None
+# winners of the benchmarks of the 'auto' kernel type.
+kernel_autotuner_cache = os.path.join(os.path.expanduser('~'), '.cache', 'deformetrica', 'kernel_autotuner.json')
 
 shoot_kernel_type = None
 number_of_time_points = 11
@@ -34,6 +40,14 @@ concentration_of_time_points = 10
 number_of_sources = None
 use_rk2_for_shoot = False
 use_rk2_for_flow = False
+# Integrators, image flow scheme, gradient mode and checkpoint interval: see Exponential.
+shoot_integrator = None
+flow_integrator = None
+integrator_tolerance = 1e-4
+parareal_number_of_slices = None
+image_flow = 'finite_difference'
+gradient_mode = 'autograd'
+checkpoint_interval = None
 t0 = None
 tmin = float('inf')
 tmax = - float('inf')
@@ -61,6 +75,10 @@ convergence_tolerance = 1e-4
 noise_variance_prior_normalized_dof = 0.01
 noise_variance_prior_normalized_dof = 0.01
 memory_length = 10
+update_control_points_every_n_iters = None
+control_points_pruning_threshold = 1e-2
+control_points_refinement_threshold = 0.5
+control_points_maximum_refinement_depth = 2
 scale_initial_step_size = True
 downsampling_factor = 1
 
@@ -134,9 +152,13 @@ verbose = 1
 
 def update_dtype(new_dtype):
     global dtype
+    global accumulation_dtype
     global tensor_scalar_type
     global tensor_integer_type
-    dtype = new_dtype
+    if new_dtype == 'mixed':
+        dtype, accumulation_dtype = 'float32', 'float64'
+    else:
+        dtype, accumulation_dtype = new_dtype, new_dtype
     tensor_scalar_type = utilities.get_torch_scalar_type(dtype)
     tensor_integer_type = utilities.get_torch_integer_type(dtype)
 
@@ -0,0 +1,109 @@
+import itertools
+import logging
+
+import numpy as np
+
+from ...core import default
+
+logger = logging.getLogger(__name__)
+
+
+class ControlPointManager:
+    """
+    Adapts the control points of a DeterministicAtlas or BayesianAtlas model along its estimation by a gradient-based
+    estimator. Every update_every_n_iters iterations:
+        - the control points whose momenta norms, across all subjects, and attachment gradient norms both fall below
+          pruning_threshold times their largest values are pruned,
+        - the cells of the control points whose attachment gradient norms exceed refinement_threshold times the largest
+          one are split octree-style: such a control point is replaced by the 2^dimension centers of the sub-cells of
+          half size, that share its momenta. Cells are split at most maximum_refinement_depth times.
+    The cells initially are cubes centered on the control points, whose sizes are the distances to the nearest other
+    control points.
+
+    """
+
+    ####################################################################################################################
+    ### Constructor:
+    ####################################################################################################################
+
+    def __init__(self, statistical_model, update_every_n_iters,
+                 pruning_threshold=default.control_points_pruning_threshold,
+                 refinement_threshold=default.control_points_refinement_threshold,
+                 maximum_refinement_depth=default.control_points_maximum_refinement_depth):
+        assert not statistical_model.dense_mode, 'The control points of the dense mode cannot be adapted.'
+        assert update_every_n_iters > 0
+
+        self.statistical_model = statistical_model
+        self.update_every_n_iters = update_every_n_iters
+        self.pruning_threshold = pruning_threshold
+        self.refinement_threshold = refinement_threshold
+        self.maximum_refinement_depth = maximum_refinement_depth
+
+        control_points = statistical_model.get_control_points()
+        self.cell_sizes = self._get_nearest_neighbour_distances(control_points) if len(control_points) > 1 \
+            else np.full(len(control_points), statistical_model.exponential.kernel.kernel_width)
+        self.depths = np.zeros(len(control_points), dtype=int)
+
+    ####################################################################################################################
+    ### Public methods:
+    ####################################################################################################################
+
+    def update(self, iteration, parameters, gradient):
+        """
+        Prunes and refines the control points of the model at the update iterations, according to the parameters of the
+        estimator and to the gradient of the log-likelihood with respect to them, that must include the momenta.
+        Returns the parameters remapped to the new control points, or None when the control points are unchanged.
+        """
+        if iteration % self.update_every_n_iters != 0 or 'momenta' not in gradient:
+            return None
+
+        control_points = self.statistical_model.get_control_points()
+        momenta = parameters['momenta']
+        attachment_gradient = gradient['momenta'] - self.statistical_model.compute_momenta_regularity_gradient(momenta)
+
+        momenta_norms = np.sqrt(np.sum(momenta ** 2, axis=(0, 2)))
+        gradient_norms = np.sqrt(np.sum(attachment_gradient ** 2, axis=(0, 2)))
+
+        refined = (gradient_norms > self.refinement_threshold * np.max(gradient_norms)) \
+                  & (self.depths < self.maximum_refinement_depth)
+        pruned = (momenta_norms <= self.pruning_threshold * np.max(momenta_norms)) \
+                 & (gradient_norms <= self.pruning_threshold * np.max(gradient_norms)) & ~refined
+        # Zero momenta, as initially, do not tell which control points are useless.
+        if np.max(momenta_norms) == 0. or np.all(pruned):
+            pruned[:] = False
+        if not np.any(pruned) and not np.any(refined):
+            return None
+
+        # The kept control points come first, followed by the centers of the sub-cells of the refined ones.
+        kept = np.flatnonzero(~pruned & ~refined)
+        split = np.flatnonzero(refined)
+        offsets = np.array(list(itertools.product([-1., 1.], repeat=control_points.shape[1])))
+
+        indices = np.concatenate([kept, np.repeat(split, len(offsets))])
+        weights = np.concatenate([np.ones(len(kept)), np.full(len(split) * len(offsets), 1. / len(offsets))])
+        new_control_points = np.concatenate([control_points[kept], (
+            control_points[split, np.newaxis] + 0.25 * self.cell_sizes[split, np.newaxis, np.newaxis] * offsets)
+                                            .reshape(-1, control_points.shape[1])])
+        self.cell_sizes = np.concatenate([self.cell_sizes[kept], np.repeat(0.5 * self.cell_sizes[split], len(offsets))])
+        self.depths = np.concatenate([self.depths[kept], np.repeat(self.depths[split] + 1, len(offsets))])
+
+        logger.info('>> %d control points pruned and %d refined: %d control points remain.'
+                    % (np.sum(pruned), len(split), len(new_control_points)))
+
+        # Remap the model, and the parameters of the estimator.
+        self.statistical_model.remap_control_points(new_control_points, indices, weights)
+        new_parameters = dict(parameters)
+        new_parameters['momenta'] = weights.reshape(1, -1, 1) * momenta[:, indices]
+        if 'control_points' in new_parameters:
+            new_parameters['control_points'] = new_control_points
+        return new_parameters
+
+    ####################################################################################################################
+    ### Private methods:
+    ####################################################################################################################
+
+    @staticmethod
+    def _get_nearest_neighbour_distances(points):
+        squared_distances = np.sum((points[:, np.newaxis] - points[np.newaxis]) ** 2, axis=2)
+        np.fill_diagonal(squared_distances, np.inf)
+        return np.sqrt(np.min(squared_distances, axis=1))
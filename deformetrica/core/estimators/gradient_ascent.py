@@ -8,6 +8,7 @@ from decimal import Decimal
 import numpy as np
 
 from ...core import default
+from ...core.estimator_tools.control_point_manager import ControlPointManager
 from ...core.estimators.abstract_estimator import AbstractEstimator
 
 logger = logging.getLogger(__name__)
@@ -32,6 +33,9 @@ class GradientAscent(AbstractEstimator):
                  max_line_search_iterations=default.max_line_search_iterations,
                  line_search_shrink=default.line_search_shrink,
                  line_search_expand=default.line_search_expand,
+                 update_control_points_every_n_iters=default.update_control_points_every_n_iters,
+                 control_points_pruning_threshold=default.control_points_pruning_threshold,
+                 control_points_refinement_threshold=default.control_points_refinement_threshold,
                  output_dir=default.output_dir, callback=None,
                  load_state_file=default.load_state_file, state_file=default.state_file,
                  **kwargs):
@@ -67,6 +71,14 @@ class GradientAscent(AbstractEstimator):
         self.line_search_shrink = line_search_shrink
         self.line_search_expand = line_search_expand
 
+        # Optional pruning and refinement of the control points.
+        self.control_point_manager = None
+        if update_control_points_every_n_iters is not None:
+            self.control_point_manager = ControlPointManager(
+                statistical_model, update_control_points_every_n_iters,
+                pruning_threshold=control_points_pruning_threshold,
+                refinement_threshold=control_points_refinement_threshold)
+
     ####################################################################################################################
     ### Public methods:
     ####################################################################################################################
@@ -182,6 +194,9 @@ class GradientAscent(AbstractEstimator):
             if not self.current_iteration == self.max_iterations:
                 gradient = self._evaluate_model_fit(self.current_parameters, with_grad=True)[2]
                 # logger.info(gradient)
+                if self.control_point_manager is not None:
+                    gradient = self._update_control_points(gradient)
+                    last_log_likelihood = self.current_log_likelihood
 
             # Save the state.
             if not self.current_iteration % self.save_every_n_iters: self._dump_state_file()
@@ -269,6 +284,21 @@ class GradientAscent(AbstractEstimator):
             else:
                 return - float('inf'), - float('inf')
 
+    def _update_control_points(self, gradient):
+        """
+        Prunes and refines the control points of the model, and remaps the current parameters accordingly. Returns the
+        gradient at the current parameters.
+        """
+        new_parameters = self.control_point_manager.update(self.current_iteration, self.current_parameters, gradient)
+        if new_parameters is None:
+            return gradient
+
+        self.current_parameters = new_parameters
+        self.current_attachment, self.current_regularity, gradient = self._evaluate_model_fit(self.current_parameters,
+                                                                                              with_grad=True)
+        self.current_log_likelihood = self.current_attachment + self.current_regularity
+        return gradient
+
     def _gradient_ascent_step(self, parameters, gradient, step):
         new_parameters = copy.deepcopy(parameters)
         for key in gradient.keys():
@@ -6,11 +6,19 @@ import numpy as np
 from scipy.optimize import minimize, brute, basinhopping
 
 from ...core import default
+from ...core.estimator_tools.control_point_manager import ControlPointManager
 from ...core.estimators.abstract_estimator import AbstractEstimator
 
 logger = logging.getLogger(__name__)
 
 
+class _ControlPointsRemapped(Exception):
+    """
+    Raised by the callback when the control points are pruned or refined, to restart the minimization.
+    """
+    pass
+
+
 class ScipyOptimize(AbstractEstimator):
     """
     ScipyOptimize object class.
@@ -29,6 +37,9 @@ class ScipyOptimize(AbstractEstimator):
                  memory_length=default.memory_length,
                  # parameters_shape, parameters_order, gradient_memory,
                  max_line_search_iterations=default.max_line_search_iterations,
+                 update_control_points_every_n_iters=default.update_control_points_every_n_iters,
+                 control_points_pruning_threshold=default.control_points_pruning_threshold,
+                 control_points_refinement_threshold=default.control_points_refinement_threshold,
                  output_dir=default.output_dir, verbose=default.verbose,
                  callback=None,
                  load_state_file=default.load_state_file, state_file=default.state_file,
@@ -72,6 +83,15 @@ class ScipyOptimize(AbstractEstimator):
         self.memory_length = memory_length
         self.max_line_search_iterations = max_line_search_iterations
 
+        # Optional pruning and refinement of the control points, along the L-BFGS-B minimization.
+        self.control_point_manager = None
+        if update_control_points_every_n_iters is not None:
+            self.control_point_manager = ControlPointManager(
+                statistical_model, update_control_points_every_n_iters,
+                pruning_threshold=control_points_pruning_threshold,
+                refinement_threshold=control_points_refinement_threshold)
+        self._parameters_memory = None
+
 
     ####################################################################################################################
     ### Public methods:
@@ -98,18 +118,26 @@ class ScipyOptimize(AbstractEstimator):
 
         try:
             if self.method == 'L-BFGS-B':
-                result = minimize(self._cost_and_derivative, self.x0.astype('float64'),
-                                  method='L-BFGS-B', jac=True, callback=self._callback,
-                                  options={
-                                      'maxiter': self.max_iterations + 10,
-                                      'maxls': self.max_line_search_iterations,
-                                      'ftol': self.convergence_tolerance,
-                                      # Number of previous gradients used to approximate the Hessian.
-                                      'maxcor': self.memory_length,
-                                      'disp': False
-                                  })
-                msg = result.message.decode("utf-8")
-                if msg == 'ABNORMAL_TERMINATION_IN_LNSRCH':
+                while True:
+                    try:
+                        result = minimize(self._cost_and_derivative, self.x0.astype('float64'),
+                                          method='L-BFGS-B', jac=True, callback=self._callback,
+                                          options={
+                                              'maxiter': self.max_iterations + 10,
+                                              'maxls': self.max_line_search_iterations,
+                                              'ftol': self.convergence_tolerance,
+                                              # Number of previous gradients used to approximate the Hessian.
+                                              'maxcor': self.memory_length,
+                                              'disp': False
+                                          })
+                        break
+                    except _ControlPointsRemapped:
+                        # The memory of L-BFGS-B cannot be remapped: the minimization restarts from the remapped x0.
+                        logger.info('>> Restarting the L-BFGS-B minimization with the new control points.')
+                # The message is bytes with older scipy versions, and starts with 'ABNORMAL: ' instead of being
+                # 'ABNORMAL_TERMINATION_IN_LNSRCH' with recent ones.
+                msg = result.message.decode("utf-8") if isinstance(result.message, bytes) else result.message
+                if msg.startswith('ABNORMAL'):
                     logger.info('>> Number of line search loops exceeded. Stopping.')
 
                 else:
@@ -240,6 +268,7 @@ class ScipyOptimize(AbstractEstimator):
 
         # Memory for exception handling.
         self._gradient_memory = gradient.astype('float64')
+        self._parameters_memory = np.copy(x)
 
         # Return.
         return cost.astype('float64'), gradient.astype('float64')
@@ -261,6 +290,29 @@ class ScipyOptimize(AbstractEstimator):
             if self.verbose > 0 and not self.current_iteration % self.print_every_n_iters:
                 self.print()
 
+        if self.control_point_manager is not None and self.method == 'L-BFGS-B':
+            self._update_control_points(x)
+
+    def _update_control_points(self, x):
+        """
+        Prunes and refines the control points of the model. When they change, x0 and the shapes of the parameters are
+        remapped, and the minimization is restarted.
+        """
+        # The gradient at x is most often the one of the last evaluation.
+        if self._parameters_memory is None or not np.array_equal(x, self._parameters_memory):
+            self._cost_and_derivative(x)
+        new_parameters = self.control_point_manager.update(self.current_iteration, self._unvectorize_parameters(x),
+                                                           self._unvectorize_parameters(- self._gradient_memory))
+        if new_parameters is None:
+            return
+
+        self.parameters_shape = {key: value.shape for key, value in new_parameters.items()}
+        self.x0 = self._vectorize_parameters(new_parameters)
+        self._set_parameters(new_parameters)
+        self._gradient_memory = None
+        self._parameters_memory = None
+        raise _ControlPointsRemapped
+
     def _get_parameters(self):
         """
         Return a dictionary of numpy arrays.
@@ -88,10 +88,12 @@ class MultiObjectAttachment:
         """
         device, _ = utilities.get_best_device(kernel.gpu_mode)
         c1, n1, c2, n2 = MultiObjectAttachment.__get_source_and_target_centers_and_normals(points, source, target, device=device)
+        accumulation_dtype = utilities.get_accumulation_dtype(c1.dtype)
 
         def current_scalar_product(points_1, points_2, normals_1, normals_2):
             assert points_1.device == points_2.device == normals_1.device == normals_2.device, 'tensors must be on the same device'
-            return torch.dot(normals_1.view(-1), kernel.convolve(points_1, points_2, normals_2).view(-1))
+            return torch.dot(normals_1.view(-1).to(accumulation_dtype),
+                             kernel.convolve(points_1, points_2, normals_2).view(-1).to(accumulation_dtype))
 
         if target.norm is None:
             target.norm = current_scalar_product(c2, c2, n2, n2)
@@ -106,10 +108,12 @@ class MultiObjectAttachment:
         """
         device, _ = utilities.get_best_device(kernel.gpu_mode)
         c1, n1, c2, n2 = MultiObjectAttachment.__get_source_and_target_centers_and_normals(points, source, target, device=device)
+        accumulation_dtype = utilities.get_accumulation_dtype(c1.dtype)
 
         def point_cloud_scalar_product(points_1, points_2, normals_1, normals_2):
-            return torch.dot(normals_1.view(-1),
-                             kernel.convolve(points_1, points_2, normals_2, mode='pointcloud').view(-1))
+            return torch.dot(normals_1.view(-1).to(accumulation_dtype),
+                             kernel.convolve(points_1, points_2, normals_2, mode='pointcloud').view(-1)
+                             .to(accumulation_dtype))
 
         if target.norm is None:
             target.norm = point_cloud_scalar_product(c2, c2, n2, n2)
@@ -126,6 +130,7 @@ class MultiObjectAttachment:
         """
         device, _ = utilities.get_best_device(kernel.gpu_mode)
         c1, n1, c2, n2 = MultiObjectAttachment.__get_source_and_target_centers_and_normals(points, source, target, device=device)
+        accumulation_dtype = utilities.get_accumulation_dtype(c1.dtype)
 
         # alpha = normales non unitaires
         areaa = torch.norm(n1, 2, 1)
@@ -135,7 +140,9 @@ class MultiObjectAttachment:
         nbeta = n2 / areab.unsqueeze(1)
 
         def varifold_scalar_product(x, y, areaa, areab, nalpha, nbeta):
-            return torch.dot(areaa.view(-1), kernel.convolve((x, nalpha), (y, nbeta), areab.view(-1, 1), mode='varifold').view(-1))
+            return torch.dot(areaa.view(-1).to(accumulation_dtype),
+                             kernel.convolve((x, nalpha), (y, nbeta), areab.view(-1, 1), mode='varifold').view(-1)
+                             .to(accumulation_dtype))
 
         if target.norm is None:
             target.norm = varifold_scalar_product(c2, c2, areab, areab, nbeta, nbeta)
@@ -150,7 +157,8 @@ class MultiObjectAttachment:
         """
         target_points = utilities.move_data(target.get_points(), dtype=str(points.type()), device=points.device)
         assert points.device == target_points.device, 'tensors must be on the same device'
-        return torch.sum((points.contiguous().view(-1) - target_points.contiguous().view(-1)) ** 2)
+        return torch.sum((points.contiguous().view(-1) - target_points.contiguous().view(-1)) ** 2,
+                         dtype=utilities.get_accumulation_dtype(points.dtype))
 
     @staticmethod
     def L2_distance(intensities, target):
@@ -167,7 +175,8 @@ class MultiObjectAttachment:
         target_intensities = utilities.move_data(target.get_intensities(), dtype=intensities.type(), device=intensities.device)
         # target_intensities = target.get_intensities_torch(tensor_scalar_type=intensities.type(), device=intensities.device)
         assert intensities.device == target_intensities.device, 'tensors must be on the same device'
-        return torch.sum((intensities.contiguous().view(-1) - target_intensities.contiguous().view(-1)) ** 2)
+        return torch.sum((intensities.contiguous().view(-1) - target_intensities.contiguous().view(-1)) ** 2,
+                         dtype=utilities.get_accumulation_dtype(intensities.dtype))
 
     ####################################################################################################################
     ### Private methods:
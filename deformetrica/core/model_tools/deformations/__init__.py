@@ -1,4 +1,5 @@
 
 from .exponential import Exponential
+from .batched_exponential import BatchedExponential
 from .geodesic import Geodesic
 from .spatiotemporal_reference_frame import SpatiotemporalReferenceFrame
@@ -0,0 +1,85 @@
+import torch
+
+from ....core.model_tools.deformations.exponential import Exponential
+
+
+class BatchedExponential(Exponential):
+    """
+    Exponential that shoots and flows B independent (template points, control points, momenta) triples at once, along
+    the leading batch dimension of the kernel operations.
+    Triples with different numbers of control points or landmark points are padded to the largest ones. The padding
+    control points carry zero momenta: they do not contribute to the velocity fields, and their momenta remain zero.
+    The padding points are dropped from the results.
+
+    """
+
+    ####################################################################################################################
+    ### Constructor:
+    ####################################################################################################################
+
+    def __init__(self, *args, **kwargs):
+        Exponential.__init__(self, *args, **kwargs)
+        # Numbers of control points, and of points of each template points key, of the B triples before padding.
+        self.numbers_of_control_points = None
+        self.numbers_of_template_points = None
+
+    ####################################################################################################################
+    ### Encapsulation methods:
+    ####################################################################################################################
+
+    def set_initial_states(self, template_points, control_points, momenta):
+        """
+        Sets the initial states of the B triples. Each argument is either a list of B tensors (or of B dictionaries of
+        tensors for the template points), whose numbers of points may differ, or a (B, N, D) tensor (or dictionary of
+        such tensors).
+        """
+        control_points, self.numbers_of_control_points = self._pad(control_points)
+        momenta, _ = self._pad(momenta, with_zeros=True)
+        self.set_initial_control_points(control_points)
+        self.set_initial_momenta(momenta)
+
+        if template_points is not None:
+            if isinstance(template_points, list):
+                template_points = {key: [elt[key] for elt in template_points] for key in template_points[0].keys()}
+            assert 'image_points' not in template_points.keys(), 'The image flow is not batched.'
+            padded_template_points, self.numbers_of_template_points = {}, {}
+            for key, value in template_points.items():
+                padded_template_points[key], self.numbers_of_template_points[key] = self._pad(value)
+            self.set_initial_template_points(padded_template_points)
+
+    def get_template_points_list(self, time_index=None):
+        """
+        Returns the list of the B dictionaries of template points, at the given time_index in the trajectory.
+        """
+        template_points = self.get_template_points(time_index)
+        numbers_of_points = self.numbers_of_template_points
+        if self.dense_mode:
+            numbers_of_points = {key: self.numbers_of_control_points for key in template_points.keys()}
+        return [{key: value[b, :numbers_of_points[key][b]] for key, value in template_points.items()}
+                for b in range(len(self.numbers_of_control_points))]
+
+    def get_norms_squared(self):
+        """
+        Returns the (B,) squared norms of the initial momenta.
+        """
+        return self.scalar_products(self.initial_control_points, self.initial_momenta, self.initial_momenta)
+
+    ####################################################################################################################
+    ### Utility methods:
+    ####################################################################################################################
+
+    @staticmethod
+    def _pad(tensors, with_zeros=False):
+        """
+        Stacks the list of (N_b, D) tensors into a (B, max N_b, D) tensor, padding each one with zeros or with copies of
+        its first point. Returns the stacked tensor and the list of the N_b.
+        """
+        if torch.is_tensor(tensors):
+            return tensors, [tensors.size(-2)] * tensors.size(0)
+
+        numbers_of_points = [elt.size(0) for elt in tensors]
+        size = max(numbers_of_points)
+        if min(numbers_of_points) < size:
+            tensors = [torch.cat([elt, elt.new_zeros((size - elt.size(0), elt.size(1))) if with_zeros
+                       else elt[:1].expand(size - elt.size(0), elt.size(1))]) for elt in tensors]
+        return torch.stack(tensors), numbers_of_points
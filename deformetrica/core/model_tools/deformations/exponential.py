@@ -1,6 +1,12 @@
+import inspect
+import math
 import warnings
+from concurrent.futures import ThreadPoolExecutor
 from copy import deepcopy
+from functools import partial
+
 import torch
+from torch.utils.checkpoint import checkpoint
 
 from ....core import default
 from ....in_out.array_readers_and_writers import *
@@ -10,6 +16,56 @@ from ....support import kernels as kernel_factory
 import logging
 logger = logging.getLogger(__name__)
 
+# Butcher tableaus (a, b, b_low) of the explicit Runge-Kutta methods, b_low being the weights of the embedded lower
+# order solution used for error control.
+runge_kutta_tableaus = {
+    'rk4': ([[], [1 / 2], [0, 1 / 2], [0, 0, 1]], [1 / 6, 1 / 3, 1 / 3, 1 / 6], None),
+    # Dormand-Prince 5(4).
+    'dopri5': ([[], [1 / 5], [3 / 40, 9 / 40], [44 / 45, -56 / 15, 32 / 9],
+                [19372 / 6561, -25360 / 2187, 64448 / 6561, -212 / 729],
+                [9017 / 3168, -355 / 33, 46732 / 5247, 49 / 176, -5103 / 18656],
+                [35 / 384, 0, 500 / 1113, 125 / 192, -2187 / 6784, 11 / 84]],
+               [35 / 384, 0, 500 / 1113, 125 / 192, -2187 / 6784, 11 / 84, 0],
+               [5179 / 57600, 0, 7571 / 16695, 393 / 640, -92097 / 339200, 187 / 2100, 1 / 40])
+}
+
+
+def run_concurrently(functions):
+    """
+    Returns the results of the given functions, run on concurrent threads that split the intra-op threads of torch
+    between them, when there are at least two intra-op threads. torch operators release the GIL, and the grad mode of
+    the calling thread is propagated to the others. The number of intra-op threads is process-wide, and the caches of
+    the kernels are shared by the threads without locks: it is only used on explicit request (the parareal shoot
+    integrator, and Geodesic.concurrent_exponentials).
+    """
+    number_of_threads = torch.get_num_threads()
+    if len(functions) < 2 or number_of_threads < 2:
+        return [function() for function in functions]
+
+    grad_enabled = torch.is_grad_enabled()
+
+    def run(function):
+        torch.set_num_threads(max(1, number_of_threads // len(functions)))
+        with torch.set_grad_enabled(grad_enabled):
+            return function()
+
+    try:
+        with ThreadPoolExecutor(max_workers=len(functions)) as executor:
+            futures = [executor.submit(run, function) for function in functions]
+            return [future.result() for future in futures]
+    finally:
+        torch.set_num_threads(number_of_threads)
+
+
+# align_corners appeared in torch 1.3, with the previous behavior as default until torch 1.4: the [-1, 1] normalized
+# coordinates span the centers of the corner voxels.
+grid_sample_kwargs = {'align_corners': True} \
+    if 'align_corners' in inspect.signature(torch.nn.functional.grid_sample).parameters else {}
+
+# use_reentrant appeared in torch 1.11: the non-reentrant checkpoint supports the inputs that do not require gradients,
+# and keyword arguments, and does not warn about the reentrant default on recent versions.
+checkpoint_kwargs = {'use_reentrant': False} if 'use_reentrant' in inspect.signature(checkpoint).parameters else {}
+
 
 class Exponential:
     """
@@ -20,6 +76,12 @@ class Exponential:
 
     """
 
+    # Above this number of control points, the parallel transport solves the kernel systems with matrix-free conjugate
+    # gradient iterations, stopped at a conjugate_gradient_tolerance relative residual, instead of with cholesky
+    # factorizations.
+    conjugate_gradient_threshold = 2000
+    conjugate_gradient_tolerance = 1e-6
+
     ####################################################################################################################
     ### Constructor:
     ####################################################################################################################
@@ -31,13 +93,18 @@ class Exponential:
                  initial_control_points=None, control_points_t=None,
                  initial_momenta=None, momenta_t=None,
                  initial_template_points=None, template_points_t=None,
-                 shoot_is_modified=True, flow_is_modified=True, use_rk2_for_shoot=False, use_rk2_for_flow=False):
+                 shoot_is_modified=True, flow_is_modified=True, use_rk2_for_shoot=False, use_rk2_for_flow=False,
+                 gradient_mode=default.gradient_mode, checkpoint_interval=default.checkpoint_interval,
+                 shoot_integrator=default.shoot_integrator, flow_integrator=default.flow_integrator,
+                 integrator_tolerance=default.integrator_tolerance,
+                 parareal_number_of_slices=default.parareal_number_of_slices, image_flow=default.image_flow):
 
         self.dense_mode = dense_mode
         self.kernel = kernel
 
         if shoot_kernel_type is not None:
-            self.shoot_kernel = kernel_factory.factory(shoot_kernel_type, gpu_mode=kernel.gpu_mode, kernel_width=kernel.kernel_width)
+            self.shoot_kernel = kernel_factory.factory(shoot_kernel_type, gpu_mode=kernel.gpu_mode,
+                                                       kernel_width=kernel.kernel_width, **kernel.options)
         else:
             self.shoot_kernel = self.kernel
 
@@ -64,10 +131,44 @@ class Exponential:
         # Wether to use a RK2 or a simple euler for shooting or flowing respectively.
         self.use_rk2_for_shoot = use_rk2_for_shoot
         self.use_rk2_for_flow = use_rk2_for_flow
-        # Contains the inverse kernel matrices for the time points 1 to self.number_of_time_points
+        # Integration schemes, that default to 'rk2' or 'euler' according to the above flags. The shoot integrator is
+        # one of 'euler', 'rk2', 'rk4', 'leapfrog' (symplectic, up to the tolerance of its fixed-point iterations) and
+        # 'adaptive' (Dormand-Prince steps, whose sizes keep the estimated local error below integrator_tolerance,
+        # between consecutive time points). The flow integrator is one of 'euler', 'rk2' (Heun), 'rk4' and 'adaptive':
+        # the two latter integrate the landmark points jointly with the control points and momenta, on each time step.
+        # The 'parareal' shoot integrator computes the 'rk2' trajectory by parareal_number_of_slices time slices
+        # integrated in parallel (see _integrate_parareal), up to integrator_tolerance. The number of slices defaults to
+        # the number of intra-op threads of torch.
+        self.shoot_integrator = shoot_integrator if shoot_integrator is not None \
+            else ('rk2' if use_rk2_for_shoot else 'euler')
+        self.flow_integrator = flow_integrator if flow_integrator is not None \
+            else ('rk2' if use_rk2_for_flow else 'euler')
+        assert self.shoot_integrator in ['euler', 'rk2', 'rk4', 'leapfrog', 'adaptive', 'parareal'], \
+            'Unknown shoot integrator: ' + str(self.shoot_integrator)
+        assert self.flow_integrator in ['euler', 'rk2', 'rk4', 'adaptive'], \
+            'Unknown flow integrator: ' + str(self.flow_integrator)
+        self.integrator_tolerance = integrator_tolerance
+        self.parareal_number_of_slices = parareal_number_of_slices
+        # Scheme of the image points flow: 'finite_difference' explicit euler steps of the transport equation, or
+        # 'semi_lagrangian' steps, that interpolate the displacement field of the previous time point at the departure
+        # points of the characteristics. The latter is unconditionally stable, and follows the characteristics with a
+        # midpoint rule when the flow integrator is not euler.
+        assert image_flow in ['finite_difference', 'semi_lagrangian'], 'Unknown image flow: ' + str(image_flow)
+        self.image_flow = image_flow
+        # How gradients are computed through the shoot and the flow: 'autograd' keeps every intermediate result in the
+        # autograd graph, 'checkpoint' only keeps the inputs of segments of checkpoint_interval time steps, and
+        # recomputes their intermediate results during the backward pass. The interval defaults to the square root of
+        # the number of time steps, which minimizes the peak memory. 'adjoint' keeps neither intermediate results nor
+        # intermediate states for backward: the adjoint equations are integrated backward in time, along states
+        # reconstructed from the final ones (see AdjointIntegration). The backward memory does not depend on the number
+        # of time points, apart from the step inputs of the flow, that are the shoot trajectory.
+        assert gradient_mode in ['autograd', 'checkpoint', 'adjoint'], 'Unknown gradient mode: ' + str(gradient_mode)
+        self.gradient_mode = gradient_mode
+        self.checkpoint_interval = checkpoint_interval
+        # Contains the lower cholesky factors of the kernel matrices for the time points 1 to
+        # self.number_of_time_points, computed on demand by the parallel transport and reused until the next shoot
         # (ACHTUNG does not contain the initial matrix, it is not needed)
-        self.cometric_matrices = {}
-        # self.cholesky_matrices = {}
+        self.cholesky_matrices = {}
 
     def move_data_to_(self, device):
         if self.initial_control_points is not None:
@@ -87,7 +188,10 @@ class Exponential:
                                  self.initial_momenta, self.momenta_t,
                                  self.initial_template_points, self.template_points_t,
                                  self.shoot_is_modified, self.flow_is_modified,
-                                 self.use_rk2_for_shoot, self.use_rk2_for_flow)
+                                 self.use_rk2_for_shoot, self.use_rk2_for_flow,
+                                 self.gradient_mode, self.checkpoint_interval,
+                                 self.shoot_integrator, self.flow_integrator, self.integrator_tolerance,
+                                 self.parareal_number_of_slices, self.image_flow)
         return light_copy
 
     ####################################################################################################################
@@ -97,10 +201,12 @@ class Exponential:
     def set_use_rk2_for_shoot(self, flag):
         self.shoot_is_modified = True
         self.use_rk2_for_shoot = flag
+        self.shoot_integrator = 'rk2' if flag else 'euler'
 
     def set_use_rk2_for_flow(self, flag):
         self.flow_is_modified = True
         self.use_rk2_for_flow = flag
+        self.flow_integrator = 'rk2' if flag else 'euler'
 
     def get_kernel_type(self):
         return self.kernel.kernel_type
@@ -142,6 +248,13 @@ class Exponential:
         """
         return torch.sum(mom1 * self.kernel.convolve(cp, cp, mom2))
 
+    def scalar_products(self, cp, mom1, mom2):
+        """
+        returns the (B,) scalar products 'mom1 K(cp) mom 2' of (B, N, D) batches of momenta, each of the three arguments
+        possibly being a (N, D) tensor shared by the whole batch
+        """
+        return torch.sum(mom1 * self.kernel.convolve(cp, cp, mom2), (-2, -1))
+
     def get_template_points(self, time_index=None):
         """
         Returns the position of the landmark points, at the given time_index in the Trajectory
@@ -168,8 +281,7 @@ class Exponential:
         """
         assert self.number_of_time_points > 0
         if self.shoot_is_modified:
-            self.cometric_matrices.clear()
-            # self.cholesky_matrices.clear()
+            self.cholesky_matrices.clear()
             self.shoot()
             if self.initial_template_points is not None:
                 self.flow()
@@ -193,23 +305,15 @@ class Exponential:
         assert len(self.initial_momenta) > 0, "Momenta not initialized in shooting"
 
         # Integrate the Hamiltonian equations.
-        self.control_points_t = [self.initial_control_points]
-        self.momenta_t = [self.initial_momenta]
-
         dt = 1.0 / float(self.number_of_time_points - 1)
-
-        if self.use_rk2_for_shoot:
-            for i in range(self.number_of_time_points - 1):
-                new_cp, new_mom = self._rk2_step(self.shoot_kernel, self.control_points_t[i], self.momenta_t[i], dt,
-                                                 return_mom=True)
-                self.control_points_t.append(new_cp)
-                self.momenta_t.append(new_mom)
-
+        if self.shoot_integrator == 'parareal':
+            trajectory = self._integrate_parareal(self.shoot_kernel, dt,
+                                                  (self.initial_control_points, self.initial_momenta))
         else:
-            for i in range(self.number_of_time_points - 1):
-                new_cp, new_mom = self._euler_step(self.shoot_kernel, self.control_points_t[i], self.momenta_t[i], dt)
-                self.control_points_t.append(new_cp)
-                self.momenta_t.append(new_mom)
+            trajectory = self._integrate(self._get_shoot_step(self.shoot_kernel, dt),
+                                         (self.initial_control_points, self.initial_momenta))
+        self.control_points_t = [state[0] for state in trajectory]
+        self.momenta_t = [state[1] for state in trajectory]
 
         # Correctly resets the attribute flag.
         self.shoot_is_modified = False
@@ -237,45 +341,17 @@ class Exponential:
 
         # Flow landmarks points.
         if 'landmark_points' in self.initial_template_points.keys():
-            landmark_points = [self.initial_template_points['landmark_points']]
-
-            for i in range(self.number_of_time_points - 1):
-                d_pos = self.kernel.convolve(landmark_points[i], self.control_points_t[i], self.momenta_t[i])
-                landmark_points.append(landmark_points[i] + dt * d_pos)
-
-                if self.use_rk2_for_flow:
-                    # In this case improved euler (= Heun's method)
-                    # to save one computation of convolve gradient per iteration.
-                    if i < self.number_of_time_points - 2:
-                        landmark_points[-1] = landmark_points[i] + dt / 2 * \
-                                              (self.kernel.convolve(landmark_points[i + 1],
-                                                                    self.control_points_t[i + 1], self.momenta_t[i + 1]) + d_pos)
-                    else:
-                        final_cp, final_mom = self._rk2_step(self.kernel, self.control_points_t[-1], self.momenta_t[-1],
-                                                             dt, return_mom=True)
-                        landmark_points[-1] = landmark_points[i] + dt / 2 * (
-                                self.kernel.convolve(landmark_points[i + 1], final_cp, final_mom) + d_pos)
-
-            self.template_points_t['landmark_points'] = landmark_points
+            landmark_step, get_landmark_step_inputs = self._get_landmark_step(dt)
+            trajectory = self._integrate(landmark_step, (self.initial_template_points['landmark_points'],),
+                                         get_landmark_step_inputs)
+            self.template_points_t['landmark_points'] = [state[0] for state in trajectory]
 
         # Flow image points.
         if 'image_points' in self.initial_template_points.keys():
-            image_points = [self.initial_template_points['image_points']]
-
-            dimension = self.initial_control_points.size(1)
-            image_shape = image_points[0].size()
-
-            for i in range(self.number_of_time_points - 1):
-                vf = self.kernel.convolve(image_points[0].contiguous().view(-1, dimension), self.control_points_t[i],
-                                          self.momenta_t[i]).view(image_shape)
-                dY = self._compute_image_explicit_euler_step_at_order_1(image_points[i], vf)
-                image_points.append(image_points[i] - dt * dY)
-
-            if self.use_rk2_for_flow:
-                msg = 'RK2 not implemented to flow image points.'
-                logger.warning(msg)
-
-            self.template_points_t['image_points'] = image_points
+            image_step, get_image_step_inputs = self._get_image_step(dt)
+            trajectory = self._integrate(image_step, (self.initial_template_points['image_points'],),
+                                         get_image_step_inputs)
+            self.template_points_t['image_points'] = [state[0] for state in trajectory]
 
         assert len(self.template_points_t) > 0, 'That\'s unexpected'
 
@@ -283,102 +359,169 @@ class Exponential:
         self.flow_is_modified = False
         # logger.info('exponential.flow(): ' + str(time.perf_counter() - start_update))
 
+    def stream(self):
+        """
+        Generator of the (control_points, momenta, template_points) states of the exponential at its successive time
+        points, computed under torch.no_grad. Only the states of the current time step are kept: the memory footprint
+        does not depend on the number of time points, and the stored trajectories are left untouched.
+        """
+        assert self.number_of_time_points > 0
+        assert len(self.initial_control_points) > 0, "Control points not initialized in shooting"
+        assert len(self.initial_momenta) > 0, "Momenta not initialized in shooting"
+
+        # Windows of the shoot trajectory, that hold the states of the time points i and i + 1 read by the flow steps.
+        control_points_t = {0: self.initial_control_points.detach()}
+        momenta_t = {0: self.initial_momenta.detach()}
+        template_points = {}
+        if self.initial_template_points is not None:
+            template_points = {key: value.detach() for key, value in self.initial_template_points.items()}
+
+        if self.number_of_time_points > 1:
+            dt = 1.0 / float(self.number_of_time_points - 1)
+            shoot_step = self._get_shoot_step(self.shoot_kernel, dt)
+            flow_steps = {}
+            if self.dense_mode:
+                assert 'image_points' not in template_points.keys(), 'Dense mode not allowed with image data.'
+            elif 'landmark_points' in template_points.keys():
+                flow_steps['landmark_points'] = self._get_landmark_step(dt, control_points_t, momenta_t)
+            if not self.dense_mode and 'image_points' in template_points.keys():
+                flow_steps['image_points'] = self._get_image_step(dt, control_points_t, momenta_t)
+
+        for i in range(self.number_of_time_points):
+            if self.dense_mode and len(template_points) > 0:
+                template_points = {'landmark_points': control_points_t[i]}
+            yield control_points_t[i], momenta_t[i], template_points
+
+            if i == self.number_of_time_points - 1:
+                break
+            with torch.no_grad():
+                control_points_t[i + 1], momenta_t[i + 1] = shoot_step(i, control_points_t[i], momenta_t[i])
+                template_points = {key: flow_steps[key][0](i, value, *flow_steps[key][1](i))[0]
+                                   if key in flow_steps else value for key, value in template_points.items()}
+            del control_points_t[i], momenta_t[i]
+
+    def get_final_template_points(self):
+        """
+        Returns the template points at the last time point. When no gradient is to be computed, those of an exponential
+        that was modified are streamed (see stream), instead of being read from the updated trajectories.
+        """
+        if self.shoot_is_modified or self.flow_is_modified:
+            parameters = [self.initial_control_points, self.initial_momenta] \
+                         + list(self.initial_template_points.values())
+            if not (torch.is_grad_enabled() and any(elt.requires_grad for elt in parameters)):
+                for _, _, template_points in self.stream():
+                    pass
+                return template_points
+            self.update()
+        return self.get_template_points()
+
     def parallel_transport(self, momenta_to_transport, initial_time_point=0, is_orthogonal=False):
         """
         Parallel transport of the initial_momenta along the exponential.
         momenta_to_transport is assumed to be a torch Variable, carried at the control points on the diffeo.
+        It can also be a (S, N, D) batch of momenta, that are transported simultaneously: the perturbed geodesics of the
+        whole batch are shot with batched kernel operations, and the kernel systems are solved for all of them at once.
+        The transport is then a list of (S, N, D) tensors.
         if is_orthogonal is on, then the momenta to transport must be orthogonal to the momenta of the geodesic.
         Note: uses shoot kernel
         """
 
         # Sanity checks ------------------------------------------------------------------------------------------------
         assert not self.shoot_is_modified, "You want to parallel transport but the shoot was modified, please update."
-        assert self.use_rk2_for_shoot, "The shoot integration must be done with a second order numerical scheme in order to use parallel transport."
-        assert (momenta_to_transport.size() == self.initial_momenta.size())
+        assert self.shoot_integrator != 'euler', "The shoot integration must be done with a second order numerical scheme in order to use parallel transport."
+        assert (momenta_to_transport.size()[-2:] == self.initial_momenta.size())
+
+        is_batched = momenta_to_transport.dim() == 3
+        if not is_batched:
+            momenta_to_transport = momenta_to_transport.unsqueeze(0)
 
         # Special cases, where the transport is simply the identity ----------------------------------------------------
         #       1) Nearly zero initial momenta yield no motion.
         #       2) Nearly zero momenta to transport.
-        if (torch.norm(self.initial_momenta).detach().cpu().numpy() < 1e-6 or
-                torch.norm(momenta_to_transport).detach().cpu().numpy() < 1e-6):
-            parallel_transport_t = [momenta_to_transport] * (self.number_of_time_points - initial_time_point)
-            return parallel_transport_t
+        parallel_transport_t = [momenta_to_transport] * (self.number_of_time_points - initial_time_point)
+        norms = torch.norm(momenta_to_transport.detach().contiguous().view(momenta_to_transport.size(0), -1), dim=1)
+        moving = torch.nonzero(norms >= 1e-6).view(-1)
+        if torch.norm(self.initial_momenta).detach().cpu().numpy() >= 1e-6 and len(moving) > 0:
+            if len(moving) == momenta_to_transport.size(0):
+                parallel_transport_t = self._parallel_transport(momenta_to_transport, initial_time_point,
+                                                                is_orthogonal)
+            else:
+                parallel_transport_t = [momenta_to_transport.index_copy(0, moving, transported_momenta)
+                                        for transported_momenta in self._parallel_transport(
+                        momenta_to_transport[moving], initial_time_point, is_orthogonal)]
+
+        return parallel_transport_t if is_batched else [elt[0] for elt in parallel_transport_t]
+
+    def _parallel_transport(self, momenta_to_transport, initial_time_point, is_orthogonal):
+        """
+        Parallel transport of the (S, N, D) batch of non-zero momenta_to_transport.
+        """
 
         # Step sizes ---------------------------------------------------------------------------------------------------
         h = 1. / (self.number_of_time_points - 1.)
         epsilon = h
+        batch_size = momenta_to_transport.size(0)
 
         # For printing -------------------------------------------------------------------------------------------------
         worst_renormalization_factor = 1.0
 
         # Optional initial orthogonalization ---------------------------------------------------------------------------
         norm_squared = self.get_norm_squared()
+        sp = (self.scalar_products(self.control_points_t[initial_time_point], momenta_to_transport,
+                                  self.momenta_t[initial_time_point]) / norm_squared).view(-1, 1, 1)
         if not is_orthogonal:
-            sp = self.scalar_product(self.control_points_t[initial_time_point], momenta_to_transport,
-                                     self.momenta_t[initial_time_point]) / norm_squared
             momenta_to_transport_orthogonal = momenta_to_transport - sp * self.momenta_t[initial_time_point]
             parallel_transport_t = [momenta_to_transport_orthogonal]
         else:
-            sp = (self.scalar_product(
-                self.control_points_t[initial_time_point], momenta_to_transport,
-                self.momenta_t[initial_time_point]) / norm_squared).detach().cpu().numpy()
-            assert abs(sp) < 1e-2, \
+            worst_sp = torch.max(torch.abs(sp)).detach().cpu().numpy()
+            assert worst_sp < 1e-2, \
                 'Error: the momenta to transport is not orthogonal to the driving momenta, ' \
-                'but the is_orthogonal flag is active. sp = %.3E' % sp
+                'but the is_orthogonal flag is active. sp = %.3E' % worst_sp
             parallel_transport_t = [momenta_to_transport]
 
         # Then, store the initial norm of this orthogonal momenta ------------------------------------------------------
-        initial_norm_squared = self.scalar_product(self.control_points_t[initial_time_point], parallel_transport_t[0],
-                                                   parallel_transport_t[0])
+        initial_norm_squared = self.scalar_products(self.control_points_t[initial_time_point], parallel_transport_t[0],
+                                                   parallel_transport_t[0]).view(-1, 1, 1)
+
+        # The perturbed geodesics are shot with the step of the shoot integrator, that integrated the main one.
+        shoot_step = self._get_shoot_step(self.shoot_kernel, h)
 
         for i in range(initial_time_point, self.number_of_time_points - 1):
-            # Shoot the two perturbed geodesics ------------------------------------------------------------------------
-            cp_eps_pos = self._rk2_step(self.shoot_kernel, self.control_points_t[i],
-                                        self.momenta_t[i] + epsilon * parallel_transport_t[-1], h, return_mom=False)
-            cp_eps_neg = self._rk2_step(self.shoot_kernel, self.control_points_t[i],
-                                        self.momenta_t[i] - epsilon * parallel_transport_t[-1], h, return_mom=False)
+            # Shoot the two perturbed geodesics of each momenta, in a single batch -------------------------------------
+            momenta_eps = torch.cat([self.momenta_t[i] + epsilon * parallel_transport_t[-1],
+                                     self.momenta_t[i] - epsilon * parallel_transport_t[-1]])
+            if self.shoot_integrator in ['rk2', 'parareal']:
+                cp_eps = self._rk2_step(self.shoot_kernel, self.control_points_t[i], momenta_eps, h, return_mom=False)
+            else:
+                cp_eps = shoot_step(i, self.control_points_t[i].expand(momenta_eps.size()), momenta_eps)[0]
+            cp_eps_pos, cp_eps_neg = cp_eps[:batch_size], cp_eps[batch_size:]
 
             # Compute J/h ----------------------------------------------------------------------------------------------
             approx_velocity = (cp_eps_pos - cp_eps_neg) / (2 * epsilon * h)
 
             # We need to find the cotangent space version of this vector -----------------------------------------------
-            # If we don't have already the cometric matrix, we compute and store it.
-            # TODO: add optional flag for not saving this if it's too large.
-            # OPTIM: keep an eye on https://github.com/pytorch/pytorch/issues/4669
-            if i not in self.cometric_matrices:
-                kernel_matrix = self.shoot_kernel.get_kernel_matrix(self.control_points_t[i + 1])
-                # self.kernel_matrices[i] = kernel_matrix
-                # self.cholesky_matrices[i] = torch.potrf(kernel_matrix.t().matmul(kernel_matrix), upper=False)
-                # self.cholesky_matrices[i] = torch.cholesky(kernel_matrix, upper=False)
-                # self.cholesky_matrices[i] = torch.potrf(kernel_matrix, upper=True)
-                self.cometric_matrices[i] = torch.inverse(kernel_matrix)
-                # self.cometric_matrices[i] = torch.inverse(kernel_matrix.cuda()).cpu()
-
-            # Solve the linear system.
-            # rhs = approx_velocity.matmul(self.kernel_matrices[i])
-            # z = torch.trtrs(rhs.t(), self.cholesky_matrices[i], transpose=False, upper=False)[0]
-            # approx_momenta = torch.trtrs(z, self.cholesky_matrices[i], transpose=True, upper=False)[0]
-            # approx_momenta = torch.potrs(approx_velocity, self.cholesky_matrices[i], upper=True)
-            approx_momenta = torch.mm(self.cometric_matrices[i], approx_velocity)
+            approx_momenta = self._apply_cometric(i + 1, approx_velocity, parallel_transport_t[-1])
 
             # We get rid of the component of this momenta along the geodesic velocity:
-            scalar_prod_with_velocity = self.scalar_product(self.control_points_t[i + 1], approx_momenta,
-                                                            self.momenta_t[i + 1]) / norm_squared
+            scalar_prod_with_velocity = (self.scalar_products(self.control_points_t[i + 1], approx_momenta,
+                                                             self.momenta_t[i + 1]) / norm_squared).view(-1, 1, 1)
 
             approx_momenta = approx_momenta - scalar_prod_with_velocity * self.momenta_t[i + 1]
 
             # Renormalization ------------------------------------------------------------------------------------------
-            approx_momenta_norm_squared = self.scalar_product(self.control_points_t[i + 1], approx_momenta,
-                                                              approx_momenta)
+            approx_momenta_norm_squared = self.scalar_products(self.control_points_t[i + 1], approx_momenta,
+                                                              approx_momenta).view(-1, 1, 1)
 
             renormalization_factor = torch.sqrt(initial_norm_squared / approx_momenta_norm_squared)
             renormalized_momenta = approx_momenta * renormalization_factor
 
-            if abs(renormalization_factor.detach().cpu().numpy() - 1.) > 0.1:
+            renormalization_factor = renormalization_factor.detach().cpu().numpy().reshape(-1)
+            renormalization_factor = renormalization_factor[abs(renormalization_factor - 1.).argmax()]
+            if abs(renormalization_factor - 1.) > 0.1:
                 raise ValueError('Absurd required renormalization factor during parallel transport: %.4f. '
-                                 'Exception raised.' % renormalization_factor.detach().cpu().numpy())
-            elif abs(renormalization_factor.detach().cpu().numpy() - 1.) > abs(worst_renormalization_factor - 1.):
-                worst_renormalization_factor = renormalization_factor.detach().cpu().numpy()
+                                 'Exception raised.' % renormalization_factor)
+            elif abs(renormalization_factor - 1.) > abs(worst_renormalization_factor - 1.):
+                worst_renormalization_factor = renormalization_factor
 
             # Finalization ---------------------------------------------------------------------------------------------
             parallel_transport_t.append(renormalized_momenta)
@@ -388,8 +531,8 @@ class Exponential:
 
         # We now need to add back the component along the velocity to the transported vectors.
         if not is_orthogonal:
-            parallel_transport_t = [parallel_transport_t[i] + sp * self.momenta_t[i]
-                                    for i in range(initial_time_point, self.number_of_time_points)]
+            parallel_transport_t = [transported_momenta + sp * momenta for transported_momenta, momenta
+                                    in zip(parallel_transport_t, self.momenta_t[initial_time_point:])]
 
         if abs(worst_renormalization_factor - 1.) > 0.05:
             msg = ("Watch out, a large renormalization factor %.4f is required during the parallel transport. "
@@ -412,12 +555,9 @@ class Exponential:
 
         # Extended shoot.
         dt = 1.0 / float(self.number_of_time_points - 1)  # Same time-step.
+        shoot_step = self._get_shoot_step(self.kernel, dt)
         for i in range(number_of_additional_time_points):
-            if self.use_rk2_for_shoot:
-                new_cp, new_mom = self._rk2_step(self.kernel, self.control_points_t[-1], self.momenta_t[-1], dt,
-                                                 return_mom=True)
-            else:
-                new_cp, new_mom = self._euler_step(self.kernel, self.control_points_t[-1], self.momenta_t[-1], dt)
+            new_cp, new_mom = shoot_step(i, self.control_points_t[-1], self.momenta_t[-1])
 
             self.control_points_t.append(new_cp)
             self.momenta_t.append(new_mom)
@@ -431,7 +571,14 @@ class Exponential:
         # Standard case.
         else:
             # Flow landmark points.
-            if 'landmark_points' in self.initial_template_points.keys():
+            if 'landmark_points' in self.initial_template_points.keys() and self.flow_integrator in ['rk4', 'adaptive']:
+                landmark_step, get_landmark_step_inputs = self._get_landmark_step(dt)
+                for ii in range(number_of_additional_time_points):
+                    i = len(self.template_points_t['landmark_points']) - 1
+                    self.template_points_t['landmark_points'].append(
+                        landmark_step(i, self.template_points_t['landmark_points'][i], *get_landmark_step_inputs(i))[0])
+
+            elif 'landmark_points' in self.initial_template_points.keys():
                 for ii in range(number_of_additional_time_points):
                     i = len(self.template_points_t['landmark_points']) - 1
                     d_pos = self.kernel.convolve(self.template_points_t['landmark_points'][i], self.control_points_t[i],
@@ -448,19 +595,11 @@ class Exponential:
 
             # Flow image points.
             if 'image_points' in self.initial_template_points.keys():
-                dimension = self.initial_control_points.size(1)
-                image_shape = self.initial_template_points['image_points'].size()
-
+                image_step, get_image_step_inputs = self._get_image_step(dt)
                 for ii in range(number_of_additional_time_points):
                     i = len(self.template_points_t['image_points']) - 1
-                    vf = self.kernel.convolve(self.initial_template_points['image_points'].contiguous().view(-1, dimension),
-                                              self.control_points_t[i], self.momenta_t[i]).view(image_shape)
-                    dY = self._compute_image_explicit_euler_step_at_order_1(self.template_points_t['image_points'][i], vf)
-                    self.template_points_t['image_points'].append(self.template_points_t['image_points'][i] - dt * dY)
-
-                if self.use_rk2_for_flow:
-                    msg = 'RK2 not implemented to flow image points.'
-                    logger.warning(msg)
+                    self.template_points_t['image_points'].append(
+                        image_step(i, self.template_points_t['image_points'][i], *get_image_step_inputs(i))[0])
 
         # Scaling of the new length.
         length_ratio = float(self.number_of_time_points + number_of_additional_time_points - 1) \
@@ -473,6 +612,317 @@ class Exponential:
     ### Utility methods:
     ####################################################################################################################
 
+    def _apply_cometric(self, i, velocity, initial_guess):
+        """
+        Returns the momenta whose velocity field at the control points of time point i is velocity, i.e. solves the
+        kernel system K p = v. Small systems are solved with the cholesky factor of the kernel matrix, that is cached
+        until the next shoot; large ones with conjugate gradient iterations on the kernel convolution, started from
+        initial_guess.
+        """
+        control_points = self.control_points_t[i]
+        if control_points.size(0) > self.conjugate_gradient_threshold:
+            return ConjugateGradientSolve.apply(self.shoot_kernel, self.conjugate_gradient_tolerance,
+                                                control_points, velocity, initial_guess.detach())
+
+        if i not in self.cholesky_matrices:
+            self.cholesky_matrices[i] = self._cholesky(self.shoot_kernel.get_kernel_matrix(control_points))
+
+        # the columns of a (B, N, D) batch are solved together, as a (N, B.D) right-hand side.
+        rhs = velocity.transpose(-3, -2).contiguous().view(velocity.size(-2), -1) if velocity.dim() == 3 else velocity
+        momenta = torch.cholesky_solve(rhs, self.cholesky_matrices[i], upper=False)
+        if velocity.dim() == 3:
+            momenta = momenta.contiguous().view(velocity.size(-2), -1, velocity.size(-1)).transpose(0, 1)
+        return momenta.contiguous()
+
+    @staticmethod
+    def _cholesky(kernel_matrix, max_number_of_attempts=6):
+        """
+        Lower cholesky factor of the kernel matrix. Close control points make it numerically singular: a multiple of
+        the identity, growing with each failed attempt, is then added to its diagonal.
+        """
+        # torch.linalg appeared in torch 1.8, and torch.cholesky was later removed.
+        cholesky = torch.linalg.cholesky if hasattr(torch, 'linalg') else torch.cholesky
+        jitter = 0.
+        for attempt in range(max_number_of_attempts):
+            try:
+                if jitter > 0.:
+                    logger.warning('Ill-conditioned kernel matrix: adding %.1E to its diagonal for the parallel '
+                                   'transport.' % jitter)
+                    return cholesky(kernel_matrix + jitter * torch.eye(
+                        kernel_matrix.size(0), dtype=kernel_matrix.dtype, device=kernel_matrix.device))
+                return cholesky(kernel_matrix)
+            except RuntimeError:
+                jitter = 1e-10 if jitter == 0. else jitter * 100.
+        raise RuntimeError('The cholesky factorization of the kernel matrix failed, even with %.1E added to its '
+                           'diagonal.' % jitter)
+
+    def _get_shoot_step(self, kernel, dt):
+        """
+        Returns the shoot step function (i, cp, mom) -> (new_cp, new_mom) of the shoot integrator, the fine 'rk2' one
+        for the parareal integrator.
+        """
+        if self.shoot_integrator == 'euler':
+            return lambda i, cp, mom: self._euler_step(kernel, cp, mom, dt)
+        elif self.shoot_integrator in ['rk2', 'parareal']:
+            return lambda i, cp, mom: self._rk2_step(kernel, cp, mom, dt)
+        elif self.shoot_integrator == 'leapfrog':
+            return lambda i, cp, mom: self._leapfrog_step(kernel, cp, mom, dt)
+
+        def derivative(cp, mom):
+            return self._hamiltonian_derivative(kernel, cp, mom)
+
+        return lambda i, cp, mom: self._high_order_step(derivative, (cp, mom), dt, self.shoot_integrator)
+
+    def _get_image_step(self, dt, control_points_t=None, momenta_t=None):
+        """
+        Returns the image flow step function (i, image_points, *inputs) -> (new_image_points,) of the image flow scheme,
+        and the function returning the inputs of the i-th step, read from the control points and momenta trajectories,
+        that default to the stored ones. The velocity field is evaluated on the initial image points, i.e. the regular
+        grid on which the image points trajectory is defined.
+        """
+        control_points_t = self.control_points_t if control_points_t is None else control_points_t
+        momenta_t = self.momenta_t if momenta_t is None else momenta_t
+        initial_image_points = self.initial_template_points['image_points']
+        dimension = initial_image_points.size(-1)
+        image_shape = initial_image_points.size()
+
+        def velocity_field(grid_points, cp, mom):
+            return self.kernel.convolve(grid_points.contiguous().view(-1, dimension), cp, mom).view(image_shape)
+
+        if self.image_flow == 'finite_difference':
+            if self.flow_integrator != 'euler':
+                msg = '%s integrator not implemented to flow image points.' % self.flow_integrator.upper()
+                logger.warning(msg)
+
+            def image_step(i, image_points, grid_points, cp, mom):
+                dY = self._compute_image_explicit_euler_step_at_order_1(image_points,
+                                                                        velocity_field(grid_points, cp, mom))
+                return image_points - dt * dY,
+
+            return image_step, lambda i: (initial_image_points, control_points_t[i], momenta_t[i])
+
+        # Affine map from the physical coordinates of the grid to the [-1, 1] normalized ones of grid_sample.
+        origin = initial_image_points[(0,) * dimension].detach()
+        scale = 2. / (torch.stack([initial_image_points[tuple(-1 if k == d else 0 for k in range(dimension))][d]
+                                   for d in range(dimension)]).detach() - origin)
+
+        def interpolate(field, points):
+            return self._grid_sample(field, (points - origin) * scale - 1.)
+
+        if self.flow_integrator == 'euler':
+            def image_step(i, image_points, grid_points, cp, mom):
+                departure_points = grid_points - dt * velocity_field(grid_points, cp, mom)
+                return departure_points + interpolate(image_points - grid_points, departure_points),
+
+            return image_step, lambda i: (initial_image_points, control_points_t[i], momenta_t[i])
+
+        if self.flow_integrator != 'rk2':
+            msg = '%s integrator not implemented to flow image points, the RK2 one is used.' \
+                  % self.flow_integrator.upper()
+            logger.warning(msg)
+
+        def image_step(i, image_points, grid_points, cp, mom, next_cp, next_mom):
+            # midpoint rule along the characteristics, with the mid-step velocity field.
+            mid_velocity = 0.5 * (velocity_field(grid_points, cp, mom) + velocity_field(grid_points, next_cp, next_mom))
+            mid_points = grid_points - 0.5 * dt * mid_velocity
+            departure_points = grid_points - dt * interpolate(mid_velocity, mid_points)
+            return departure_points + interpolate(image_points - grid_points, departure_points),
+
+        return image_step, lambda i: (initial_image_points, control_points_t[i], momenta_t[i],
+                                      control_points_t[i + 1], momenta_t[i + 1])
+
+    @staticmethod
+    def _grid_sample(field, normalized_points):
+        """
+        Multilinear interpolation of the (*grid_shape, C) field at the (*grid_shape, D) points, given in the [-1, 1]
+        normalized coordinates of the grid. Points outside of the grid take the value of the nearest border point.
+        """
+        dimension = normalized_points.size(-1)
+        # grid_sample expects (1, C, *grid_shape) inputs, and points whose coordinates are ordered from the last axis.
+        res = torch.nn.functional.grid_sample(field.permute(dimension, *range(dimension)).unsqueeze(0),
+                                              normalized_points.flip(-1).unsqueeze(0),
+                                              padding_mode='border', **grid_sample_kwargs)
+        return res[0].permute(*range(1, dimension + 1), 0)
+
+    def _get_landmark_step(self, dt, control_points_t=None, momenta_t=None):
+        """
+        Returns the landmark flow step function (i, landmark_points, *inputs) -> (new_landmark_points,) of the flow
+        integrator, and the function returning the inputs of the i-th step, read from the control points and momenta
+        trajectories, that default to the stored ones.
+        """
+        control_points_t = self.control_points_t if control_points_t is None else control_points_t
+        momenta_t = self.momenta_t if momenta_t is None else momenta_t
+        if self.flow_integrator in ['rk4', 'adaptive']:
+            def derivative(cp, mom, landmark_points):
+                return self._hamiltonian_derivative(self.shoot_kernel, cp, mom) \
+                       + (self.kernel.convolve(landmark_points, cp, mom),)
+
+            def landmark_step(i, landmark_points, cp, mom):
+                return self._high_order_step(derivative, (cp, mom, landmark_points), dt,
+                                             self.flow_integrator)[2:]
+
+            return landmark_step, lambda i: (control_points_t[i], momenta_t[i])
+
+        def landmark_step(i, landmark_points, cp, mom, next_cp=None, next_mom=None):
+            d_pos = self.kernel.convolve(landmark_points, cp, mom)
+            new_landmark_points = landmark_points + dt * d_pos
+
+            if self.flow_integrator == 'rk2':
+                # In this case improved euler (= Heun's method)
+                # to save one computation of convolve gradient per iteration.
+                if i == self.number_of_time_points - 2:
+                    next_cp, next_mom = self._rk2_step(self.kernel, next_cp, next_mom, dt, return_mom=True)
+                new_landmark_points = landmark_points + dt / 2 * \
+                                      (self.kernel.convolve(new_landmark_points, next_cp, next_mom) + d_pos)
+
+            return new_landmark_points,
+
+        if self.flow_integrator == 'rk2':
+            def get_landmark_step_inputs(i):
+                return (control_points_t[i], momenta_t[i],
+                        control_points_t[i + 1], momenta_t[i + 1])
+        else:
+            def get_landmark_step_inputs(i):
+                return control_points_t[i], momenta_t[i]
+
+        return landmark_step, get_landmark_step_inputs
+
+    def _high_order_step(self, derivative, state, h, integrator):
+        """
+        rk4 or adaptive step of length h of the ode state' = derivative(*state).
+        """
+        if integrator == 'rk4':
+            return self._runge_kutta_step(derivative, state, h, runge_kutta_tableaus['rk4'])[0]
+        return self._adaptive_step(derivative, state, h, self.integrator_tolerance)
+
+    def _integrate(self, step, initial_state, get_step_inputs=lambda i: ()):
+        """
+        Integrates over the number_of_time_points - 1 time steps: the state at time i + 1 is step(i, *state_i,
+        *get_step_inputs(i)), states and step inputs being tuples of tensors. Returns the list of the states.
+        In checkpoint gradient mode, the steps are evaluated by segments whose intermediate results are not kept in
+        the autograd graph. In adjoint gradient mode, see AdjointIntegration.
+        """
+        number_of_steps = self.number_of_time_points - 1
+        trajectory = [initial_state]
+
+        if self.gradient_mode == 'autograd' or number_of_steps == 0 or not torch.is_grad_enabled():
+            for i in range(number_of_steps):
+                trajectory.append(step(i, *trajectory[-1], *get_step_inputs(i)))
+            return trajectory
+
+        if self.gradient_mode == 'adjoint':
+            step_inputs = [get_step_inputs(i) for i in range(number_of_steps)]
+            res = AdjointIntegration.apply(step, number_of_steps, len(initial_state),
+                                           tuple(len(inputs) for inputs in step_inputs),
+                                           *initial_state, *[t for inputs in step_inputs for t in inputs])
+            state_size = len(initial_state)
+            return trajectory + [tuple(res[k * state_size:(k + 1) * state_size]) for k in range(number_of_steps)]
+
+        interval = self.checkpoint_interval
+        if interval is None:
+            interval = int(math.ceil(math.sqrt(number_of_steps)))
+
+        for start in range(0, number_of_steps, interval):
+            trajectory.extend(self._integrate_segment(
+                step, trajectory[-1], range(start, min(start + interval, number_of_steps)), get_step_inputs))
+        return trajectory
+
+    def _integrate_parareal(self, kernel, dt, initial_state):
+        """
+        Parareal integration of the shoot over the number_of_time_points - 1 time steps, split into
+        parareal_number_of_slices time slices. The states at the starts of the slices are predicted by single coarse rk2
+        steps over the slices, then corrected by iterations: the slices are integrated concurrently by the fine rk2
+        steps, from the current starting states, and the new starting states are the fine ones, plus the difference of
+        the coarse steps from the new and from the current starting states. The iterations stop when the corrections
+        fall below integrator_tolerance * (1 + |state|): the k first starting states are exact after k iterations, so
+        that the serial trajectory is reached after at most parareal_number_of_slices iterations. A last fine sweep is
+        then integrated from the converged starting states, so that the returned trajectory only jumps by less than the
+        tolerance at the starts of the slices.
+        When gradients are required, the iterations are not recorded in the autograd graph: the trajectory is
+        differentiated through the last fine sweep, whatever the gradient mode (see PararealIntegration). The serial
+        trajectory is integrated when there is a single slice. Returns the list of the states.
+        """
+        number_of_steps = self.number_of_time_points - 1
+        fine_step = self._get_shoot_step(kernel, dt)
+        number_of_slices = min(number_of_steps, self.parareal_number_of_slices if
+                               self.parareal_number_of_slices is not None else torch.get_num_threads())
+        if number_of_slices < 2:
+            return self._integrate(fine_step, initial_state)
+
+        bounds = [int(round(k * number_of_steps / float(number_of_slices))) for k in range(number_of_slices + 1)]
+
+        def coarse(k, state):
+            return self._rk2_step(kernel, *state, dt * (bounds[k + 1] - bounds[k]))
+
+        def fine(k, state):
+            trajectory = [state]
+            for i in range(bounds[k], bounds[k + 1]):
+                trajectory.append(fine_step(i, *trajectory[-1]))
+            return trajectory[1:]
+
+        def integrate(*initial_state):
+            # Coarse prediction.
+            states, coarse_states = [initial_state], []
+            for k in range(number_of_slices - 1):
+                coarse_states.append(coarse(k, states[k]))
+                states.append(coarse_states[k])
+
+            # Corrections, until the fine sweep from converged starting states.
+            fine_trajectories, converged = [None] * number_of_slices, False
+            for iteration in range(number_of_slices):
+                fine_trajectories[iteration:] = run_concurrently(
+                    [partial(fine, k, states[k]) for k in range(iteration, number_of_slices)])
+
+                if converged or iteration == number_of_slices - 1:
+                    break
+
+                new_states = states[:iteration + 1] + [fine_trajectories[iteration][-1]]
+                for k in range(iteration + 1, number_of_slices - 1):
+                    new_coarse_state = coarse(k, new_states[k])
+                    new_states.append(tuple(f + (g - c) for f, g, c in zip(
+                        fine_trajectories[k][-1], new_coarse_state, coarse_states[k])))
+                    coarse_states[k] = new_coarse_state
+
+                correction = max(torch.max(torch.abs(n - s) / (1. + torch.abs(s))).item()
+                                 for k in range(iteration + 1, number_of_slices)
+                                 for n, s in zip(new_states[k], states[k]))
+                states = new_states
+                converged = correction <= self.integrator_tolerance
+
+            logger.debug('Parareal shoot converged in %d iterations over %d slices.'
+                         % (iteration + 1, number_of_slices))
+            return [state for trajectory in fine_trajectories for state in trajectory], states
+
+        if not torch.is_grad_enabled():
+            return [initial_state] + integrate(*initial_state)[0]
+
+        state_size = len(initial_state)
+        res = PararealIntegration.apply(integrate, fine_step, bounds, state_size, *initial_state)
+        return [initial_state] + [tuple(res[k * state_size:(k + 1) * state_size]) for k in range(number_of_steps)]
+
+    @staticmethod
+    def _integrate_segment(step, state, steps, get_step_inputs):
+        """
+        Checkpointed evaluation of the given steps: only the initial state and the step inputs are saved for backward.
+        """
+        state_size = len(state)
+        step_inputs = [get_step_inputs(i) for i in steps]
+
+        def segment(*args):
+            current_state, offset, res = args[:state_size], state_size, []
+            for i, inputs in zip(steps, step_inputs):
+                current_state = step(i, *current_state, *args[offset:offset + len(inputs)])
+                offset += len(inputs)
+                res.extend(current_state)
+            return tuple(res)
+
+        args = list(state) + [t for inputs in step_inputs for t in inputs]
+        if any(t.requires_grad for t in args):
+            res = checkpoint(segment, *args, **checkpoint_kwargs)
+        else:
+            res = segment(*args)
+        return [tuple(res[k * state_size:(k + 1) * state_size]) for k in range(len(steps))]
+
     @staticmethod
     def _euler_step(kernel, cp, mom, h):
         """
@@ -480,8 +930,8 @@ class Exponential:
         """
         assert cp.device == mom.device, 'tensors must be on the same device, cp.device=' + str(
             cp.device) + ', mom.device=' + str(mom.device)
-        return cp + h * kernel.convolve(cp, cp, mom), \
-               mom - h * kernel.convolve_gradient(mom, cp)
+        d_cp, d_mom = kernel.convolve_and_gradient(cp, mom)
+        return cp + h * d_cp, mom - h * d_mom
 
     @staticmethod
     def _rk2_step(kernel, cp, mom, h, return_mom=True):
@@ -493,14 +943,99 @@ class Exponential:
         assert cp.device == mom.device, 'tensors must be on the same device, cp.device=' + str(
             cp.device) + ', mom.device=' + str(mom.device)
 
-        mid_cp = cp + h / 2. * kernel.convolve(cp, cp, mom)
-        mid_mom = mom - h / 2. * kernel.convolve_gradient(mom, cp)
+        d_cp, d_mom = kernel.convolve_and_gradient(cp, mom)
+        mid_cp = cp + h / 2. * d_cp
+        mid_mom = mom - h / 2. * d_mom
         if return_mom:
-            return cp + h * kernel.convolve(mid_cp, mid_cp, mid_mom), \
-                   mom - h * kernel.convolve_gradient(mid_mom, mid_cp)
+            mid_d_cp, mid_d_mom = kernel.convolve_and_gradient(mid_cp, mid_mom)
+            return cp + h * mid_d_cp, mom - h * mid_d_mom
         else:
             return cp + h * kernel.convolve(mid_cp, mid_cp, mid_mom)
 
+    @staticmethod
+    def _leapfrog_step(kernel, cp, mom, h, tolerance=1e-10, max_number_of_iterations=20):
+        """
+        Generalized Stormer-Verlet step of length h, symplectic and of order 2, for the non-separable hamiltonian
+        H(cp, mom) = 1/2 <mom, K(cp) mom>. Its two implicit stages are solved by fixed-point iterations, until the
+        updates fall below tolerance * (1 + |stage|) (and the precision of the dtype): the step is symplectic and
+        time-reversible up to this tolerance. A warning is logged when max_number_of_iterations are not enough.
+        """
+        assert cp.device == mom.device, 'tensors must be on the same device, cp.device=' + str(
+            cp.device) + ', mom.device=' + str(mom.device)
+        tolerance = max(tolerance, 100. * torch.finfo(cp.dtype).eps)
+
+        def solve(fixed_point_map, initial_guess, name):
+            stage = initial_guess
+            for _ in range(max_number_of_iterations):
+                new_stage = fixed_point_map(stage)
+                update = torch.max(torch.abs(new_stage - stage)).item()
+                stage = new_stage
+                if update <= tolerance * (1. + torch.max(torch.abs(stage)).item()):
+                    return stage
+            logger.warning('The %s stage of the leapfrog step did not converge in %d fixed-point iterations: the step '
+                           'is not exactly symplectic. Try using more time points.' % (name, max_number_of_iterations))
+            return stage
+
+        d_cp, d_mom = kernel.convolve_and_gradient(cp, mom)
+        mid_mom = solve(lambda m: mom - h / 2. * kernel.convolve_gradient(m, cp), mom - h / 2. * d_mom, 'momenta')
+
+        d_cp = kernel.convolve(cp, cp, mid_mom)
+        new_cp = solve(lambda c: cp + h / 2. * (d_cp + kernel.convolve(c, c, mid_mom)), cp + h * d_cp,
+                       'control points')
+
+        return new_cp, mid_mom - h / 2. * kernel.convolve_gradient(mid_mom, new_cp)
+
+    @staticmethod
+    def _hamiltonian_derivative(kernel, cp, mom):
+        d_cp, d_mom = kernel.convolve_and_gradient(cp, mom)
+        return d_cp, - d_mom
+
+    @staticmethod
+    def _runge_kutta_step(derivative, state, h, tableau):
+        """
+        Explicit Runge-Kutta step of length h of the ode state' = derivative(*state), states being tuples of tensors.
+        Returns the new state, and the local error estimate for embedded methods.
+        """
+        a, b, b_low = tableau
+
+        def combine(weights, derivatives):
+            return tuple(s + h * sum(w * d[m] for w, d in zip(weights, derivatives) if w != 0)
+                         for m, s in enumerate(state))
+
+        derivatives = []
+        for a_i in a:
+            derivatives.append(derivative(*(combine(a_i, derivatives) if len(a_i) > 0 else state)))
+
+        new_state = combine(b, derivatives)
+        if b_low is None:
+            return new_state, None
+        return new_state, tuple(n - l for n, l in zip(new_state, combine(b_low, derivatives)))
+
+    @staticmethod
+    def _adaptive_step(derivative, state, h, tolerance):
+        """
+        Integrates the ode state' = derivative(*state) over a time interval of length h, by Dormand-Prince steps whose
+        sizes are adapted so that the estimated local errors stay below tolerance * (1 + |state|). Every call starts
+        with a single step of length h, so that the result only depends on the state.
+        """
+        t, step_size = 0., h
+        while True:
+            is_last_step = step_size >= h - t
+            step_size = min(step_size, h - t)
+            new_state, errors = Exponential._runge_kutta_step(derivative, state, step_size,
+                                                              runge_kutta_tableaus['dopri5'])
+            error_ratio = max(torch.max(torch.abs(e.detach()) / (tolerance * (1. + torch.max(
+                torch.abs(s.detach()), torch.abs(n.detach()))))).item() for e, s, n in zip(errors, state, new_state))
+
+            if not math.isfinite(error_ratio):
+                raise RuntimeError('Non-finite error estimate in the adaptive integration.')
+
+            if error_ratio <= 1.:
+                t, state = t + step_size, new_state
+                if is_last_step:
+                    return state
+            step_size *= min(5., max(0.2, 0.9 * error_ratio ** -0.2)) if error_ratio > 0. else 5.
+
     # TODO. Wrap pytorch of an efficient C code ? Use keops ? Called ApplyH in PyCa. Check Numba as well.
     # @jit(parallel=True)
     @staticmethod
@@ -569,24 +1104,29 @@ class Exponential:
 
     def write_flow(self, objects_names, objects_extensions, template, template_data, output_dir,
                    write_adjoint_parameters=False):
+        """
+        Writes the deformed template objects at each time point. Those of an exponential that was modified and not
+        updated are streamed (see stream), and written one time point at a time.
+        """
+        if self.shoot_is_modified or self.flow_is_modified:
+            states = self.stream()
+        else:
+            states = zip(self.control_points_t, self.momenta_t,
+                         (self.get_template_points(j) for j in range(self.number_of_time_points)))
 
-        assert not self.flow_is_modified, \
-            "You are trying to write data relative to the flow, but it has been modified and not updated."
-
-        for j in range(self.number_of_time_points):
+        for j, (control_points, momenta, deformed_points) in enumerate(states):
             # names = [objects_names[i]+"_t="+str(i)+objects_extensions[j] for j in range(len(objects_name))]
             names = []
             for k, elt in enumerate(objects_names):
                 names.append(elt + "__tp_" + str(j) + objects_extensions[k])
 
-            deformed_points = self.get_template_points(j)
             deformed_data = template.get_deformed_data(deformed_points, template_data)
             template.write(output_dir, names,
                            {key: value.detach().cpu().numpy() for key, value in deformed_data.items()})
 
             if write_adjoint_parameters:
-                cp = self.control_points_t[j].detach().cpu().numpy()
-                mom = self.momenta_t[j].detach().cpu().numpy()
+                cp = control_points.detach().cpu().numpy()
+                mom = momenta.detach().cpu().numpy()
                 write_2D_array(cp, output_dir, elt + "__ControlPoints__tp_" + str(j) + ".txt")
                 write_3D_array(mom, output_dir, elt + "__Momenta__tp_" + str(j) + ".txt")
 
@@ -602,3 +1142,204 @@ class Exponential:
         for j, (control_points, momenta) in enumerate(zip(self.control_points_t, self.momenta_t)):
             write_2D_array(control_points.detach().cpu().numpy(), name + "__control_points_" + str(j) + ".txt")
             write_2D_array(momenta.detach().cpu().numpy(), name + "__momenta_" + str(j) + ".txt")
+
+
+class AdjointIntegration(torch.autograd.Function):
+    """
+    Integrates state_{i+1} = step(i, *state_i, *inputs_i) without autograd graph, and returns the flattened states 1 to
+    number_of_steps. Only the initial and final states and the step inputs are saved for backward: the adjoint state is
+    integrated backward in time, each previous state being reconstructed from the next one, and the adjoint being
+    propagated through the step by a vector-Jacobian product at the reconstructed state.
+    The previous states are solved from step(i, *state_i, *inputs_i) = state_{i+1} by fixed-point iterations, until the
+    residual falls below reconstruction_tolerance relatively to state_{i+1} (and to the precision of the dtype). When
+    the iterations do not converge within max_reconstruction_iterations, as for large displacements per time step, the
+    state is re-anchored: it is recomputed by the forward steps from the saved initial state. Gradients then differ
+    from the autograd ones by the reconstruction tolerance only.
+    """
+
+    reconstruction_tolerance = 1e-10
+    max_reconstruction_iterations = 20
+
+    @staticmethod
+    def forward(ctx, step, number_of_steps, state_size, input_sizes, *args):
+        ctx.step, ctx.state_size, ctx.input_sizes = step, state_size, input_sizes
+        state, step_inputs = args[:state_size], AdjointIntegration._split_inputs(args[state_size:], input_sizes)
+
+        res = []
+        with torch.no_grad():
+            for i in range(number_of_steps):
+                state = step(i, *state, *step_inputs[i])
+                res.extend(state)
+
+        ctx.save_for_backward(*args[:state_size], *state, *args[state_size:])
+        return tuple(res)
+
+    @staticmethod
+    @torch.autograd.function.once_differentiable
+    def backward(ctx, *grad_outputs):
+        step, state_size, input_sizes = ctx.step, ctx.state_size, ctx.input_sizes
+        number_of_steps = len(input_sizes)
+        saved_tensors = ctx.saved_tensors
+        initial_state, state = saved_tensors[:state_size], saved_tensors[state_size:2 * state_size]
+        step_inputs = AdjointIntegration._split_inputs(saved_tensors[2 * state_size:], input_sizes)
+
+        def get_grad_output(i):
+            return [torch.zeros_like(t) if g is None else g
+                    for t, g in zip(state, grad_outputs[(i - 1) * state_size:i * state_size])]
+
+        adjoint = get_grad_output(number_of_steps)
+        grad_inputs, number_of_anchorings = [], 0
+        for i in reversed(range(number_of_steps)):
+            with torch.no_grad():
+                if i == 0:
+                    previous_state = initial_state
+                else:
+                    previous_state = AdjointIntegration._reconstruct(step, i, state, step_inputs[i])
+                    if previous_state is None:
+                        number_of_anchorings += 1
+                        previous_state = initial_state
+                        for k in range(i):
+                            previous_state = step(k, *previous_state, *step_inputs[k])
+
+            with torch.enable_grad():
+                variables = [t.detach().requires_grad_(True) for t in tuple(previous_state) + step_inputs[i]]
+                grads = torch.autograd.grad(step(i, *variables), variables, adjoint, allow_unused=True)
+            grads = [torch.zeros_like(v) if g is None else g for v, g in zip(variables, grads)]
+
+            grad_inputs = grads[state_size:] + grad_inputs
+            adjoint = grads[:state_size]
+            if i > 0:
+                adjoint = [a + g for a, g in zip(adjoint, get_grad_output(i))]
+            state = tuple(t.detach() for t in previous_state)
+
+        if number_of_anchorings > 0:
+            logger.debug('Adjoint integration: %d of the %d previous states were re-anchored to the initial state.'
+                         % (number_of_anchorings, number_of_steps - 1))
+        return (None, None, None, None) + tuple(adjoint) + tuple(grad_inputs)
+
+    @staticmethod
+    def _reconstruct(step, i, state, inputs):
+        """
+        Solves step(i, *previous_state, *inputs) = state by fixed-point iterations, from previous_state = state. Returns
+        None when the iterations do not converge.
+        """
+        tolerance = max(AdjointIntegration.reconstruction_tolerance,
+                        100. * max(torch.finfo(t.dtype).eps for t in state))
+        previous_state = state
+        for _ in range(AdjointIntegration.max_reconstruction_iterations):
+            residuals = [s - f for s, f in zip(state, step(i, *previous_state, *inputs))]
+            if all(torch.max(torch.abs(r)) <= tolerance * (1. + torch.max(torch.abs(s)))
+                   for r, s in zip(residuals, state)):
+                return previous_state
+            previous_state = tuple(p + r for p, r in zip(previous_state, residuals))
+        return None
+
+    @staticmethod
+    def _split_inputs(flat_inputs, input_sizes):
+        step_inputs, offset = [], 0
+        for size in input_sizes:
+            step_inputs.append(tuple(flat_inputs[offset:offset + size]))
+            offset += size
+        return step_inputs
+
+
+class PararealIntegration(torch.autograd.Function):
+    """
+    Differentiable parareal integration (see Exponential._integrate_parareal): returns the flattened states 1 to
+    number_of_steps of the trajectory integrated by integrate(*initial_state), without autograd graph. Only the
+    converged starting states of the slices are saved for backward: the adjoint state is propagated backward in time,
+    slice by slice, through the fine steps of each slice recomputed from its starting state, and passed from the start
+    of each slice to the end of the previous one. The gradients are those of the serial trajectory, up to the parareal
+    tolerance, and the memory is that of a single slice, as in checkpoint gradient mode.
+    """
+
+    @staticmethod
+    def forward(ctx, integrate, fine_step, bounds, state_size, *initial_state):
+        trajectory, starting_states = integrate(*initial_state)
+        ctx.fine_step, ctx.bounds, ctx.state_size = fine_step, bounds, state_size
+        ctx.save_for_backward(*[t for state in starting_states for t in state])
+        return tuple(t for state in trajectory for t in state)
+
+    @staticmethod
+    @torch.autograd.function.once_differentiable
+    def backward(ctx, *grad_outputs):
+        fine_step, bounds, state_size = ctx.fine_step, ctx.bounds, ctx.state_size
+        saved_tensors = ctx.saved_tensors
+        starting_states = [saved_tensors[k * state_size:(k + 1) * state_size] for k in range(len(bounds) - 1)]
+
+        def get_grad_output(i):
+            return [torch.zeros_like(t) if g is None else g
+                    for t, g in zip(starting_states[0], grad_outputs[(i - 1) * state_size:i * state_size])]
+
+        adjoint = [torch.zeros_like(t) for t in starting_states[0]]
+        for k in reversed(range(len(bounds) - 1)):
+            with torch.enable_grad():
+                variables = [t.detach().requires_grad_(True) for t in starting_states[k]]
+                states, outputs, output_grads = variables, [], []
+                for i in range(bounds[k], bounds[k + 1]):
+                    states = fine_step(i, *states)
+                    outputs.extend(states)
+                    output_grads.extend(get_grad_output(i + 1))
+                output_grads[-state_size:] = [g + a for g, a in zip(output_grads[-state_size:], adjoint)]
+                grads = torch.autograd.grad(outputs, variables, output_grads, allow_unused=True)
+            adjoint = [torch.zeros_like(v) if g is None else g for v, g in zip(variables, grads)]
+
+        return (None, None, None, None) + tuple(adjoint)
+
+
+class ConjugateGradientSolve(torch.autograd.Function):
+    """
+    Solves K(x) p = v, K(x) being the kernel matrix of the points x, with conjugate gradient iterations on the kernel
+    convolution, so that the kernel matrix is never formed. The columns of v, or of a (B, N, D) batch v, are solved
+    simultaneously. The backward pass solves the adjoint system K(x) w = grad_p instead of differentiating through the
+    iterations.
+    """
+
+    @staticmethod
+    def forward(ctx, kernel, tolerance, x, v, initial_guess):
+        with torch.no_grad():
+            p = ConjugateGradientSolve._solve(kernel, tolerance, x, v, initial_guess)
+        ctx.kernel, ctx.tolerance = kernel, tolerance
+        ctx.save_for_backward(x, p)
+        return p
+
+    @staticmethod
+    @torch.autograd.function.once_differentiable
+    def backward(ctx, grad_p):
+        x, p = ctx.saved_tensors
+        with torch.no_grad():
+            w = ConjugateGradientSolve._solve(ctx.kernel, ctx.tolerance, x, grad_p, torch.zeros_like(grad_p))
+
+        # d(p) = - K^-1 d(K) p, hence the gradient of <grad_p, p> with respect to x is the one of - <w, K(x) p>.
+        grad_x = None
+        if ctx.needs_input_grad[2]:
+            with torch.enable_grad():
+                x_ = x.detach().requires_grad_(True)
+                grad_x = torch.autograd.grad(ctx.kernel.convolve(x_, x_, p), x_, -w)[0]
+
+        return None, None, grad_x, w, None
+
+    @staticmethod
+    def _solve(kernel, tolerance, x, v, p):
+        residual = v - kernel.convolve(x, x, p)
+        direction = residual
+        residual_norm_squared = torch.sum(residual ** 2, -2, keepdim=True)
+        target_norm_squared = tolerance ** 2 * torch.sum(v ** 2, -2, keepdim=True)
+
+        for _ in range(x.size(0)):
+            if bool(torch.all(residual_norm_squared <= target_norm_squared)):
+                return p
+            kernel_direction = kernel.convolve(x, x, direction)
+            curvature = torch.sum(direction * kernel_direction, -2, keepdim=True)
+            alpha = torch.where(curvature > 0, residual_norm_squared / curvature, torch.zeros_like(curvature))
+            p = p + alpha * direction
+            residual = residual - alpha * kernel_direction
+            new_residual_norm_squared = torch.sum(residual ** 2, -2, keepdim=True)
+            beta = torch.where(residual_norm_squared > 0, new_residual_norm_squared / residual_norm_squared,
+                               torch.zeros_like(residual_norm_squared))
+            direction = residual + beta * direction
+            residual_norm_squared = new_residual_norm_squared
+
+        logger.warning('The conjugate gradient solve of the kernel system did not converge: relative residual %.1E.'
+                       % torch.sqrt(torch.max(residual_norm_squared / target_norm_squared) * tolerance ** 2).item())
+        return p
@@ -1,9 +1,11 @@
 import time
 import warnings
+from functools import partial
 
+import torch
 
 from ....core import default
-from ....core.model_tools.deformations.exponential import Exponential
+from ....core.model_tools.deformations.exponential import Exponential, run_concurrently
 from ....in_out.array_readers_and_writers import *
 from ....support import utilities
 
@@ -11,6 +13,49 @@ import logging
 logger = logging.getLogger(__name__)
 
 
+def _run_concurrently(functions):
+    """
+    Returns the results of the given functions, run on concurrent threads when Geodesic.concurrent_exponentials is set
+    (see run_concurrently).
+    """
+    if not Geodesic.concurrent_exponentials:
+        return [function() for function in functions]
+    return run_concurrently(functions)
+
+
+def get_interpolation_indices_and_weights(times_t, times):
+    """
+    Linear interpolation of a trajectory, defined at the sorted (T,) float64 times_t, at the (B,) times: returns the
+    indices of the right bounds of the intervals of the times, found by a binary search, and the left and right
+    weights, differentiable with respect to the times.
+    """
+    times = times.to(times_t.device)
+
+    # Index of the first time point after each time, clamped to the last interval.
+    if hasattr(torch, 'searchsorted'):
+        indices = torch.searchsorted(times_t, times.detach().to(torch.float64), right=True)
+    else:
+        # torch.searchsorted appeared in torch 1.6.
+        indices = torch.sum(times_t.unsqueeze(0) <= times.detach().to(torch.float64).unsqueeze(1), 1)
+    indices = torch.clamp(indices, 1, len(times_t) - 1)
+
+    times_left, times_right = times_t[indices - 1], times_t[indices]
+    lengths = (times_right - times_left).to(times.dtype)
+    weights_left = (times_right.to(times.dtype) - times) / lengths
+    weights_right = (times - times_left.to(times.dtype)) / lengths
+    return indices, weights_left, weights_right
+
+
+def gather_time_points(trajectory, indices):
+    """
+    Returns the time points of the given (B,) indices in a trajectory, either stacked as a (T, ...) tensor, or stored
+    as a list of T tensors: only the indexed time points of the latter are stacked, on the device of the indices.
+    """
+    if isinstance(trajectory, list):
+        return torch.stack([utilities.move_data(trajectory[i], device=indices.device) for i in indices.tolist()])
+    return trajectory[indices]
+
+
 def _parallel_transport(*args):
 
     # read args
@@ -31,6 +76,11 @@ class Geodesic:
 
     """
 
+    # Whether the backward and forward exponentials are integrated, and parallel transported along, concurrently (see
+    # _run_concurrently). Opt-in: the threads set the process-wide number of intra-op threads of torch, and share the
+    # caches of the kernels (sparse neighbor lists, fourier ranks, auto kernel winners), that are not locked.
+    concurrent_exponentials = False
+
     ####################################################################################################################
     ### Constructor:
     ####################################################################################################################
@@ -38,7 +88,11 @@ class Geodesic:
     def __init__(self, dense_mode=default.dense_mode,
                  kernel=default.deformation_kernel, shoot_kernel_type=None,
                  t0=default.t0, concentration_of_time_points=default.concentration_of_time_points,
-                 use_rk2_for_shoot=default.use_rk2_for_shoot, use_rk2_for_flow=default.use_rk2_for_flow):
+                 use_rk2_for_shoot=default.use_rk2_for_shoot, use_rk2_for_flow=default.use_rk2_for_flow,
+                 shoot_integrator=default.shoot_integrator, flow_integrator=default.flow_integrator,
+                 integrator_tolerance=default.integrator_tolerance,
+                 parareal_number_of_slices=default.parareal_number_of_slices, image_flow=default.image_flow,
+                 gradient_mode=default.gradient_mode, checkpoint_interval=default.checkpoint_interval):
 
         self.concentration_of_time_points = concentration_of_time_points
         self.t0 = t0
@@ -52,12 +106,20 @@ class Geodesic:
         self.backward_exponential = Exponential(
             dense_mode=dense_mode,
             kernel=kernel, shoot_kernel_type=shoot_kernel_type,
-            use_rk2_for_shoot=use_rk2_for_shoot, use_rk2_for_flow=use_rk2_for_flow)
+            use_rk2_for_shoot=use_rk2_for_shoot, use_rk2_for_flow=use_rk2_for_flow,
+            shoot_integrator=shoot_integrator, flow_integrator=flow_integrator,
+            integrator_tolerance=integrator_tolerance,
+            parareal_number_of_slices=parareal_number_of_slices, image_flow=image_flow,
+            gradient_mode=gradient_mode, checkpoint_interval=checkpoint_interval)
 
         self.forward_exponential = Exponential(
             dense_mode=dense_mode,
             kernel=kernel, shoot_kernel_type=shoot_kernel_type,
-            use_rk2_for_shoot=use_rk2_for_shoot, use_rk2_for_flow=use_rk2_for_flow)
+            use_rk2_for_shoot=use_rk2_for_shoot, use_rk2_for_flow=use_rk2_for_flow,
+            shoot_integrator=shoot_integrator, flow_integrator=flow_integrator,
+            integrator_tolerance=integrator_tolerance,
+            parareal_number_of_slices=parareal_number_of_slices, image_flow=image_flow,
+            gradient_mode=gradient_mode, checkpoint_interval=checkpoint_interval)
 
         # Flags to save extra computations that have already been made in the update methods.
         self.shoot_is_modified = True
@@ -65,6 +127,11 @@ class Geodesic:
         self.backward_extension = 0
         self.forward_extension = 0
 
+        # Trajectory store, built by the update method: (T,) tensor of the times, in float64, and dictionary of the
+        # (T, ...) stacked template points trajectories, on the device of the kernel.
+        self.times_t = None
+        self.template_points_store = None
+
         # mp.set_sharing_strategy('file_system')
         # self.parallel_transport_pool = mp.Pool(processes=1)
 
@@ -163,40 +230,40 @@ class Geodesic:
             msg = "Asking for deformed template data but the geodesic was modified and not updated"
             warnings.warn(msg)
 
-        times = self.get_times()
-
         # Deal with the special case of a geodesic reduced to a single point.
-        if len(times) == 1:
+        if len(self.times_t) == 1:
             logger.info('>> The geodesic seems to be reduced to a single point.')
             return self.template_points_t0
 
-        # Standard case.
-        for j in range(1, len(times)):
-            if time - times[j] < 0: break
+        return {key: value[0] for key, value in self.get_template_points_batch([time]).items()}
 
-        # j = np.searchsorted(times[:-1], time, side='right')
-
-        # if time <= self.t0:
-        #     dt = (self.t0 - self.tmin) / (self.backward_exponential.number_of_time_points - 1)
-        #     j = int((time-self.tmin)/dt) + 1
-        #
-        # else:
-        #     dt = (self.tmax - self.t0) / (self.forward_exponential.number_of_time_points - 1)
-        #     j = min(len(times)-1,
-        #             int((time - self.t0) / dt) + self.backward_exponential.number_of_time_points)
-        #
-        # assert times[j-1] <= time
-        # assert times[j] >= time
-
-        device, _ = utilities.get_best_device(self.backward_exponential.kernel.gpu_mode)
-
-        weight_left = utilities.move_data([(times[j] - time) / (times[j] - times[j - 1])], device=device, dtype=self.momenta_t0.dtype)
-        weight_right = utilities.move_data([(time - times[j - 1]) / (times[j] - times[j - 1])], device=device, dtype=self.momenta_t0.dtype)
-        template_t = {key: [utilities.move_data(v, device=device) for v in value] for key, value in self.get_template_points_trajectory().items()}
+    def get_template_points_batch(self, times):
+        """
+        Returns the positions of the landmark points at the B given times, as a dictionary of (B, ...) tensors. The
+        intervals of the times are found by a binary search in the trajectory store, and all the interpolations are
+        performed by a single gather (see _update_trajectory_store).
+        """
+        if self.shoot_is_modified or self.flow_is_modified:
+            msg = "Asking for deformed template data but the geodesic was modified and not updated"
+            warnings.warn(msg)
 
-        deformed_points = {key: weight_left * value[j - 1] + weight_right * value[j]
-                           for key, value in template_t.items()}
+        times = [float(elt) for elt in times]
+        assert all(self.tmin <= elt <= self.tmax for elt in times)
+        times = torch.tensor(times, dtype=torch.float64, device=self.times_t.device)
 
+        # Deal with the special case of a geodesic reduced to a single point.
+        if len(self.times_t) == 1:
+            indices = torch.zeros(len(times), dtype=torch.long, device=self.times_t.device)
+            return {key: gather_time_points(value, indices) for key, value in self.template_points_store.items()}
+
+        indices, weights_left, weights_right = get_interpolation_indices_and_weights(self.times_t, times)
+
+        deformed_points = {}
+        for key, value in self.template_points_store.items():
+            points_left, points_right = gather_time_points(value, indices - 1), gather_time_points(value, indices)
+            shape = (-1,) + (1,) * (points_left.dim() - 1)
+            deformed_points[key] = weights_left.to(points_left.dtype).view(shape) * points_left \
+                                   + weights_right.to(points_right.dtype).view(shape) * points_right
         return deformed_points
 
     ####################################################################################################################
@@ -213,48 +280,58 @@ class Geodesic:
         assert self.t0 <= self.tmax, "tmax should be larger than t0"
 
         if self.shoot_is_modified or self.flow_is_modified:
-
-            device, _ = utilities.get_best_device(self.backward_exponential.kernel.gpu_mode)
-
-            # Backward exponential -------------------------------------------------------------------------------------
-            length = self.t0 - self.tmin
-            self.backward_exponential.number_of_time_points = \
-                max(1, int(length * self.concentration_of_time_points + 1.5))
-            if self.shoot_is_modified:
-                self.backward_exponential.set_initial_momenta(- self.momenta_t0 * length)
-                self.backward_exponential.set_initial_control_points(self.control_points_t0)
-            if self.flow_is_modified:
-                self.backward_exponential.set_initial_template_points(self.template_points_t0)
-            if self.backward_exponential.number_of_time_points > 1:
-                self.backward_exponential.move_data_to_(device=device)
-                self.backward_exponential.update()
-
-            # Forward exponential --------------------------------------------------------------------------------------
-            length = self.tmax - self.t0
-            self.forward_exponential.number_of_time_points = \
-                max(1, int(length * self.concentration_of_time_points + 1.5))
-            if self.shoot_is_modified:
-                self.forward_exponential.set_initial_momenta(self.momenta_t0 * length)
-                self.forward_exponential.set_initial_control_points(self.control_points_t0)
-            if self.flow_is_modified:
-                self.forward_exponential.set_initial_template_points(self.template_points_t0)
-            if self.forward_exponential.number_of_time_points > 1:
-                self.forward_exponential.move_data_to_(device=device)
-                self.forward_exponential.update()
+            self._set_exponentials()
+            _run_concurrently([exponential.update for exponential in [self.backward_exponential,
+                                                                      self.forward_exponential]
+                               if exponential.number_of_time_points > 1])
 
             self.shoot_is_modified = False
             self.flow_is_modified = False
             self.backward_extension = 0
             self.forward_extension = 0
+            self._update_trajectory_store()
+
+        elif self.backward_extension > 0 or self.forward_extension > 0:
+            _run_concurrently([partial(exponential.extend, extension)
+                               for exponential, extension in [(self.backward_exponential, self.backward_extension),
+                                                              (self.forward_exponential, self.forward_extension)]
+                               if extension > 0])
+            self.backward_extension = 0
+            self.forward_extension = 0
+            self._update_trajectory_store()
+
+    def stream(self):
+        """
+        Generator of the (t, time, control_points, momenta, template_points) states of the geodesic, t indexing the time
+        points of get_times. The states are streamed from the exponentials (see Exponential.stream), without computing
+        nor storing their trajectories: those of the backward exponential come first, from t0 down to tmin.
+        """
+        assert self.t0 >= self.tmin, "tmin should be smaller than t0"
+        assert self.t0 <= self.tmax, "tmax should be larger than t0"
 
+        if self.shoot_is_modified or self.flow_is_modified:
+            self._set_exponentials()
+        times = self.get_times()
+        number_of_backward_time_points = self.backward_exponential.number_of_time_points
+
+        # Backward exponential -----------------------------------------------------------------------------------------
+        if number_of_backward_time_points > 1:
+            length = self.tmin - self.t0
+            for j, (control_points, momenta, template_points) in enumerate(self.backward_exponential.stream()):
+                t = number_of_backward_time_points - 1 - j
+                yield t, times[t], control_points, momenta / length, template_points
         else:
-            if self.backward_extension > 0:
-                self.backward_exponential.extend(self.backward_extension)
-                self.backward_extension = 0
+            yield 0, times[0], self.control_points_t0.detach(), self.momenta_t0.detach(), \
+                  {key: value.detach() for key, value in self.template_points_t0.items()}
 
-            if self.forward_extension > 0:
-                self.forward_exponential.extend(self.forward_extension)
-                self.forward_extension = 0
+        # Forward exponential ------------------------------------------------------------------------------------------
+        if self.forward_exponential.number_of_time_points > 1:
+            length = self.tmax - self.t0
+            states = self.forward_exponential.stream()
+            next(states)
+            for j, (control_points, momenta, template_points) in enumerate(states):
+                t = number_of_backward_time_points + j
+                yield t, times[t], control_points, momenta / length, template_points
 
     def get_norm_squared(self):
         """
@@ -264,7 +341,8 @@ class Geodesic:
 
     def parallel_transport(self, momenta_to_transport_t0, is_orthogonal=False):
         """
-        :param momenta_to_transport_t0: the vector to parallel transport, given at t0 and carried at control_points_t0
+        :param momenta_to_transport_t0: the vector to parallel transport, given at t0 and carried at control_points_t0,
+        or a (S, N, D) batch of such vectors, transported simultaneously.
         :returns: the full trajectory of the parallel transport, from tmin to tmax.
         """
         start = time.perf_counter()
@@ -273,19 +351,19 @@ class Geodesic:
             msg = "Trying to parallel transport but the geodesic object was modified, please update before."
             warnings.warn(msg)
 
-        # backwards
-        if self.backward_exponential.number_of_time_points > 1:
-            backward_transport = self.backward_exponential.parallel_transport(momenta_to_transport_t0,
-                                                                              is_orthogonal=is_orthogonal)
-        else:
-            backward_transport = [momenta_to_transport_t0]
-
-        # forwards
-        if self.forward_exponential.number_of_time_points > 1:
-            forward_transport = self.forward_exponential.parallel_transport(momenta_to_transport_t0,
-                                                                            is_orthogonal=is_orthogonal)
-        else:
-            forward_transport = []
+        # backwards and forwards, concurrently.
+        backward_transport = [momenta_to_transport_t0]
+        forward_transport = []
+        results = _run_concurrently([partial(_parallel_transport, compute_backward, exponential,
+                                             momenta_to_transport_t0, is_orthogonal)
+                                     for compute_backward, exponential in [(True, self.backward_exponential),
+                                                                           (False, self.forward_exponential)]
+                                     if exponential.number_of_time_points > 1])
+        for compute_backward, transport in results:
+            if compute_backward:
+                backward_transport = transport
+            else:
+                forward_transport = transport
 
         logger.debug('time taken to compute parallel_transport: ' + str(time.perf_counter() - start))
         assert backward_transport is not None
@@ -298,7 +376,10 @@ class Geodesic:
 
     def extend_parallel_transport(self, parallel_transport_t, backward_extension, forward_extension,
                                   is_orthogonal=False):
-
+        """
+        Extends the parallel_transport_t trajectory, of vectors or of (S, N, D) batches of vectors, to the time points
+        added by the last backward and forward extensions of the geodesic.
+        """
         parallel_transport_t_backward_extension = [parallel_transport_t[0]]
         if backward_extension > 0:
             parallel_transport_t_backward_extension = self.backward_exponential.parallel_transport(
@@ -317,6 +398,43 @@ class Geodesic:
                                + parallel_transport_t + parallel_transport_t_forward_extension[1:]
         return parallel_transport_t
 
+    def _set_exponentials(self):
+        """
+        Sets the number of time points and the initial control points, momenta and template points of the backward and
+        forward exponentials, according to the time bounds.
+        """
+        device, _ = utilities.get_best_device(self.backward_exponential.kernel.gpu_mode)
+
+        for exponential, length in [(self.backward_exponential, self.t0 - self.tmin),
+                                    (self.forward_exponential, self.tmax - self.t0)]:
+            exponential.number_of_time_points = max(1, int(length * self.concentration_of_time_points + 1.5))
+            if self.shoot_is_modified:
+                exponential.set_initial_momenta(
+                    (- self.momenta_t0 if exponential is self.backward_exponential else self.momenta_t0) * length)
+                exponential.set_initial_control_points(self.control_points_t0)
+            if self.flow_is_modified:
+                exponential.set_initial_template_points(self.template_points_t0)
+            if exponential.number_of_time_points > 1:
+                exponential.move_data_to_(device=device)
+
+    def _update_trajectory_store(self):
+        """
+        Stores the times and the template points trajectories, on the device of the kernel. The landmark points
+        trajectories are stacked, to be interpolated by single gathers. The image points trajectories are kept as the
+        lists of the exponentials: stacking them would copy every image of the trajectory on each update, whereas
+        only the interpolated time points are needed (see gather_time_points).
+        """
+        device, _ = utilities.get_best_device(self.backward_exponential.kernel.gpu_mode)
+        self.times_t = torch.tensor(self.get_times(), dtype=torch.float64, device=device)
+        self.template_points_store = {}
+        if self.template_points_t0 is not None:
+            for key, value in self.get_template_points_trajectory().items():
+                if key == 'image_points':
+                    self.template_points_store[key] = value
+                else:
+                    self.template_points_store[key] = torch.stack(
+                        [utilities.move_data(elt, device=device) for elt in value])
+
     def get_times(self):
         times_backward = [self.t0]
         if self.backward_exponential.number_of_time_points > 1:
@@ -391,25 +509,29 @@ class Geodesic:
     def write(self, root_name, objects_name, objects_extension, template, template_data, output_dir,
               write_adjoint_parameters=False):
 
+        # A geodesic that was modified and not updated is streamed, and written one time point at a time.
+        if self.shoot_is_modified or self.flow_is_modified:
+            states = self.stream()
+        else:
+            times = self.get_times()
+            states = zip(range(len(times)), times, self.get_control_points_trajectory(),
+                         self.get_momenta_trajectory(), (self.get_template_points(time) for time in times))
+
         # Core loop ----------------------------------------------------------------------------------------------------
-        times = self.get_times()
-        for t, time in enumerate(times):
+        for t, time, control_points, momenta, deformed_points in states:
             names = []
             for k, (object_name, object_extension) in enumerate(zip(objects_name, objects_extension)):
                 name = root_name + '__GeodesicFlow__' + object_name + '__tp_' + str(t) \
                        + ('__age_%.2f' % time) + object_extension
                 names.append(name)
-            deformed_points = self.get_template_points(time)
             deformed_data = template.get_deformed_data(deformed_points, template_data)
             template.write(output_dir, names,
                            {key: value.detach().cpu().numpy() for key, value in deformed_data.items()})
 
-        # Optional writing of the control points and momenta -----------------------------------------------------------
-        if write_adjoint_parameters:
-            control_points_t = [elt.detach().cpu().numpy() for elt in self.get_control_points_trajectory()]
-            momenta_t = [elt.detach().cpu().numpy() for elt in self.get_momenta_trajectory()]
-            for t, (time, control_points, momenta) in enumerate(zip(times, control_points_t, momenta_t)):
-                write_2D_array(control_points, output_dir, root_name + '__GeodesicFlow__ControlPoints__tp_' + str(t)
-                               + ('__age_%.2f' % time) + '.txt')
-                write_2D_array(momenta, output_dir, root_name + '__GeodesicFlow__Momenta__tp_' + str(t)
+            # Optional writing of the control points and momenta -------------------------------------------------------
+            if write_adjoint_parameters:
+                write_2D_array(control_points.detach().cpu().numpy(), output_dir,
+                               root_name + '__GeodesicFlow__ControlPoints__tp_' + str(t)
                                + ('__age_%.2f' % time) + '.txt')
+                write_2D_array(momenta.detach().cpu().numpy(), output_dir,
+                               root_name + '__GeodesicFlow__Momenta__tp_' + str(t) + ('__age_%.2f' % time) + '.txt')
@@ -1,9 +1,12 @@
 import torch
 
 from ....core import default
+from ....core.model_tools.deformations.batched_exponential import BatchedExponential
 from ....core.model_tools.deformations.exponential import Exponential
-from ....core.model_tools.deformations.geodesic import Geodesic
+from ....core.model_tools.deformations.geodesic import Geodesic, gather_time_points, \
+    get_interpolation_indices_and_weights
 from ....in_out.array_readers_and_writers import *
+from ....support import utilities
 
 
 class SpatiotemporalReferenceFrame:
@@ -22,18 +25,40 @@ class SpatiotemporalReferenceFrame:
                  kernel=default.deformation_kernel, shoot_kernel_type=default.shoot_kernel_type, t0=default.t0,
                  concentration_of_time_points=default.concentration_of_time_points,
                  number_of_time_points=default.number_of_time_points,
-                 use_rk2_for_shoot=default.use_rk2_for_shoot, use_rk2_for_flow=default.use_rk2_for_flow):
+                 use_rk2_for_shoot=default.use_rk2_for_shoot, use_rk2_for_flow=default.use_rk2_for_flow,
+                 shoot_integrator=default.shoot_integrator, flow_integrator=default.flow_integrator,
+                 integrator_tolerance=default.integrator_tolerance,
+                 parareal_number_of_slices=default.parareal_number_of_slices, image_flow=default.image_flow,
+                 gradient_mode=default.gradient_mode, checkpoint_interval=default.checkpoint_interval):
 
         self.exponential = Exponential(
             dense_mode=dense_mode,
             kernel=kernel, shoot_kernel_type=shoot_kernel_type,
             number_of_time_points=number_of_time_points, use_rk2_for_shoot=use_rk2_for_shoot,
-            use_rk2_for_flow=use_rk2_for_flow)
+            use_rk2_for_flow=use_rk2_for_flow, shoot_integrator=shoot_integrator, flow_integrator=flow_integrator,
+            integrator_tolerance=integrator_tolerance,
+            parareal_number_of_slices=parareal_number_of_slices, image_flow=image_flow, gradient_mode=gradient_mode,
+            checkpoint_interval=checkpoint_interval)
 
+        # Shoots and flows the exponentials of several (time, sources) couples at once.
+        self.batched_exponential = BatchedExponential(
+            dense_mode=dense_mode,
+            kernel=kernel, shoot_kernel_type=shoot_kernel_type,
+            number_of_time_points=number_of_time_points, use_rk2_for_shoot=use_rk2_for_shoot,
+            use_rk2_for_flow=use_rk2_for_flow, shoot_integrator=shoot_integrator, flow_integrator=flow_integrator,
+            integrator_tolerance=integrator_tolerance,
+            parareal_number_of_slices=parareal_number_of_slices, gradient_mode=gradient_mode,
+            checkpoint_interval=checkpoint_interval)
+
+        # The parallel transport along the geodesic requires a second order shoot integrator: rk2 by default.
         self.geodesic = Geodesic(
             dense_mode=dense_mode, kernel=kernel, t0=t0,
             concentration_of_time_points=concentration_of_time_points,
-            use_rk2_for_shoot=True, use_rk2_for_flow=use_rk2_for_flow)
+            use_rk2_for_shoot=True, use_rk2_for_flow=use_rk2_for_flow,
+            shoot_integrator=shoot_integrator if shoot_integrator != 'euler' else None, flow_integrator=flow_integrator,
+            integrator_tolerance=integrator_tolerance,
+            parareal_number_of_slices=parareal_number_of_slices, image_flow=image_flow, gradient_mode=gradient_mode,
+            checkpoint_interval=checkpoint_interval)
 
         self.modulation_matrix_t0 = None
         self.projected_modulation_matrix_t0 = None
@@ -48,6 +73,12 @@ class SpatiotemporalReferenceFrame:
         self.template_points_t = None
         self.control_points_t = None
 
+        # Trajectory store, stacked on a single device for the batched interpolations.
+        self.times_t = None
+        self.template_points_store = None
+        self.stacked_control_points_t = None
+        self.stacked_projected_modulation_matrix_t = None
+
     def clone(self):
         raise NotImplementedError  # TODO
         # clone = SpatiotemporalReferenceFrame()
@@ -80,14 +111,17 @@ class SpatiotemporalReferenceFrame:
 
     def set_use_rk2_for_shoot(self, flag):  # Cannot modify the shoot integration of the geodesic, which require rk2.
         self.exponential.set_use_rk2_for_shoot(flag)
+        self.batched_exponential.set_use_rk2_for_shoot(flag)
 
     def set_use_rk2_for_flow(self, flag):
-        self.exponential.set_use_rk2_for_shoot(flag)
+        self.exponential.set_use_rk2_for_flow(flag)
+        self.batched_exponential.set_use_rk2_for_flow(flag)
         self.geodesic.set_use_rk2_for_flow(flag)
 
     def set_kernel(self, kernel):
         self.geodesic.set_kernel(kernel)
         self.exponential.set_kernel(kernel)
+        self.batched_exponential.set_kernel(kernel)
 
     def get_kernel_type(self):
         return self.exponential.kernel.kernel_type
@@ -103,6 +137,7 @@ class SpatiotemporalReferenceFrame:
 
     def set_number_of_time_points(self, ntp):
         self.exponential.number_of_time_points = ntp
+        self.batched_exponential.number_of_time_points = ntp
 
     def set_template_points_t0(self, td):
         self.geodesic.set_template_points_t0(td)
@@ -139,75 +174,93 @@ class SpatiotemporalReferenceFrame:
         self.forward_extension = self.geodesic.forward_extension
 
     def get_template_points_exponential_parameters(self, time, sources):
-
-        # Assert for coherent length of attribute lists.
-        assert len(self.template_points_t[list(self.template_points_t.keys())[0]]) == len(self.control_points_t) == len(
-            self.projected_modulation_matrix_t) == len(self.times)
-
-        # Deal with the special case of a geodesic reduced to a single point.
-        if len(self.times) == 1:
-            logger.info('>> The spatiotemporal reference frame geodesic seems to be reduced to a single point.')
-            initial_template_points = {key: value[0] for key, value in self.template_points_t.items()}
-            initial_control_points = self.control_points_t[0]
-            initial_momenta = torch.mm(self.projected_modulation_matrix_t[0], sources.unsqueeze(1)).view(
-                self.geodesic.momenta_t0.size())
-
-        # Standard case.
-        else:
-            index, weight_left, weight_right = self._get_interpolation_index_and_weights(time)
-            template_points = {key: weight_left * value[index - 1] + weight_right * value[index]
-                               for key, value in self.template_points_t.items()}
-            control_points = weight_left * self.control_points_t[index - 1] + weight_right * self.control_points_t[index]
-            modulation_matrix = weight_left * self.projected_modulation_matrix_t[index - 1] + weight_right * self.projected_modulation_matrix_t[index]
-            space_shift = torch.mm(modulation_matrix, sources.unsqueeze(1)).view(self.geodesic.momenta_t0.size())
-
-            initial_template_points = template_points
-            initial_control_points = control_points
-            initial_momenta = space_shift
-
-        return initial_template_points, initial_control_points, initial_momenta
+        initial_template_points, initial_control_points, initial_momenta = self._get_initial_states_batch(
+            time.view(1), sources.unsqueeze(0))
+        return {key: value[0] for key, value in initial_template_points.items()}, \
+               initial_control_points[0], initial_momenta[0]
 
     def get_template_points(self, time, sources, device=None):
+        """
+        Returns the template points deformed by the exponential of the space shift of the given sources, from the
+        geodesic at the given time. time and sources may also be lists of B times and B sources: the list of the B
+        deformed template points is then returned, computed by get_template_points_batch.
+        """
+        if isinstance(time, list):
+            deformed_points = self.get_template_points_batch(torch.stack(time), torch.stack(sources), device=device)
+            return [{key: value[b] for key, value in deformed_points.items()} for b in range(len(time))]
+
+        initial_template_points, initial_control_points, initial_momenta = \
+            self.get_template_points_exponential_parameters(time, sources)
+        self.exponential.set_initial_template_points(initial_template_points)
+        self.exponential.set_initial_control_points(initial_control_points)
+        self.exponential.set_initial_momenta(initial_momenta)
+        if device is not None:
+            self.exponential.move_data_to_(device)
+        self.exponential.update()
+        return self.exponential.get_template_points()
 
-        # Assert for coherent length of attribute lists.
-        assert len(self.template_points_t[list(self.template_points_t.keys())[0]]) == len(self.control_points_t) \
-               == len(self.projected_modulation_matrix_t) == len(self.times)
+    def get_template_points_batch(self, times, sources, device=None):
+        """
+        Returns the template points deformed by the exponentials of the space shifts of the B given sources, from the
+        geodesic at the B given absolute times, as a dictionary of (B, ...) tensors. times is a (B,) tensor and sources
+        a (B, number_of_sources) tensor. The trajectories are interpolated at all the times by a binary search and a
+        single gather in the trajectory store, and the B exponentials are shot and flowed at once by the batched
+        exponential.
+        """
+        template_points, control_points, space_shifts = self._get_initial_states_batch(times, sources)
+
+        # The image flow is not batched.
+        if 'image_points' in template_points.keys():
+            deformed_points = []
+            for b in range(len(times)):
+                self.exponential.set_initial_template_points({key: value[b] for key, value in template_points.items()})
+                self.exponential.set_initial_control_points(control_points[b])
+                self.exponential.set_initial_momenta(space_shifts[b])
+                if device is not None:
+                    self.exponential.move_data_to_(device)
+                self.exponential.update()
+                deformed_points.append(self.exponential.get_template_points())
+            return {key: torch.stack([elt[key] for elt in deformed_points]) for key in deformed_points[0].keys()}
+
+        self.batched_exponential.set_initial_states(template_points, control_points, space_shifts)
+        if device is not None:
+            self.batched_exponential.move_data_to_(device)
+        self.batched_exponential.update()
+        return self.batched_exponential.get_template_points()
+
+    def _get_initial_states_batch(self, times, sources):
+        """
+        Interpolates the template points, control points and projected modulation matrices trajectories at the B given
+        times, and returns the B initial template points, control points and space shifts of the given sources.
+        """
+        assert self.times_t is not None, 'The spatiotemporal reference frame should be updated first.'
+        number_of_exponentials = len(times)
 
         # Deal with the special case of a geodesic reduced to a single point.
-        if len(self.times) == 1:
+        if len(self.times_t) == 1:
             logger.info('>> The spatiotemporal reference frame geodesic seems to be reduced to a single point.')
-            self.exponential.set_initial_template_points({key: value[0]
-                                                          for key, value in self.template_points_t.items()})
-            self.exponential.set_initial_control_points(self.control_points_t[0])
-            self.exponential.set_initial_momenta(torch.mm(self.projected_modulation_matrix_t[0],
-                                                          sources.unsqueeze(1)).view(self.geodesic.momenta_t0.size()))
-
-        # Standard case.
-        else:
-            index, weight_left, weight_right = self._get_interpolation_index_and_weights(time)
-            template_points = {key: weight_left * value[index - 1] + weight_right * value[index]
-                               for key, value in self.template_points_t.items()}
-            control_points = weight_left * self.control_points_t[index - 1] + weight_right * self.control_points_t[index]
-            modulation_matrix = weight_left * self.projected_modulation_matrix_t[index - 1] \
-                                + weight_right * self.projected_modulation_matrix_t[index]
-            space_shift = torch.mm(modulation_matrix, sources.unsqueeze(1)).view(self.geodesic.momenta_t0.size())
-
-            self.exponential.set_initial_template_points(template_points)
-            self.exponential.set_initial_control_points(control_points)
-            self.exponential.set_initial_momenta(space_shift)
 
-        if device is not None:
-            self.exponential.move_data_to_(device)
-        self.exponential.update()
-        return self.exponential.get_template_points()
+            def interpolate(trajectory):
+                return gather_time_points(trajectory, torch.zeros(number_of_exponentials, dtype=torch.long,
+                                                                  device=self.times_t.device))
 
-    def _get_interpolation_index_and_weights(self, time):
-        for index in range(1, len(self.times)):
-            if time.data.cpu().numpy() - self.times[index] < 0:
-                break
-        weight_left = (self.times[index] - time) / (self.times[index] - self.times[index - 1])
-        weight_right = (time - self.times[index - 1]) / (self.times[index] - self.times[index - 1])
-        return index, weight_left, weight_right
+        # Standard case: all the times are interpolated at once.
+        else:
+            indices, weights_left, weights_right = get_interpolation_indices_and_weights(self.times_t, times)
+
+            def interpolate(trajectory):
+                points_left, points_right = gather_time_points(trajectory, indices - 1), \
+                                            gather_time_points(trajectory, indices)
+                shape = (-1,) + (1,) * (points_left.dim() - 1)
+                return weights_left.to(points_left.dtype).view(shape) * points_left \
+                       + weights_right.to(points_right.dtype).view(shape) * points_right
+
+        template_points = {key: interpolate(value) for key, value in self.template_points_store.items()}
+        control_points = interpolate(self.stacked_control_points_t)
+        modulation_matrices = interpolate(self.stacked_projected_modulation_matrix_t)
+        space_shifts = torch.bmm(modulation_matrices, sources.to(modulation_matrices).unsqueeze(2)).view(
+            (number_of_exponentials,) + self.geodesic.momenta_t0.size())
+        return template_points, control_points, space_shifts
 
     ####################################################################################################################
     ### Public methods:
@@ -233,19 +286,12 @@ class SpatiotemporalReferenceFrame:
             # Projects the modulation_matrix_t0 attribute columns.
             self._update_projected_modulation_matrix_t0(device=device)
 
-            # Initializes the projected_modulation_matrix_t attribute size.
-            self.projected_modulation_matrix_t = \
-                [torch.zeros(self.projected_modulation_matrix_t0.size(), dtype=self.modulation_matrix_t0.dtype, device=device)
-                 for _ in range(len(self.control_points_t))]
-
-            # Transport each column, ignoring the tangential components.
-            for s in range(self.number_of_sources):
-                space_shift_t0 = self.projected_modulation_matrix_t0[:, s].contiguous().view(self.geodesic.momenta_t0.size())
-                space_shift_t = self.geodesic.parallel_transport(space_shift_t0, is_orthogonal=True)
-
-                # Set the result correctly in the projected_modulation_matrix_t attribute.
-                for t, space_shift in enumerate(space_shift_t):
-                    self.projected_modulation_matrix_t[t][:, s] = space_shift.view(-1)
+            # Transport all the columns at once, ignoring the tangential components.
+            space_shifts_t0 = self.projected_modulation_matrix_t0.t().contiguous().view(
+                (self.number_of_sources,) + self.geodesic.momenta_t0.size())
+            space_shifts_t = self.geodesic.parallel_transport(space_shifts_t0, is_orthogonal=True)
+            self.projected_modulation_matrix_t = [space_shifts.contiguous().view(self.number_of_sources, -1).t()
+                                                  for space_shifts in space_shifts_t]
 
             self.transport_is_modified = False
             self.backward_extension = 0
@@ -253,21 +299,15 @@ class SpatiotemporalReferenceFrame:
 
         elif self.backward_extension > 0 or self.forward_extension > 0:
 
-            # Initializes the extended projected_modulation_matrix_t variable.
-            projected_modulation_matrix_t_extended = [
-                torch.zeros(self.projected_modulation_matrix_t0.size(), dtype=self.modulation_matrix_t0.dtype, device=device)
-                for _ in range(len(self.control_points_t))]
-
-            # Transport each column, ignoring the tangential components.
-            for s in range(self.number_of_sources):
-                space_shift_t = [elt[:, s].contiguous().view(self.geodesic.momenta_t0.size())
-                                 for elt in self.projected_modulation_matrix_t]
-                space_shift_t = self.geodesic.extend_parallel_transport(space_shift_t, self.backward_extension,
-                                                                        self.forward_extension, is_orthogonal=True)
-
-                assert len(space_shift_t) == len(projected_modulation_matrix_t_extended)
-                for t, space_shift in enumerate(space_shift_t):
-                    projected_modulation_matrix_t_extended[t][:, s] = space_shift.view(-1)
+            # Transport all the columns at once, ignoring the tangential components.
+            space_shifts_t = [modulation_matrix.t().contiguous().view(
+                (self.number_of_sources,) + self.geodesic.momenta_t0.size())
+                for modulation_matrix in self.projected_modulation_matrix_t]
+            space_shifts_t = self.geodesic.extend_parallel_transport(space_shifts_t, self.backward_extension,
+                                                                     self.forward_extension, is_orthogonal=True)
+            assert len(space_shifts_t) == len(self.control_points_t)
+            projected_modulation_matrix_t_extended = [space_shifts.contiguous().view(self.number_of_sources, -1).t()
+                                                      for space_shifts in space_shifts_t]
 
             self.projected_modulation_matrix_t = projected_modulation_matrix_t_extended
             self.backward_extension = 0
@@ -280,25 +320,35 @@ class SpatiotemporalReferenceFrame:
             (len(self.template_points_t[list(self.template_points_t.keys())[0]]), len(self.control_points_t),
              len(self.times), len(self.projected_modulation_matrix_t))
 
+        self._update_trajectory_store()
+
     ####################################################################################################################
     ### Auxiliary methods:
     ####################################################################################################################
 
-    def _update_projected_modulation_matrix_t0(self, device='cpu'):
-        self.projected_modulation_matrix_t0 = torch.zeros(self.modulation_matrix_t0.size(),
-                                                          dtype=self.modulation_matrix_t0.dtype,
-                                                          device=device)
+    def _update_trajectory_store(self):
+        """
+        Stacks the control points and projected modulation matrices trajectories, next to the times and template points
+        trajectories stored by the geodesic.
+        """
+        self.times_t = self.geodesic.times_t
+        self.template_points_store = self.geodesic.template_points_store
+        self.stacked_control_points_t = torch.stack(
+            [utilities.move_data(elt, device=self.times_t.device) for elt in self.control_points_t])
+        self.stacked_projected_modulation_matrix_t = torch.stack(
+            [utilities.move_data(elt, device=self.times_t.device) for elt in self.projected_modulation_matrix_t])
 
+    def _update_projected_modulation_matrix_t0(self, device='cpu'):
         norm_squared = self.geodesic.backward_exponential.scalar_product(
             self.geodesic.control_points_t0, self.geodesic.momenta_t0, self.geodesic.momenta_t0)
 
-        for s in range(self.number_of_sources):
-            space_shift_t0 = self.modulation_matrix_t0[:, s].contiguous().view(self.geodesic.momenta_t0.size())
-            sp = self.geodesic.backward_exponential.scalar_product(
-                self.geodesic.control_points_t0, self.geodesic.momenta_t0, space_shift_t0) / norm_squared
+        space_shifts_t0 = self.modulation_matrix_t0.t().contiguous().view(
+            (self.number_of_sources,) + self.geodesic.momenta_t0.size()).to(device)
+        sp = self.geodesic.backward_exponential.scalar_products(
+            self.geodesic.control_points_t0, space_shifts_t0, self.geodesic.momenta_t0) / norm_squared
 
-            projected_space_shift_t0 = space_shift_t0 - sp * self.geodesic.momenta_t0
-            self.projected_modulation_matrix_t0[:, s] = projected_space_shift_t0.view(-1).contiguous()
+        projected_space_shifts_t0 = space_shifts_t0 - sp.view(-1, 1, 1) * self.geodesic.momenta_t0
+        self.projected_modulation_matrix_t0 = projected_space_shifts_t0.view(self.number_of_sources, -1).t()
 
     ####################################################################################################################
     ### Writing methods:
@@ -41,10 +41,15 @@ class BayesianAtlas(AbstractStatisticalModel):
 
                  deformation_kernel_type=default.deformation_kernel_type,
                  deformation_kernel_width=default.deformation_kernel_width,
+                 deformation_kernel_options=default.deformation_kernel_options,
 
                  shoot_kernel_type=default.shoot_kernel_type,
                  number_of_time_points=default.number_of_time_points,
                  use_rk2_for_shoot=default.use_rk2_for_shoot, use_rk2_for_flow=default.use_rk2_for_flow,
+                 shoot_integrator=default.shoot_integrator, flow_integrator=default.flow_integrator,
+                 integrator_tolerance=default.integrator_tolerance,
+                 parareal_number_of_slices=default.parareal_number_of_slices, image_flow=default.image_flow,
+                 gradient_mode=default.gradient_mode, checkpoint_interval=default.checkpoint_interval,
 
                  freeze_template=default.freeze_template,
                  use_sobolev_gradient=default.use_sobolev_gradient,
@@ -84,10 +89,15 @@ class BayesianAtlas(AbstractStatisticalModel):
         # Deformation.
         self.exponential = Exponential(
             dense_mode=dense_mode,
-            kernel=kernel_factory.factory(deformation_kernel_type, gpu_mode=gpu_mode, kernel_width=deformation_kernel_width),
+            kernel=kernel_factory.factory(deformation_kernel_type, gpu_mode=gpu_mode, kernel_width=deformation_kernel_width,
+                                          **(deformation_kernel_options or {})),
             shoot_kernel_type=shoot_kernel_type,
             number_of_time_points=number_of_time_points,
-            use_rk2_for_shoot=use_rk2_for_shoot, use_rk2_for_flow=use_rk2_for_flow)
+            use_rk2_for_shoot=use_rk2_for_shoot, use_rk2_for_flow=use_rk2_for_flow,
+            shoot_integrator=shoot_integrator, flow_integrator=flow_integrator,
+            integrator_tolerance=integrator_tolerance,
+            parareal_number_of_slices=parareal_number_of_slices, image_flow=image_flow,
+            gradient_mode=gradient_mode, checkpoint_interval=checkpoint_interval)
 
         # Template.
         (object_list, self.objects_name, self.objects_name_extension,
@@ -242,6 +252,25 @@ class BayesianAtlas(AbstractStatisticalModel):
     ### Public methods:
     ####################################################################################################################
 
+    def remap_control_points(self, control_points, indices, weights):
+        """
+        Replaces the control points by the given ones. The momenta are individual random effects, remapped by the
+        estimator: their covariance and its prior are reinitialized at the new control points.
+        """
+        self.set_control_points(control_points)
+        covariance_momenta_inverse = initialize_covariance_momenta_inverse(control_points, self.exponential.kernel,
+                                                                           self.dimension)
+        self.priors['covariance_momenta'].scale_matrix = np.linalg.inv(covariance_momenta_inverse)
+        self.individual_random_effects['momenta'].mean = np.zeros((self.number_of_control_points * self.dimension,))
+        self.set_covariance_momenta_inverse(covariance_momenta_inverse)
+
+    def compute_momenta_regularity_gradient(self, momenta):
+        """
+        Gradient of the momenta random effect log-likelihood with respect to the momenta. Numpy input/output.
+        """
+        return - np.dot(momenta.reshape(len(momenta), -1),
+                        self.fixed_effects['covariance_momenta_inverse']).reshape(momenta.shape)
+
     def compute_log_likelihood(self, dataset, population_RER, individual_RER, mode='complete', with_grad=False,
                                modified_individual_RER='all'):
         """
@@ -474,14 +503,29 @@ class BayesianAtlas(AbstractStatisticalModel):
         # Deform -------------------------------------------------------------------------------------------------------
         residuals = []
 
+        if 'image_points' not in template_points.keys():
+            # landmark-only template: all the subjects are shot and flowed at once, along a leading batch dimension.
+            self.exponential.set_initial_template_points(
+                {key: value.expand((len(targets),) + value.size()) for key, value in template_points.items()})
+            self.exponential.set_initial_control_points(control_points.expand(momenta.size()))
+            self.exponential.set_initial_momenta(momenta)
+            self.exponential.move_data_to_(device=device)
+
+            deformed_points = self.exponential.get_final_template_points()
+            for i, target in enumerate(targets):
+                deformed_data = self.template.get_deformed_data(
+                    {key: value[i] for key, value in deformed_points.items()}, template_data)
+                residuals.append(self.multi_object_attachment.compute_distances(deformed_data, self.template, target))
+
+            return residuals
+
         self.exponential.set_initial_template_points(template_points)
         self.exponential.set_initial_control_points(control_points)
 
         for i, target in enumerate(targets):
             self.exponential.set_initial_momenta(momenta[i])
             self.exponential.move_data_to_(device=device)
-            self.exponential.update()
-            deformed_points = self.exponential.get_template_points()
+            deformed_points = self.exponential.get_final_template_points()
             deformed_data = self.template.get_deformed_data(deformed_points, template_data)
             residuals.append(self.multi_object_attachment.compute_distances(deformed_data, self.template, target))
 
@@ -93,11 +93,16 @@ class DeterministicAtlas(AbstractStatisticalModel):
 
                  deformation_kernel_type=default.deformation_kernel_type,
                  deformation_kernel_width=default.deformation_kernel_width,
+                 deformation_kernel_options=default.deformation_kernel_options,
                  deformation_kernel_device=default.deformation_kernel_device,
 
                  shoot_kernel_type=default.shoot_kernel_type,
                  number_of_time_points=default.number_of_time_points,
                  use_rk2_for_shoot=default.use_rk2_for_shoot, use_rk2_for_flow=default.use_rk2_for_flow,
+                 shoot_integrator=default.shoot_integrator, flow_integrator=default.flow_integrator,
+                 integrator_tolerance=default.integrator_tolerance,
+                 parareal_number_of_slices=default.parareal_number_of_slices, image_flow=default.image_flow,
+                 gradient_mode=default.gradient_mode, checkpoint_interval=default.checkpoint_interval,
 
                  freeze_template=default.freeze_template,
                  use_sobolev_gradient=default.use_sobolev_gradient,
@@ -138,10 +143,15 @@ class DeterministicAtlas(AbstractStatisticalModel):
             dense_mode=dense_mode,
             kernel=kernel_factory.factory(deformation_kernel_type,
                                           gpu_mode=gpu_mode,
-                                          kernel_width=deformation_kernel_width),
+                                          kernel_width=deformation_kernel_width,
+                                          **(deformation_kernel_options or {})),
             shoot_kernel_type=shoot_kernel_type,
             number_of_time_points=number_of_time_points,
-            use_rk2_for_shoot=use_rk2_for_shoot, use_rk2_for_flow=use_rk2_for_flow)
+            use_rk2_for_shoot=use_rk2_for_shoot, use_rk2_for_flow=use_rk2_for_flow,
+            shoot_integrator=shoot_integrator, flow_integrator=flow_integrator,
+            integrator_tolerance=integrator_tolerance,
+            parareal_number_of_slices=parareal_number_of_slices, image_flow=image_flow,
+            gradient_mode=gradient_mode, checkpoint_interval=checkpoint_interval)
 
         # Template.
         (object_list, self.objects_name, self.objects_name_extension,
@@ -257,6 +267,25 @@ class DeterministicAtlas(AbstractStatisticalModel):
     ### Public methods:
     ####################################################################################################################
 
+    def remap_control_points(self, control_points, indices, weights):
+        """
+        Replaces the control points by the given ones, the i-th of which carries the momenta of the indices[i]-th
+        previous control point, scaled by weights[i].
+        """
+        self.set_control_points(control_points)
+        self.number_of_control_points = len(control_points)
+        self.set_momenta(weights.reshape(1, -1, 1) * self.get_momenta()[:, indices])
+
+    def compute_momenta_regularity_gradient(self, momenta):
+        """
+        Gradient of the regularity term of the log-likelihood with respect to the momenta. Numpy input/output.
+        """
+        device, _ = utilities.get_best_device(gpu_mode=self.gpu_mode)
+        control_points = utilities.move_data(self.fixed_effects['control_points'], device=device,
+                                             dtype=self.tensor_scalar_type)
+        momenta = utilities.move_data(momenta, device=device, dtype=self.tensor_scalar_type)
+        return - 2. * self.exponential.kernel.convolve(control_points, control_points, momenta).detach().cpu().numpy()
+
     def setup_multiprocess_pool(self, dataset):
         self._setup_multiprocess_pool(initargs=([target[0] for target in dataset.deformable_objects],
                                                 self.multi_object_attachment,
@@ -348,10 +377,9 @@ class DeterministicAtlas(AbstractStatisticalModel):
         exponential.set_initial_control_points(control_points)
         exponential.set_initial_momenta(momenta)
         exponential.move_data_to_(device=device)
-        exponential.update()
 
-        # Compute attachment and regularity.
-        deformed_points = exponential.get_template_points()
+        # Compute attachment and regularity. Without gradient, only the final state of the flow is computed.
+        deformed_points = exponential.get_final_template_points()
         deformed_data = template.get_deformed_data(deformed_points, template_data)
         attachment = -multi_object_attachment.compute_weighted_distance(deformed_data, template, deformable_objects,
                                                                         objects_noise_variance)
@@ -415,17 +443,35 @@ class DeterministicAtlas(AbstractStatisticalModel):
         attachment = 0.
         regularity = 0.
 
-        # loop for every deformable object
-        # deform and update attachment and regularity
-        for i, target in enumerate(targets):
-            new_attachment, new_regularity = DeterministicAtlas._deform_and_compute_attachment_and_regularity(
-                self.exponential, template_points, control_points, momenta[i],
-                self.template, template_data, self.multi_object_attachment,
-                target, self.objects_noise_variance,
-                device=device)
-
-            attachment += new_attachment
-            regularity += new_regularity
+        if 'image_points' not in template_points.keys():
+            # landmark-only template: all the subjects are shot and flowed at once, along a leading batch dimension.
+            number_of_subjects = len(targets)
+            self.exponential.set_initial_template_points(
+                {key: value.expand((number_of_subjects,) + value.size()) for key, value in template_points.items()})
+            self.exponential.set_initial_control_points(control_points.expand(momenta.size()))
+            self.exponential.set_initial_momenta(momenta)
+            self.exponential.move_data_to_(device=device)
+
+            deformed_points = self.exponential.get_final_template_points()
+            for i, target in enumerate(targets):
+                deformed_data = self.template.get_deformed_data(
+                    {key: value[i] for key, value in deformed_points.items()}, template_data)
+                attachment -= self.multi_object_attachment.compute_weighted_distance(
+                    deformed_data, self.template, target, self.objects_noise_variance)
+            regularity = -self.exponential.get_norm_squared()
+
+        else:
+            # loop for every deformable object
+            # deform and update attachment and regularity
+            for i, target in enumerate(targets):
+                new_attachment, new_regularity = DeterministicAtlas._deform_and_compute_attachment_and_regularity(
+                    self.exponential, template_points, control_points, momenta[i],
+                    self.template, template_data, self.multi_object_attachment,
+                    target, self.objects_noise_variance,
+                    device=device)
+
+                attachment += new_attachment
+                regularity += new_regularity
 
         # Compute gradient.
         return self._compute_gradients(attachment, regularity, template_data,
@@ -33,10 +33,15 @@ class GeodesicRegression(AbstractStatisticalModel):
 
                  deformation_kernel_type=default.deformation_kernel_type,
                  deformation_kernel_width=default.deformation_kernel_width,
+                 deformation_kernel_options=default.deformation_kernel_options,
 
                  shoot_kernel_type=default.shoot_kernel_type,
                  concentration_of_time_points=default.concentration_of_time_points, t0=default.t0,
                  use_rk2_for_shoot=default.use_rk2_for_shoot, use_rk2_for_flow=default.use_rk2_for_flow,
+                 shoot_integrator=default.shoot_integrator, flow_integrator=default.flow_integrator,
+                 integrator_tolerance=default.integrator_tolerance,
+                 parareal_number_of_slices=default.parareal_number_of_slices, image_flow=default.image_flow,
+                 gradient_mode=default.gradient_mode, checkpoint_interval=default.checkpoint_interval,
 
                  freeze_template=default.freeze_template,
                  use_sobolev_gradient=default.use_sobolev_gradient,
@@ -72,10 +77,15 @@ class GeodesicRegression(AbstractStatisticalModel):
         # Deformation.
         self.geodesic = Geodesic(
             dense_mode=dense_mode,
-            kernel=kernel_factory.factory(deformation_kernel_type, gpu_mode=gpu_mode, kernel_width=deformation_kernel_width),
+            kernel=kernel_factory.factory(deformation_kernel_type, gpu_mode=gpu_mode, kernel_width=deformation_kernel_width,
+                                          **(deformation_kernel_options or {})),
             shoot_kernel_type=shoot_kernel_type,
             t0=t0, concentration_of_time_points=concentration_of_time_points,
-            use_rk2_for_shoot=use_rk2_for_shoot, use_rk2_for_flow=use_rk2_for_flow)
+            use_rk2_for_shoot=use_rk2_for_shoot, use_rk2_for_flow=use_rk2_for_flow,
+            shoot_integrator=shoot_integrator, flow_integrator=flow_integrator,
+            integrator_tolerance=integrator_tolerance,
+            parareal_number_of_slices=parareal_number_of_slices, image_flow=image_flow,
+            gradient_mode=gradient_mode, checkpoint_interval=checkpoint_interval)
 
         # Template.
         (object_list, self.objects_name, self.objects_name_extension,
@@ -120,8 +130,9 @@ class GeodesicRegression(AbstractStatisticalModel):
             self.geodesic.update()
 
             residuals = np.zeros((self.number_of_objects,))
-            for (time, target) in zip(target_times, target_objects):
-                deformed_points = self.geodesic.get_template_points(time)
+            deformed_points_t = self.geodesic.get_template_points_batch(target_times)
+            for j, target in enumerate(target_objects):
+                deformed_points = {key: value[j] for key, value in deformed_points_t.items()}
                 deformed_data = self.template.get_deformed_data(deformed_points, template_data)
                 residuals += self.multi_object_attachment.compute_distances(
                     deformed_data, self.template, target).data.numpy()
@@ -275,8 +286,9 @@ class GeodesicRegression(AbstractStatisticalModel):
         self.geodesic.update()
 
         attachment = 0.
-        for j, (time, obj) in enumerate(zip(target_times, target_objects)):
-            deformed_points = self.geodesic.get_template_points(time)
+        deformed_points_t = self.geodesic.get_template_points_batch(target_times)
+        for j, obj in enumerate(target_objects):
+            deformed_points = {key: value[j] for key, value in deformed_points_t.items()}
             deformed_data = self.template.get_deformed_data(deformed_points, template_data)
             attachment -= self.multi_object_attachment.compute_weighted_distance(
                 deformed_data, self.template, obj, self.objects_noise_variance)
@@ -86,10 +86,9 @@ def compute_exponential_and_attachment(args):
 
         # start_update = time.perf_counter()
         exponential.move_data_to_(device)
-        exponential.update()
+        deformed_points = exponential.get_final_template_points()
         # logger.info('exponential.update(): ' + str(time.perf_counter() - start_update))
 
-        deformed_points = exponential.get_template_points()
         # deformed_points = {'image_points': torch.rand(48, 65, 30, 3, device=device)}
         deformed_data = template.get_deformed_data(deformed_points, template_data)
         residual = multi_object_attachment.compute_distances(deformed_data, template, target)
@@ -188,12 +187,19 @@ class LongitudinalAtlas(AbstractStatisticalModel):
 
                  deformation_kernel_type=default.deformation_kernel_type,
                  deformation_kernel_width=default.deformation_kernel_width,
+                 deformation_kernel_options=default.deformation_kernel_options,
 
                  shoot_kernel_type=default.shoot_kernel_type,
                  number_of_time_points=default.number_of_time_points,
                  concentration_of_time_points=default.concentration_of_time_points,
                  use_rk2_for_shoot=default.use_rk2_for_shoot,
                  use_rk2_for_flow=default.use_rk2_for_flow,
+                 shoot_integrator=default.shoot_integrator,
+                 flow_integrator=default.flow_integrator,
+                 integrator_tolerance=default.integrator_tolerance,
+                 parareal_number_of_slices=default.parareal_number_of_slices, image_flow=default.image_flow,
+                 gradient_mode=default.gradient_mode,
+                 checkpoint_interval=default.checkpoint_interval,
                  t0=default.t0,
 
                  freeze_template=default.freeze_template,
@@ -270,10 +276,15 @@ class LongitudinalAtlas(AbstractStatisticalModel):
             dense_mode=dense_mode,
             kernel=kernel_factory.factory(deformation_kernel_type,
                                           gpu_mode=self.gpu_mode,
-                                          kernel_width=deformation_kernel_width),
+                                          kernel_width=deformation_kernel_width,
+                                          **(deformation_kernel_options or {})),
             shoot_kernel_type=shoot_kernel_type,
             concentration_of_time_points=concentration_of_time_points, number_of_time_points=number_of_time_points,
-            t0=t0, use_rk2_for_shoot=use_rk2_for_shoot, use_rk2_for_flow=use_rk2_for_flow)
+            t0=t0, use_rk2_for_shoot=use_rk2_for_shoot, use_rk2_for_flow=use_rk2_for_flow,
+            shoot_integrator=shoot_integrator, flow_integrator=flow_integrator,
+            integrator_tolerance=integrator_tolerance,
+            parareal_number_of_slices=parareal_number_of_slices, image_flow=image_flow,
+            gradient_mode=gradient_mode, checkpoint_interval=checkpoint_interval)
         self.spatiotemporal_reference_frame_is_modified = True
 
         # Template.
@@ -1253,13 +1264,19 @@ class LongitudinalAtlas(AbstractStatisticalModel):
             # self.template_data = {key: utilities.move_data(value, device=device) for key, value in
             #                       template_data.items()}
 
+            # The exponentials of all the visits are shot and flowed at once.
+            subject_indices = torch.from_numpy(
+                np.repeat(np.arange(len(targets)), [len(absolute_times_i) for absolute_times_i in absolute_times]))
+            deformed_points = self.spatiotemporal_reference_frame.get_template_points_batch(
+                torch.cat(absolute_times), sources[subject_indices.to(sources.device)], device=device)
+            deformed_points = iter([{key: value[b] for key, value in deformed_points.items()}
+                                    for b in range(len(subject_indices))])
+
             for i in range(len(targets)):
                 residuals_i = []
-                for j, (absolute_time, target) in enumerate(zip(absolute_times[i], targets[i])):
+                for j, target in enumerate(targets[i]):
                     # target = utilities.convert_deformable_object_to_torch(target, device=device)
-                    deformed_points = self.spatiotemporal_reference_frame.get_template_points(
-                        absolute_time, sources[i], device=device)
-                    deformed_data = self.template.get_deformed_data(deformed_points, template_data)
+                    deformed_data = self.template.get_deformed_data(next(deformed_points), template_data)
                     residual = self.multi_object_attachment.compute_distances(deformed_data, self.template, target)
                     residuals_i.append(residual.cpu())
                 residuals.append(residuals_i)
@@ -1283,20 +1300,24 @@ class LongitudinalAtlas(AbstractStatisticalModel):
         reference_time_torch = torch.from_numpy(np.array(reference_time)).type(self.tensor_scalar_type)
         clamped_accelerations = torch.clamp(accelerations, 0.0)
 
-        absolute_times = []
-        for i in range(len(times)):
-            absolute_times_i = []
-            for j in range(len(times[i])):
-                t_ij = torch.from_numpy(np.array(times[i][j])).type(self.tensor_scalar_type)
-
-                assert i < len(onset_ages), 'i=' + str(i) + ', len(onset_ages)=' + str(len(onset_ages))
-
-                absolute_times_i.append(clamped_accelerations[i] * (t_ij - onset_ages[i]) + reference_time_torch)
-            absolute_times.append(absolute_times_i)
-
-        tmin = min([subject_times[0].detach().cpu().numpy() for subject_times in absolute_times] + [reference_time])
-        tmax = max([subject_times[-1].detach().cpu().numpy() for subject_times in absolute_times] + [reference_time])
-
+        # All the visits are processed at once, and split back per subject.
+        assert len(times) <= len(onset_ages), \
+            'len(times)=' + str(len(times)) + ', len(onset_ages)=' + str(len(onset_ages))
+        numbers_of_visits = [len(times_i) for times_i in times]
+        subject_indices = torch.from_numpy(np.repeat(np.arange(len(times)), numbers_of_visits)).to(onset_ages.device)
+        t = torch.from_numpy(np.concatenate([np.array(times_i, dtype=float).ravel() for times_i in times])).type(
+            self.tensor_scalar_type).to(onset_ages.device)
+        absolute_times = clamped_accelerations[subject_indices] * (t - onset_ages[subject_indices]) \
+                         + reference_time_torch.to(onset_ages.device)
+
+        # The first and last absolute times of each subject bound the geodesic.
+        absolute_times_numpy = absolute_times.detach().cpu().numpy()
+        last_indices = np.cumsum(numbers_of_visits) - 1
+        first_indices = last_indices - np.array(numbers_of_visits) + 1
+        tmin = min(list(absolute_times_numpy[first_indices]) + [reference_time])
+        tmax = max(list(absolute_times_numpy[last_indices]) + [reference_time])
+
+        absolute_times = list(torch.split(absolute_times, numbers_of_visits))
         return absolute_times, tmin, tmax
 
     ####################################################################################################################
@@ -41,12 +41,19 @@ class PrincipalGeodesicAnalysis(AbstractStatisticalModel):
 
                  deformation_kernel_type=default.deformation_kernel_type,
                  deformation_kernel_width=default.deformation_kernel_width,
+                 deformation_kernel_options=default.deformation_kernel_options,
                  deformation_kernel_device=default.deformation_kernel_device,
 
                  shoot_kernel_type=None,
                  number_of_time_points=default.number_of_time_points,
                  use_rk2_for_shoot=default.use_rk2_for_shoot,
                  use_rk2_for_flow=default.use_rk2_for_flow,
+                 shoot_integrator=default.shoot_integrator,
+                 flow_integrator=default.flow_integrator,
+                 integrator_tolerance=default.integrator_tolerance,
+                 parareal_number_of_slices=default.parareal_number_of_slices, image_flow=default.image_flow,
+                 gradient_mode=default.gradient_mode,
+                 checkpoint_interval=default.checkpoint_interval,
 
                  initial_cp_spacing=default.initial_cp_spacing,
                  initial_control_points=default.freeze_control_points,
@@ -112,10 +119,15 @@ class PrincipalGeodesicAnalysis(AbstractStatisticalModel):
         self.objects_noise_dimension = compute_noise_dimension(self.template, self.multi_object_attachment,
                                                                self.dimension)
         self.exponential = Exponential(dense_mode=dense_mode,
-                                       kernel=kernel_factory.factory(deformation_kernel_type, gpu_mode=gpu_mode, kernel_width=deformation_kernel_width),
+                                       kernel=kernel_factory.factory(deformation_kernel_type, gpu_mode=gpu_mode, kernel_width=deformation_kernel_width,
+                                                                     **(deformation_kernel_options or {})),
                                        shoot_kernel_type=shoot_kernel_type,
                                        number_of_time_points=number_of_time_points,
-                                       use_rk2_for_shoot=use_rk2_for_shoot, use_rk2_for_flow=use_rk2_for_flow)
+                                       use_rk2_for_shoot=use_rk2_for_shoot, use_rk2_for_flow=use_rk2_for_flow,
+                                       shoot_integrator=shoot_integrator, flow_integrator=flow_integrator,
+                                       integrator_tolerance=integrator_tolerance,
+                                       parareal_number_of_slices=parareal_number_of_slices, image_flow=image_flow,
+                                       gradient_mode=gradient_mode, checkpoint_interval=checkpoint_interval)
 
         self.use_sobolev_gradient = use_sobolev_gradient
         self.smoothing_kernel_width = smoothing_kernel_width
@@ -176,8 +188,13 @@ class PrincipalGeodesicAnalysis(AbstractStatisticalModel):
         determ_estimator_options['print_every_n_iters'] = 1  # No printing
         determ_estimator_options['save_every_n_iters'] = 100  # No un-necessary saving
 
+        # The tangent pca is only a starting point: an approximate deformation kernel (e.g. 'fourier') can be used.
+        determ_model_options = deepcopy(model_options)
+        if model_options.get('initialization_kernel_type') is not None:
+            determ_model_options['deformation_kernel_type'] = model_options['initialization_kernel_type']
+
         determ_atlas = deformetrica.estimate_deterministic_atlas(template_specifications, dataset_specifications,
-                                                  model_options, determ_estimator_options, write_output=True)
+                                                  determ_model_options, determ_estimator_options, write_output=True)
 
         control_points = read_2D_array(
             os.path.join(deformetrica.output_dir, 'DeterministicAtlas__EstimatedParameters__ControlPoints.txt'))
@@ -31,7 +31,12 @@ def call(name, params, estimator_callback=None, callback=lambda *args: None):
 corresp = {
     "kernel": {
         "torch": dfca.kernels.Type.TORCH,
-        "keops": dfca.kernels.Type.KEOPS
+        "keops": dfca.kernels.Type.KEOPS,
+        "sparse": dfca.kernels.Type.SPARSE,
+        "grid": dfca.kernels.Type.GRID,
+        "fourier": dfca.kernels.Type.FOURIER,
+        "multiscale": dfca.kernels.Type.MULTISCALE,
+        "numba": dfca.kernels.Type.NUMBA
     },
 
     "optimize": {
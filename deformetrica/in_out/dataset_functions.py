@@ -210,7 +210,8 @@ def create_template_metadata(template_specifications, dimension=None, gpu_mode=N
             objects_norm_kernels.append(kernel_factory.factory(
                 object['kernel_type'],
                 gpu_mode=gpu_mode,
-                kernel_width=object['kernel_width']))
+                kernel_width=object['kernel_width'],
+                **object.get('kernel_options', {})))
         else:
             objects_norm_kernels.append(kernel_factory.factory(kernel_factory.Type.NO_KERNEL))
 
@@ -27,12 +27,18 @@ def get_estimator_options(xml_parameters):
         options['line_search_expand'] = xml_parameters.line_search_expand
         options['max_line_search_iterations'] = xml_parameters.max_line_search_iterations
         options['optimized_log_likelihood'] = xml_parameters.optimized_log_likelihood
+        options['update_control_points_every_n_iters'] = xml_parameters.update_control_points_every_n_iters
+        options['control_points_pruning_threshold'] = xml_parameters.control_points_pruning_threshold
+        options['control_points_refinement_threshold'] = xml_parameters.control_points_refinement_threshold
 
     elif xml_parameters.optimization_method_type.lower() == 'ScipyLBFGS'.lower():
         options['memory_length'] = xml_parameters.memory_length
         options['freeze_template'] = xml_parameters.freeze_template
         options['max_line_search_iterations'] = xml_parameters.max_line_search_iterations
         options['optimized_log_likelihood'] = xml_parameters.optimized_log_likelihood
+        options['update_control_points_every_n_iters'] = xml_parameters.update_control_points_every_n_iters
+        options['control_points_pruning_threshold'] = xml_parameters.control_points_pruning_threshold
+        options['control_points_refinement_threshold'] = xml_parameters.control_points_refinement_threshold
 
     elif xml_parameters.optimization_method_type.lower() == 'McmcSaem'.lower():
         options['sample_every_n_mcmc_iters'] = xml_parameters.sample_every_n_mcmc_iters
@@ -63,10 +69,18 @@ def get_model_options(xml_parameters):
         'deformation_kernel_type': xml_parameters.deformation_kernel_type,
         'deformation_kernel_width': xml_parameters.deformation_kernel_width,
         'deformation_kernel_device': xml_parameters.deformation_kernel_device,
+        'deformation_kernel_options': xml_parameters.deformation_kernel_options,
         'number_of_time_points': xml_parameters.number_of_time_points,
         'concentration_of_time_points': xml_parameters.concentration_of_time_points,
         'use_rk2_for_shoot': xml_parameters.use_rk2_for_shoot,
         'use_rk2_for_flow': xml_parameters.use_rk2_for_flow,
+        'shoot_integrator': xml_parameters.shoot_integrator,
+        'flow_integrator': xml_parameters.flow_integrator,
+        'integrator_tolerance': xml_parameters.integrator_tolerance,
+        'parareal_number_of_slices': xml_parameters.parareal_number_of_slices,
+        'image_flow': xml_parameters.image_flow,
+        'gradient_mode': xml_parameters.gradient_mode,
+        'checkpoint_interval': xml_parameters.checkpoint_interval,
         'freeze_template': xml_parameters.freeze_template,
         'freeze_control_points': xml_parameters.freeze_control_points,
         'freeze_momenta': xml_parameters.freeze_momenta,
@@ -148,11 +162,19 @@ class XmlParameters:
         self.deformation_kernel_width = 0
         self.deformation_kernel_type = 'torch'
         self.deformation_kernel_device = default.deformation_kernel_device
+        self.deformation_kernel_options = {}
         self.number_of_time_points = default.number_of_time_points
         self.concentration_of_time_points = default.concentration_of_time_points
         self.number_of_sources = default.number_of_sources
         self.use_rk2_for_shoot = default.use_rk2_for_shoot
         self.use_rk2_for_flow = default.use_rk2_for_flow
+        self.shoot_integrator = default.shoot_integrator
+        self.flow_integrator = default.flow_integrator
+        self.integrator_tolerance = default.integrator_tolerance
+        self.parareal_number_of_slices = default.parareal_number_of_slices
+        self.image_flow = default.image_flow
+        self.gradient_mode = default.gradient_mode
+        self.checkpoint_interval = default.checkpoint_interval
         self.t0 = None
         self.tmin = default.tmin
         self.tmax = default.tmax
@@ -180,6 +202,9 @@ class XmlParameters:
         self.line_search_expand = default.line_search_expand
         self.convergence_tolerance = default.convergence_tolerance
         self.memory_length = default.memory_length
+        self.update_control_points_every_n_iters = default.update_control_points_every_n_iters
+        self.control_points_pruning_threshold = default.control_points_pruning_threshold
+        self.control_points_refinement_threshold = default.control_points_refinement_threshold
         self.scale_initial_step_size = default.scale_initial_step_size
         self.downsampling_factor = default.downsampling_factor
 
@@ -366,6 +391,14 @@ class XmlParameters:
                                     self._keops_is_used = True
                             elif model_xml_level3.tag.lower() == 'kernel-device':
                                 template_object['kernel_device'] = model_xml_level3.text
+                            elif model_xml_level3.tag.lower() == 'kernel-widths':
+                                template_object['kernel_options']['kernel_widths'] = self._to_float_list(
+                                    model_xml_level3.text)
+                            elif model_xml_level3.tag.lower() == 'kernel-weights':
+                                template_object['kernel_options']['weights'] = self._to_float_list(
+                                    model_xml_level3.text)
+                            elif model_xml_level3.tag.lower() == 'kernel-memory-budget':
+                                template_object['kernel_options']['memory_budget'] = int(float(model_xml_level3.text))
                             elif model_xml_level3.tag.lower() == 'noise-std':
                                 template_object['noise_std'] = float(model_xml_level3.text)
                             elif model_xml_level3.tag.lower() == 'filename':
@@ -398,6 +431,12 @@ class XmlParameters:
                             self._keops_is_used = True
                     elif model_xml_level2.tag.lower() == 'kernel-device':
                         self.deformation_kernel_device = model_xml_level2.text
+                    elif model_xml_level2.tag.lower() == 'kernel-widths':
+                        self.deformation_kernel_options['kernel_widths'] = self._to_float_list(model_xml_level2.text)
+                    elif model_xml_level2.tag.lower() == 'kernel-weights':
+                        self.deformation_kernel_options['weights'] = self._to_float_list(model_xml_level2.text)
+                    elif model_xml_level2.tag.lower() == 'kernel-memory-budget':
+                        self.deformation_kernel_options['memory_budget'] = int(float(model_xml_level2.text))
                     elif model_xml_level2.tag.lower() == 'number-of-timepoints':
                         self.number_of_time_points = int(model_xml_level2.text)
                     elif model_xml_level2.tag.lower() == 'number-of-interpolation-points':
@@ -497,6 +536,12 @@ class XmlParameters:
                     self.convergence_tolerance = float(optimization_parameters_xml_level1.text)
                 elif optimization_parameters_xml_level1.tag.lower() == 'memory-length':
                     self.memory_length = int(optimization_parameters_xml_level1.text)
+                elif optimization_parameters_xml_level1.tag.lower() == 'update-control-points-every-n-iters':
+                    self.update_control_points_every_n_iters = int(optimization_parameters_xml_level1.text)
+                elif optimization_parameters_xml_level1.tag.lower() == 'control-points-pruning-threshold':
+                    self.control_points_pruning_threshold = float(optimization_parameters_xml_level1.text)
+                elif optimization_parameters_xml_level1.tag.lower() == 'control-points-refinement-threshold':
+                    self.control_points_refinement_threshold = float(optimization_parameters_xml_level1.text)
                 elif optimization_parameters_xml_level1.tag.lower() == 'downsampling-factor':
                     self.downsampling_factor = int(optimization_parameters_xml_level1.text)
                 elif optimization_parameters_xml_level1.tag.lower() == 'save-every-n-iters':
@@ -531,6 +576,20 @@ class XmlParameters:
                 elif optimization_parameters_xml_level1.tag.lower() == 'use-rk2':
                     self.use_rk2_for_shoot = self._on_off_to_bool(optimization_parameters_xml_level1.text)
                     self.use_rk2_for_flow = self._on_off_to_bool(optimization_parameters_xml_level1.text)
+                elif optimization_parameters_xml_level1.tag.lower() == 'shoot-integrator':
+                    self.shoot_integrator = optimization_parameters_xml_level1.text.lower()
+                elif optimization_parameters_xml_level1.tag.lower() == 'flow-integrator':
+                    self.flow_integrator = optimization_parameters_xml_level1.text.lower()
+                elif optimization_parameters_xml_level1.tag.lower() == 'integrator-tolerance':
+                    self.integrator_tolerance = float(optimization_parameters_xml_level1.text)
+                elif optimization_parameters_xml_level1.tag.lower() == 'parareal-number-of-slices':
+                    self.parareal_number_of_slices = int(optimization_parameters_xml_level1.text)
+                elif optimization_parameters_xml_level1.tag.lower() == 'image-flow':
+                    self.image_flow = optimization_parameters_xml_level1.text.lower().replace('-', '_')
+                elif optimization_parameters_xml_level1.tag.lower() == 'gradient-mode':
+                    self.gradient_mode = optimization_parameters_xml_level1.text.lower()
+                elif optimization_parameters_xml_level1.tag.lower() == 'checkpoint-interval':
+                    self.checkpoint_interval = int(optimization_parameters_xml_level1.text)
                 elif optimization_parameters_xml_level1.tag.lower() == 'momenta-proposal-std':
                     self.momenta_proposal_std = float(optimization_parameters_xml_level1.text)
                 elif optimization_parameters_xml_level1.tag.lower() == 'onset-age-proposal-std':
@@ -581,12 +640,17 @@ class XmlParameters:
         template_object['kernel_type'] = 'undefined'
         template_object['kernel_width'] = 0.0
         template_object['kernel_device'] = default.deformation_kernel_device
+        template_object['kernel_options'] = {}
         template_object['noise_std'] = -1
         template_object['filename'] = 'undefined'
         template_object['noise_variance_prior_scale_std'] = None
         template_object['noise_variance_prior_normalized_dof'] = 0.01
         return template_object
 
+    @staticmethod
+    def _to_float_list(s):
+        return [float(elt) for elt in s.replace(',', ' ').split()]
+
     def _on_off_to_bool(self, s):
         if s.lower() == "on":
             return True
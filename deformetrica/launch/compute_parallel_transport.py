@@ -21,6 +21,7 @@ def compute_parallel_transport(template_specifications,
 
                                deformation_kernel_type=default.deformation_kernel_type,
                                deformation_kernel_width=default.deformation_kernel_width,
+                               deformation_kernel_options=default.deformation_kernel_options,
 
                                shoot_kernel_type=None,
                                initial_control_points=default.initial_control_points,
@@ -37,7 +38,8 @@ def compute_parallel_transport(template_specifications,
                                gpu_mode=default.gpu_mode,
                                output_dir=default.output_dir, **kwargs
                                ):
-    deformation_kernel = kernel_factory.factory(deformation_kernel_type, gpu_mode=gpu_mode, kernel_width=deformation_kernel_width)
+    deformation_kernel = kernel_factory.factory(deformation_kernel_type, gpu_mode=gpu_mode, kernel_width=deformation_kernel_width,
+                                                **(deformation_kernel_options or {}))
 
     """
     Compute parallel transport
@@ -18,6 +18,7 @@ def compute_shooting(template_specifications,
 
                      deformation_kernel_type=default.deformation_kernel_type,
                      deformation_kernel_width=default.deformation_kernel_width,
+                     deformation_kernel_options=default.deformation_kernel_options,
                      deformation_kernel_device=default.deformation_kernel_device,
 
                      shoot_kernel_type=None,
@@ -37,7 +38,8 @@ def compute_shooting(template_specifications,
     Create the template object
     """
 
-    deformation_kernel = kernel_factory.factory(deformation_kernel_type, gpu_mode=gpu_mode, kernel_width=deformation_kernel_width)
+    deformation_kernel = kernel_factory.factory(deformation_kernel_type, gpu_mode=gpu_mode, kernel_width=deformation_kernel_width,
+                                                **(deformation_kernel_options or {}))
 
     (object_list, t_name, t_name_extension,
      t_noise_variance, multi_object_attachment) = create_template_metadata(
@@ -103,10 +105,10 @@ def compute_shooting(template_specifications,
     geodesic.set_use_rk2_for_flow(use_rk2_for_flow)
     geodesic.set_template_points_t0(template_points)
 
+    # The geodesics are not updated: their states are streamed and written one time point at a time.
     # Single momenta: single shooting
     if len(momenta.shape) == 2:
         geodesic.set_momenta_t0(momenta_torch)
-        geodesic.update()
         names = [elt for elt in t_name]
         geodesic.write('Shooting', names, t_name_extension, template, template_data, output_dir,
                        write_adjoint_parameters=True)
@@ -115,7 +117,6 @@ def compute_shooting(template_specifications,
     else:
         for i in range(len(momenta_torch)):
             geodesic.set_momenta_t0(momenta_torch[i])
-            geodesic.update()
             names = [elt for elt in t_name]
             geodesic.write('Shooting' + "_" + str(i), names, t_name_extension, template, template_data, output_dir,
                            write_adjoint_parameters=True)
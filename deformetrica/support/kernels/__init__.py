@@ -3,34 +3,33 @@ from enum import Enum, auto
 from ...core import default
 from ...support.kernels.abstract_kernel import AbstractKernel
 from .keops_kernel import test_keops_setup
+from .numba_kernel import test_numba_setup
 
 
 class Type(Enum):
+    from ...support.kernels.auto_kernel import AutoKernel
     from ...support.kernels.torch_kernel import TorchKernel
     from ...support.kernels.keops_kernel import KeopsKernel
+    from ...support.kernels.sparse_kernel import SparseKernel
+    from ...support.kernels.grid_kernel import GridKernel
+    from ...support.kernels.fourier_kernel import FourierKernel
+    from ...support.kernels.multiscale_kernel import MultiScaleKernel
+    from ...support.kernels.numba_kernel import NumbaKernel
 
-    AUTO = auto()
+    AUTO = AutoKernel
     NO_KERNEL = auto()
     TORCH = TorchKernel
     KEOPS = KeopsKernel
+    SPARSE = SparseKernel
+    GRID = GridKernel
+    FOURIER = FourierKernel
+    MULTISCALE = MultiScaleKernel
+    NUMBA = NumbaKernel
 
 
 instance_map = dict()
 
 
-def kernel_selector():
-    # check that keops is properly setup
-    res = Type.KEOPS if test_keops_setup() else Type.TORCH
-
-    # # estimate tensor size in bytes TODO
-    # import torch
-    # from ..utilities import estimate_tensor_required_size
-    # t = torch.tensor([[63.], [90.]], dtype=torch.float64, requires_grad=False)
-    # tensor_size = estimate_tensor_required_size(t)
-
-    return res
-
-
 def factory(kernel_type, cuda_type=None, gpu_mode=None, *args, **kwargs):
     """Return an instance of a kernel corresponding to the requested kernel_type"""
     if cuda_type is None:
@@ -53,13 +52,11 @@ def factory(kernel_type, cuda_type=None, gpu_mode=None, *args, **kwargs):
     if kernel_type in [Type.NO_KERNEL]:
         return None
 
-    if kernel_type in [Type.AUTO]:
-        kernel_type = kernel_selector()
-
     res = None
     hash = AbstractKernel.hash(kernel_type, cuda_type, gpu_mode, *args, **kwargs)
     if hash not in instance_map:
         res = kernel_type.value(gpu_mode=gpu_mode, cuda_type=cuda_type, *args, **kwargs)    # instantiate
+        res.options = {key: value for key, value in kwargs.items() if key != 'kernel_width'}
         instance_map[hash] = res
     else:
         res = instance_map[hash]
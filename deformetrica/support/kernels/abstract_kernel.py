@@ -1,4 +1,5 @@
 from abc import ABC, abstractmethod
+import functools
 import torch
 
 from ...core import default
@@ -7,11 +8,43 @@ import logging
 logger = logging.getLogger(__name__)
 
 
+def loop_over_batch_dimension(method):
+    """
+    Decorator for the kernel methods that only handle (N, D) tensors: (B, N, D) arguments, possibly in tuples, are
+    sliced along the batch dimension and the results are stacked. (N, D) arguments are shared by the whole batch.
+    """
+    def get_batch_sizes(arg):
+        if isinstance(arg, (tuple, list)):
+            return set().union(*[get_batch_sizes(elt) for elt in arg])
+        return {arg.size(0)} if isinstance(arg, torch.Tensor) and arg.dim() == 3 else set()
+
+    def select(arg, b):
+        if isinstance(arg, (tuple, list)):
+            return type(arg)(select(elt, b) for elt in arg)
+        return arg[b] if isinstance(arg, torch.Tensor) and arg.dim() == 3 else arg
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        batch_sizes = get_batch_sizes(args)
+        if len(batch_sizes) == 0:
+            return method(self, *args, **kwargs)
+        assert len(batch_sizes) == 1, 'batched tensors must have the same batch size'
+
+        res = [method(self, *select(args, b), **kwargs) for b in range(batch_sizes.pop())]
+        if isinstance(res[0], tuple):
+            return tuple(torch.stack(elt) for elt in zip(*res))
+        return torch.stack(res)
+
+    return wrapper
+
+
 class AbstractKernel(ABC):
     def __init__(self, kernel_width=None, kernel_type='undefined', gpu_mode=default.gpu_mode):
         self.kernel_width = kernel_width
         self.kernel_type = kernel_type
         self.gpu_mode = gpu_mode
+        # Extra keyword arguments given to the factory, that the kernels derived from this one are built with.
+        self.options = {}
         logger.debug('instantiating kernel %s with kernel_width %s and gpu_mode %s. addr: %s',
                      self.kernel_type, self.kernel_width, self.gpu_mode, hex(id(self)))
 
@@ -22,6 +55,8 @@ class AbstractKernel(ABC):
 
     @staticmethod
     def hash(kernel_type, cuda_type, gpu_mode, *args, **kwargs):
+        # list options, e.g. read from a configuration file, are hashed as tuples.
+        kwargs = {key: tuple(value) if isinstance(value, list) else value for key, value in kwargs.items()}
         return hash((kernel_type, cuda_type, gpu_mode, frozenset(args), frozenset(kwargs.items())))
 
     def __hash__(self, **kwargs):
@@ -35,6 +70,14 @@ class AbstractKernel(ABC):
     def convolve_gradient(self, px, x, y=None, py=None):
         raise NotImplementedError
 
+    def convolve_and_gradient(self, x, p):
+        """
+        Returns both K(x, x) p and the gradient of the hamiltonian p^T K(x, x) p / 2 with respect to x, i.e. the
+        derivatives of the control points and momenta in the geodesic equations (up to the sign of the second term).
+        Backends that can share the pairwise computations between the two reductions should override this method.
+        """
+        return self.convolve(x, x, p), self.convolve_gradient(p, x)
+
     def get_kernel_matrix(self, x, y=None):
         """
         returns the kernel matrix, A_{ij} = exp(-|x_i-x_j|^2/sigma^2)
@@ -47,12 +90,25 @@ class AbstractKernel(ABC):
 
     @staticmethod
     def _squared_distances(x, y):
-        x_norm = (x ** 2).sum(1).view(-1, 1)
-        y_norm = (y ** 2).sum(1).view(1, -1)
+        x_norm = (x ** 2).sum(-1).unsqueeze(-1)
+        y_norm = (y ** 2).sum(-1).unsqueeze(-2)
 
-        dist = x_norm + y_norm - 2.0 * torch.mm(x, torch.transpose(y, 0, 1))
+        dist = x_norm + y_norm - 2.0 * torch.matmul(x, torch.transpose(y, -1, -2))
         return dist
 
+    @staticmethod
+    def _broadcast_batch_dimension(*tensors):
+        """
+        Expands the (N, D) tensors to the batch size of the (B, N, D) ones, if any. Expanded tensors share the memory
+        of the original ones, and their gradients are summed over the batch.
+        """
+        batch_sizes = {t.size(0) for t in tensors if t.dim() == 3}
+        if len(batch_sizes) == 0:
+            return tensors
+        assert len(batch_sizes) == 1, 'batched tensors must have the same batch size'
+        batch_size = batch_sizes.pop()
+        return tuple(t if t.dim() == 3 else t.expand(batch_size, -1, -1) for t in tensors)
+
     @staticmethod
     def _move_to_device(t, gpu_mode):
         """
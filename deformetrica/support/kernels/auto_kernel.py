@@ -0,0 +1,204 @@
+import json
+import logging
+import math
+import multiprocessing
+import os
+import tempfile
+import threading
+import time
+import torch
+
+from ...core import default
+from ...support.kernels.abstract_kernel import AbstractKernel
+from ...support.kernels.keops_kernel import test_keops_setup
+from ...support.kernels.numba_kernel import test_numba_setup
+
+logger = logging.getLogger(__name__)
+
+
+class AutoKernel(AbstractKernel):
+    """
+    Dispatches each call to the fastest of a set of candidate backends. Calls are grouped in buckets of similar sizes
+    (method, mode, N and M rounded up to powers of two, D, dtype, device, gpu mode and whether a backward pass
+    follows), and the candidates are benchmarked on the first call of each bucket. Winners are persisted in a json
+    file, shared by all the runs on the same machine, and replaced atomically when a new winner is found.
+    Benchmarks only run in the main thread of the main process, so that concurrent computations do not time each
+    other: worker threads and processes use the winners found so far, in memory or in the json file, and otherwise the
+    first candidate, without recording it.
+    Candidates are the exact backends by default: dense and tiled torch, keops when it is properly setup and numba
+    when it is installed. The approximate ones (sparse, grid, fourier) can be added to the candidates explicitly.
+    """
+
+    ####################################################################################################################
+    ### Constructor:
+    ####################################################################################################################
+
+    def __init__(self, kernel_width=None, gpu_mode=default.gpu_mode, cuda_type=None, candidates=None,
+                 cache_path=None, tiled_memory_budget=2 ** 28, benchmark_repetitions=3, **kwargs):
+        super().__init__(kernel_width, 'auto', gpu_mode)
+
+        if cuda_type is None:
+            cuda_type = default.dtype
+        if cache_path is None:
+            cache_path = default.kernel_autotuner_cache
+
+        self.cuda_type = cuda_type
+        self.cache_path = cache_path
+        self.benchmark_repetitions = benchmark_repetitions
+
+        # names of the candidate backends: kernel types, and 'torch_tiled' for the torch kernel with a memory budget.
+        if candidates is None:
+            candidates = ('torch', 'torch_tiled') + (('keops',) if test_keops_setup() else ()) \
+                         + (('numba',) if test_numba_setup() else ())
+        self.candidates = tuple(candidates)
+        self.tiled_memory_budget = tiled_memory_budget
+
+        # bucket -> name of the winning candidate.
+        self._winners = {}
+
+    def __eq__(self, other):
+        return AbstractKernel.__eq__(self, other) \
+               and self.cuda_type == other.cuda_type \
+               and self.candidates == other.candidates \
+               and self.tiled_memory_budget == other.tiled_memory_budget \
+               and self.cache_path == other.cache_path \
+               and self.benchmark_repetitions == other.benchmark_repetitions
+
+    def __hash__(self, **kwargs):
+        return AbstractKernel.__hash__(self, candidates=self.candidates, tiled_memory_budget=self.tiled_memory_budget,
+                                       cache_path=self.cache_path, benchmark_repetitions=self.benchmark_repetitions,
+                                       **kwargs)
+
+    ####################################################################################################################
+    ### Public methods:
+    ####################################################################################################################
+
+    def convolve(self, x, y, p, mode='gaussian'):
+        x_points, y_points = (x[0], y[0]) if mode == 'varifold' else (x, y)
+        return self._dispatch('convolve', (x, y, p), {'mode': mode}, x_points, y_points)
+
+    def convolve_gradient(self, px, x, y=None, py=None):
+        return self._dispatch('convolve_gradient', (px, x, y, py), {}, x, x if y is None else y)
+
+    def convolve_and_gradient(self, x, p):
+        return self._dispatch('convolve_and_gradient', (x, p), {}, x, x)
+
+    def get_candidate_kernel(self, name):
+        from ...support import kernels as kernel_factory
+        if name == 'torch_tiled':
+            return kernel_factory.factory('torch', cuda_type=self.cuda_type, gpu_mode=self.gpu_mode,
+                                          kernel_width=self.kernel_width, memory_budget=self.tiled_memory_budget)
+        return kernel_factory.factory(name, cuda_type=self.cuda_type, gpu_mode=self.gpu_mode,
+                                      kernel_width=self.kernel_width)
+
+    ####################################################################################################################
+    ### Auxiliary methods:
+    ####################################################################################################################
+
+    def _dispatch(self, method, args, kwargs, x, y):
+        backward = torch.is_grad_enabled() and any(
+            t.requires_grad for t in self._get_tensors(args) if t.is_floating_point())
+        bucket = '|'.join(str(elt) for elt in [
+            method, kwargs.get('mode', ''), self._round_size(x.numel() // x.size(-1)),
+            self._round_size(y.numel() // y.size(-1)), x.size(-1), x.dtype, self._get_device_name(x.device),
+            self.gpu_mode.name, 'backward' if backward else 'forward', ','.join(sorted(self.candidates))])
+
+        winner = self._winners.get(bucket)
+        if winner is None:
+            winner = self._load_cache().get(bucket)
+            if winner not in self.candidates:
+                if not self._is_main_thread_of_main_process():
+                    return getattr(self.get_candidate_kernel(self.candidates[0]), method)(*args, **kwargs)
+                winner = self._benchmark(method, args, kwargs, backward)
+                logger.info('>> Kernel autotuner: %s is the fastest for %s' % (winner, bucket))
+                self._save_cache(bucket, winner)
+            self._winners[bucket] = winner
+
+        return getattr(self.get_candidate_kernel(winner), method)(*args, **kwargs)
+
+    def _benchmark(self, method, args, kwargs, backward):
+        """
+        Returns the name of the candidate with the lowest median time on the given arguments, which are detached so
+        that benchmark runs do not take part in the computational graph.
+        """
+        timings = {}
+        for name in self.candidates:
+            try:
+                function = getattr(self.get_candidate_kernel(name), method)
+                durations = []
+                # the first run is not timed: it includes compilations and allocations.
+                for repetition in range(self.benchmark_repetitions + 1):
+                    detached_args = self._detach(args, backward)
+                    start = time.perf_counter()
+                    res = function(*detached_args, **kwargs)
+                    if backward:
+                        torch.autograd.backward([torch.sum(t) for t in (res if isinstance(res, tuple) else (res,))])
+                    if torch.cuda.is_available():
+                        torch.cuda.synchronize()
+                    durations.append(time.perf_counter() - start)
+                timings[name] = sorted(durations[1:])[len(durations[1:]) // 2]
+
+            except Exception as e:
+                logger.warning('>> Kernel autotuner: the %s candidate failed (%s)' % (name, e))
+                timings[name] = float('inf')
+
+        return min(timings, key=timings.get)
+
+    def _load_cache(self):
+        try:
+            with open(self.cache_path, 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _save_cache(self, bucket, winner):
+        """
+        Adds the winner to the json file, rewritten in a temporary file of the same directory that then replaces it, so
+        that concurrent readers never see a truncated file.
+        """
+        directory = os.path.dirname(os.path.abspath(self.cache_path))
+        try:
+            os.makedirs(directory, exist_ok=True)
+            cache = self._load_cache()
+            cache[bucket] = winner
+            file_descriptor, temporary_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+            try:
+                with os.fdopen(file_descriptor, 'w') as f:
+                    json.dump(cache, f, indent=2, sort_keys=True)
+                os.replace(temporary_path, self.cache_path)
+            except BaseException:
+                os.remove(temporary_path)
+                raise
+        except OSError as e:
+            logger.warning('>> Kernel autotuner: the cache file %s could not be written (%s)' % (self.cache_path, e))
+
+    @staticmethod
+    def _is_main_thread_of_main_process():
+        return threading.current_thread() is threading.main_thread() \
+               and multiprocessing.current_process().name == 'MainProcess'
+
+    @staticmethod
+    def _round_size(n):
+        return 2 ** int(math.ceil(math.log2(max(n, 1))))
+
+    @staticmethod
+    def _get_device_name(device):
+        return torch.cuda.get_device_name(device) if device.type == 'cuda' else 'cpu'
+
+    @staticmethod
+    def _get_tensors(args):
+        for arg in args:
+            if isinstance(arg, (tuple, list)):
+                yield from AutoKernel._get_tensors(arg)
+            elif isinstance(arg, torch.Tensor):
+                yield arg
+
+    @staticmethod
+    def _detach(args, requires_grad):
+        def detach(arg):
+            if isinstance(arg, (tuple, list)):
+                return type(arg)(detach(elt) for elt in arg)
+            if isinstance(arg, torch.Tensor):
+                return arg.detach().requires_grad_(requires_grad and arg.is_floating_point())
+            return arg
+        return tuple(detach(arg) for arg in args)
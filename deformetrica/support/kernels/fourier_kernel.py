@@ -0,0 +1,181 @@
+import logging
+import torch
+
+from ...core import GpuMode, default
+from ...support.kernels.abstract_kernel import AbstractKernel, loop_over_batch_dimension
+
+logger = logging.getLogger(__name__)
+
+
+class FourierKernel(AbstractKernel):
+    """
+    Approximate gaussian kernel based on random Fourier features: k(x, y) = exp(-|x-y|^2/s^2) is the expectation of
+    cos(w.(x-y)) for w ~ N(0, 2/s^2 I), and is replaced by the average over rank sampled frequencies. Convolutions
+    then factorize through the (N, rank) feature matrices, at a O((N+M).rank) cost instead of O(N.M).
+    The rank is either given, or chosen as the smallest power of two reaching relative_error on a subsample of the
+    first convolution, compared with the exact kernel. Frequencies are drawn once per dimension from a fixed seed.
+    """
+
+    ####################################################################################################################
+    ### Constructor:
+    ####################################################################################################################
+
+    def __init__(self, kernel_width=None, gpu_mode=default.gpu_mode, rank=None, relative_error=0.05, seed=0,
+                 max_rank=16384, **kwargs):
+        super().__init__(kernel_width, 'fourier', gpu_mode)
+        self.rank = rank
+        self.relative_error = relative_error
+        self.seed = seed
+        self.max_rank = max_rank if rank is None else max(max_rank, rank)
+        # dimension -> (max_rank, dimension) standard normal frequencies, and chosen rank.
+        self._frequencies = {}
+        self._ranks = {}
+
+    def __eq__(self, other):
+        return AbstractKernel.__eq__(self, other) \
+               and self.rank == other.rank \
+               and self.relative_error == other.relative_error \
+               and self.seed == other.seed \
+               and self.max_rank == other.max_rank
+
+    def __hash__(self, **kwargs):
+        return AbstractKernel.__hash__(self, rank=self.rank, relative_error=self.relative_error, seed=self.seed,
+                                       max_rank=self.max_rank, **kwargs)
+
+    ####################################################################################################################
+    ### Public methods:
+    ####################################################################################################################
+
+    @loop_over_batch_dimension
+    def convolve(self, x, y, p, mode='gaussian'):
+        res = None
+
+        if mode in ['gaussian', 'pointcloud']:
+            # move tensors with respect to gpu_mode
+            x, y, p = (self._move_to_device(t, gpu_mode=self.gpu_mode) for t in [x, y, p])
+            assert x.device == y.device == p.device, 'x, y and p must be on the same device'
+
+            res = self._convolve(x, y, p, self._get_frequencies(x, y, p))
+
+        elif mode == 'varifold':
+            assert isinstance(x, tuple), 'x must be a tuple'
+            assert len(x) == 2, 'tuple length must be 2'
+            assert isinstance(y, tuple), 'y must be a tuple'
+            assert len(y) == 2, 'tuple length must be 2'
+
+            # tuples are immutable, mutability is needed to mode to device
+            x = list(x)
+            y = list(y)
+
+            # move tensors with respect to gpu_mode
+            x[0], x[1], y[0], y[1], p = (self._move_to_device(t, gpu_mode=self.gpu_mode) for t in [x[0], x[1], y[0], y[1], p])
+            assert x[0].device == y[0].device == p.device, 'x, y and p must be on the same device'
+            assert x[1].device == y[1].device == p.device, 'x, y and p must be on the same device'
+
+            # <nx_i, ny_j>^2 = sum_{a,b} nx_i^a nx_i^b ny_j^a ny_j^b: one column per (a <= b) pair and column of p.
+            dimension = x[0].size(1)
+            pairs = [(a, b) for a in range(dimension) for b in range(a, dimension)]
+            weights = torch.cat([(y[1][:, a] * y[1][:, b]).unsqueeze(1) * p for a, b in pairs], 1)
+            convolved = self._convolve(x[0], y[0], weights, self._get_frequencies(x[0], y[0], p))
+
+            res = 0.
+            for k, (a, b) in enumerate(pairs):
+                factor = 1. if a == b else 2.
+                res = res + factor * (x[1][:, a] * x[1][:, b]).unsqueeze(1) \
+                      * convolved[:, k * p.size(1):(k + 1) * p.size(1)]
+        else:
+            raise RuntimeError('Unknown kernel mode.')
+
+        return res.cpu() if self.gpu_mode is GpuMode.KERNEL else res
+
+    @loop_over_batch_dimension
+    def convolve_gradient(self, px, x, y=None, py=None):
+        if y is None:
+            y = x
+        if py is None:
+            py = px
+
+        # move tensors with respect to gpu_mode
+        x, px, y, py = (self._move_to_device(t, gpu_mode=self.gpu_mode) for t in [x, px, y, py])
+        assert px.device == x.device == y.device == py.device, 'tensors must be on the same device'
+
+        w = self._get_frequencies(x, y, py)
+        wx, wy = torch.mm(x, w.t()), torch.mm(y, w.t())
+        res = self._gradient(px, torch.cos(wx), torch.sin(wx), torch.cos(wy), torch.sin(wy), py, w)
+        return res.cpu() if self.gpu_mode is GpuMode.KERNEL else res
+
+    @loop_over_batch_dimension
+    def convolve_and_gradient(self, x, p):
+        # move tensors with respect to gpu_mode
+        x, p = (self._move_to_device(t, gpu_mode=self.gpu_mode) for t in [x, p])
+        assert x.device == p.device, 'x and p must be on the same device'
+
+        # The features are shared by both reductions.
+        w = self._get_frequencies(x, x, p)
+        wx = torch.mm(x, w.t())
+        cos_x, sin_x = torch.cos(wx), torch.sin(wx)
+        velocity = (torch.mm(cos_x, torch.mm(cos_x.t(), p)) + torch.mm(sin_x, torch.mm(sin_x.t(), p))) / w.size(0)
+        gradient = self._gradient(p, cos_x, sin_x, cos_x, sin_x, p, w)
+
+        if self.gpu_mode is GpuMode.KERNEL:
+            velocity, gradient = velocity.cpu(), gradient.cpu()
+        return velocity, gradient
+
+    ####################################################################################################################
+    ### Auxiliary methods:
+    ####################################################################################################################
+
+    @staticmethod
+    def _convolve(x, y, p, w):
+        wx, wy = torch.mm(x, w.t()), torch.mm(y, w.t())
+        return (torch.mm(torch.cos(wx), torch.mm(torch.cos(wy).t(), p))
+                + torch.mm(torch.sin(wx), torch.mm(torch.sin(wy).t(), p))) / w.size(0)
+
+    @staticmethod
+    def _gradient(px, cos_x, sin_x, cos_y, sin_y, py, w):
+        """
+        Gradient of sum_j k(x_i, y_j) <px_i, py_j> with respect to x_i, the derivative of cos(w.(x_i - y_j)) being
+        -w (sin(w.x_i) cos(w.y_j) - cos(w.x_i) sin(w.y_j)).
+        """
+        a = - sin_x * torch.mm(px, torch.mm(cos_y.t(), py).t()) + cos_x * torch.mm(px, torch.mm(sin_y.t(), py).t())
+        return torch.mm(a, w) / w.size(0)
+
+    def _get_frequencies(self, x, y, p):
+        """
+        Returns the (rank, D) frequencies, the rank being chosen on the first call for each dimension.
+        """
+        dimension = x.size(1)
+        if dimension not in self._frequencies:
+            generator = torch.Generator().manual_seed(self.seed)
+            self._frequencies[dimension] = torch.randn((self.max_rank, dimension), generator=generator,
+                                                       dtype=torch.float64)
+        frequencies = self._frequencies[dimension] * (2 ** 0.5 / self.kernel_width)
+
+        if dimension not in self._ranks:
+            self._ranks[dimension] = self.rank if self.rank is not None \
+                else self._select_rank(x.detach(), y.detach(), p.detach(), frequencies.to(x.device, x.dtype))
+            logger.info('>> Fourier kernel of width %s in dimension %d: rank %d' %
+                        (self.kernel_width, dimension, self._ranks[dimension]))
+
+        return frequencies[:self._ranks[dimension]].to(device=x.device, dtype=x.dtype)
+
+    def _select_rank(self, x, y, p, frequencies, subsample_size=512):
+        """
+        Doubles the rank until the relative error of the convolution of a subsample is below relative_error.
+        """
+        generator = torch.Generator().manual_seed(self.seed)
+        x = x[torch.randperm(x.size(0), generator=generator)[:subsample_size].to(x.device)]
+        y_indices = torch.randperm(y.size(0), generator=generator)[:subsample_size].to(y.device)
+        y, p = y[y_indices], p[y_indices]
+
+        exact = torch.mm(torch.exp(-self._squared_distances(x, y) / (self.kernel_width ** 2)), p)
+        rank = 64
+        while rank < self.max_rank:
+            error = torch.norm(self._convolve(x, y, p, frequencies[:rank]) - exact) / torch.norm(exact)
+            if error <= self.relative_error:
+                return rank
+            rank *= 2
+
+        logger.warning('>> Fourier kernel: the relative error %.2E is not reached with the maximum rank %d' %
+                       (self.relative_error, self.max_rank))
+        return self.max_rank
@@ -0,0 +1,217 @@
+import itertools
+import logging
+import math
+from functools import reduce
+from operator import mul
+
+import torch
+
+from ...core import GpuMode, default
+from ...support.kernels.abstract_kernel import AbstractKernel, loop_over_batch_dimension
+
+logger = logging.getLogger(__name__)
+
+
+class GridKernel(AbstractKernel):
+    """
+    Gaussian kernel evaluated on a regular grid: the weights are splatted onto the grid nodes (multilinear, or
+    cloud-in-cell, weights), convolved with separable sampled gaussians, and interpolated back at the target points.
+    The cost is O(grid nodes * taps) instead of O(N.M), which pays off for dense targets such as image points.
+    The grid is aligned with the minimum of the source points, so that a regular grid of control points whose step is
+    a multiple of the grid step is splatted exactly.
+    """
+
+    ####################################################################################################################
+    ### Constructor:
+    ####################################################################################################################
+
+    def __init__(self, kernel_width=None, gpu_mode=default.gpu_mode, grid_spacing=0.2, truncation_sigmas=4.,
+                 **kwargs):
+        super().__init__(kernel_width, 'grid', gpu_mode)
+        # Grid step, in kernel width units.
+        self.grid_spacing = grid_spacing
+        self.truncation_sigmas = truncation_sigmas
+
+    def __eq__(self, other):
+        return AbstractKernel.__eq__(self, other) \
+               and self.grid_spacing == other.grid_spacing \
+               and self.truncation_sigmas == other.truncation_sigmas
+
+    def __hash__(self, **kwargs):
+        return AbstractKernel.__hash__(self, grid_spacing=self.grid_spacing,
+                                       truncation_sigmas=self.truncation_sigmas, **kwargs)
+
+    ####################################################################################################################
+    ### Public methods:
+    ####################################################################################################################
+
+    @loop_over_batch_dimension
+    def convolve(self, x, y, p, mode='gaussian'):
+        res = None
+
+        if mode in ['gaussian', 'pointcloud']:
+            # move tensors with respect to gpu_mode
+            x, y, p = (self._move_to_device(t, gpu_mode=self.gpu_mode) for t in [x, y, p])
+            assert x.device == y.device == p.device, 'x, y and p must be on the same device'
+
+            origin, shape = self._get_grid(x, y)
+            field = self._convolve_grid(self._splat(y, p, origin, shape))
+            res = self._interpolate(field, x, origin)
+
+        elif mode == 'varifold':
+            assert isinstance(x, tuple), 'x must be a tuple'
+            assert len(x) == 2, 'tuple length must be 2'
+            assert isinstance(y, tuple), 'y must be a tuple'
+            assert len(y) == 2, 'tuple length must be 2'
+
+            # tuples are immutable, mutability is needed to mode to device
+            x = list(x)
+            y = list(y)
+
+            # move tensors with respect to gpu_mode
+            x[0], x[1], y[0], y[1], p = (self._move_to_device(t, gpu_mode=self.gpu_mode) for t in [x[0], x[1], y[0], y[1], p])
+            assert x[0].device == y[0].device == p.device, 'x, y and p must be on the same device'
+            assert x[1].device == y[1].device == p.device, 'x, y and p must be on the same device'
+
+            # <nx_i, ny_j>^2 = sum_{a,b} nx_i^a nx_i^b ny_j^a ny_j^b: one channel per (a <= b) pair and column of p.
+            dimension = x[0].size(1)
+            pairs = [(a, b) for a in range(dimension) for b in range(a, dimension)]
+            weights = torch.cat([(y[1][:, a] * y[1][:, b]).unsqueeze(1) * p for a, b in pairs], 1)
+
+            origin, shape = self._get_grid(x[0], y[0])
+            field = self._interpolate(self._convolve_grid(self._splat(y[0], weights, origin, shape)), x[0], origin)
+
+            res = 0.
+            for k, (a, b) in enumerate(pairs):
+                factor = 1. if a == b else 2.
+                res = res + factor * (x[1][:, a] * x[1][:, b]).unsqueeze(1) \
+                      * field[:, k * p.size(1):(k + 1) * p.size(1)]
+        else:
+            raise RuntimeError('Unknown kernel mode.')
+
+        return res.cpu() if self.gpu_mode is GpuMode.KERNEL else res
+
+    @loop_over_batch_dimension
+    def convolve_gradient(self, px, x, y=None, py=None):
+        if y is None:
+            y = x
+        if py is None:
+            py = px
+
+        # move tensors with respect to gpu_mode
+        x, px, y, py = (self._move_to_device(t, gpu_mode=self.gpu_mode) for t in [x, px, y, py])
+        assert px.device == x.device == y.device == py.device, 'tensors must be on the same device'
+
+        origin, shape = self._get_grid(x, y)
+        splatted = self._splat(y, py, origin, shape)
+        res = self._contract_gradient(splatted, px, x, origin)
+        return res.cpu() if self.gpu_mode is GpuMode.KERNEL else res
+
+    @loop_over_batch_dimension
+    def convolve_and_gradient(self, x, p):
+        # move tensors with respect to gpu_mode
+        x, p = (self._move_to_device(t, gpu_mode=self.gpu_mode) for t in [x, p])
+        assert x.device == p.device, 'x and p must be on the same device'
+
+        # The splatted momenta are shared by both reductions.
+        origin, shape = self._get_grid(x, x)
+        splatted = self._splat(x, p, origin, shape)
+        velocity = self._interpolate(self._convolve_grid(splatted), x, origin)
+        gradient = self._contract_gradient(splatted, p, x, origin)
+
+        if self.gpu_mode is GpuMode.KERNEL:
+            velocity, gradient = velocity.cpu(), gradient.cpu()
+        return velocity, gradient
+
+    ####################################################################################################################
+    ### Auxiliary methods:
+    ####################################################################################################################
+
+    def _get_grid_step(self):
+        return self.grid_spacing * self.kernel_width
+
+    def _get_grid(self, x, y):
+        """
+        Returns the origin and shape of a grid containing x and y, with a margin of one node.
+        """
+        h = self._get_grid_step()
+        with torch.no_grad():
+            y_min = torch.min(y.detach(), 0)[0]
+            all_min = torch.min(torch.min(x.detach(), 0)[0], y_min)
+            all_max = torch.max(torch.max(x.detach(), 0)[0], torch.max(y.detach(), 0)[0])
+            origin = y_min - h * (torch.ceil((y_min - all_min) / h) + 1)
+            shape = [int(n) for n in torch.floor((all_max - origin) / h) + 3]
+        return origin, shape
+
+    def _get_corners(self, points, origin, shape):
+        """
+        Yields the flat indices of the 2^D grid nodes around each point, with the corresponding multilinear weights.
+        """
+        cells = (points - origin) / self._get_grid_step()
+        base = torch.floor(cells.detach())
+        fractions = cells - base
+        base = base.long()
+
+        strides = [int(s) for s in torch.tensor(shape[1:] + [1]).flip(0).cumprod(0).flip(0)]
+        for corner in itertools.product([0, 1], repeat=points.size(1)):
+            indices = 0
+            weights = 1.
+            for d, c in enumerate(corner):
+                indices = indices + (base[:, d] + c) * strides[d]
+                weights = weights * (fractions[:, d] if c else 1 - fractions[:, d])
+            yield indices, weights
+
+    def _splat(self, points, values, origin, shape):
+        """
+        Returns the (C, n_1, ..., n_D) grid of the values, spread on the nodes around each point.
+        """
+        res = torch.zeros((reduce(mul, shape, 1), values.size(1)), dtype=values.dtype, device=values.device)
+        for indices, weights in self._get_corners(points, origin, shape):
+            res = res.index_add(0, indices, weights.unsqueeze(1) * values)
+        return res.t().reshape([values.size(1)] + shape)
+
+    def _interpolate(self, grid_values, points, origin):
+        """
+        Multilinear interpolation of the (C, n_1, ..., n_D) grid values at the points. Returns a (N, C) tensor.
+        """
+        flat_values = grid_values.reshape(grid_values.size(0), -1).t()
+        res = 0.
+        for indices, weights in self._get_corners(points, origin, list(grid_values.shape[1:])):
+            res = res + weights.unsqueeze(1) * flat_values[indices]
+        return res
+
+    def _get_taps(self, derivative=False, dtype=None, device=None):
+        """
+        Sampled gaussian exp(-u^2/s^2) (or its derivative), ordered for the cross-correlation of torch.conv1d.
+        """
+        h = self._get_grid_step()
+        radius = int(math.ceil(self.truncation_sigmas / self.grid_spacing))
+        u = torch.arange(radius, -radius - 1, -1, dtype=dtype, device=device) * h
+        taps = torch.exp(-u ** 2 / (self.kernel_width ** 2))
+        if derivative:
+            taps = - 2 * u / (self.kernel_width ** 2) * taps
+        return taps
+
+    def _convolve_grid(self, grid_values, derivative_dimension=None):
+        """
+        Separable convolution of the (C, n_1, ..., n_D) grid values with the gaussian, differentiated along
+        derivative_dimension if any.
+        """
+        res = grid_values
+        for d in range(grid_values.dim() - 1):
+            taps = self._get_taps(derivative=(d == derivative_dimension), dtype=res.dtype, device=res.device)
+            res = res.transpose(d + 1, -1)
+            transposed_shape = res.shape
+            res = torch.nn.functional.conv1d(res.reshape(-1, 1, res.size(-1)), taps.view(1, 1, -1),
+                                             padding=(taps.size(0) - 1) // 2)
+            res = res.reshape(transposed_shape).transpose(d + 1, -1)
+        return res
+
+    def _contract_gradient(self, splatted, px, x, origin):
+        """
+        Gradient of sum_j k(x_i, y_j) <px_i, py_j> with respect to x_i, from the splatted py: component a is the
+        derivative along a of the convolved field, contracted with px_i.
+        """
+        return torch.cat([torch.sum(px * self._interpolate(self._convolve_grid(splatted, derivative_dimension=a), x,
+                                                           origin), 1, keepdim=True)
+                          for a in range(x.size(1))], 1)
@@ -1,5 +1,6 @@
 import torch
 
+from ...support import utilities
 from ...support.kernels import AbstractKernel
 from ...core import default, GpuMode
 import pykeops.torch as pktorch
@@ -9,7 +10,41 @@ import logging
 logger = logging.getLogger(__name__)
 
 
+# name -> (formula, aliases with the dimension as a format field). The kernel width is the G parameter.
+reduction_formulas = {
+    'gaussian_convolve': ("Exp(-G*SqDist(X,Y)) * P",
+                          ["G = Pm(1)", "X = Vi({0})", "Y = Vj({0})", "P = Vj({0})"]),
+    'point_cloud_convolve': ("Exp(-G*SqDist(X,Y)) * P",
+                             ["G = Pm(1)", "X = Vi({0})", "Y = Vj({0})", "P = Vj(1)"]),
+    'varifold_convolve': ("Exp(-(WeightedSqDist(G, X, Y))) * Square((Nx|Ny)) * P",
+                          ["G = Pm(1)", "X = Vi({0})", "Y = Vj({0})", "Nx = Vi({0})", "Ny = Vj({0})", "P = Vj(1)"]),
+    'gaussian_convolve_gradient_x': ("(Px|Py) * Exp(-G*SqDist(X,Y)) * (X-Y)",
+                                     ["G = Pm(1)", "X = Vi({0})", "Y = Vj({0})", "Px = Vi({0})", "Py = Vj({0})"]),
+    'gaussian_convolve_and_gradient': ("Exp(-G*SqDist(X,Y)) * Concat(Py, (Px|Py) * (X-Y))",
+                                       ["G = Pm(1)", "X = Vi({0})", "Y = Vj({0})", "Px = Vi({0})", "Py = Vj({0})"])
+}
+
+# (name, dimension, cuda_type) -> Genred, shared by all the kernel instances of the process.
+reductions = {}
+
+
+def get_reduction(name, dimension, cuda_type):
+    """
+    Returns the requested reduction, built on first use. Compiled reductions are stored by keops in its build folder,
+    so that the compilation itself only happens once per machine.
+    """
+    key = (name, dimension, cuda_type)
+    if key not in reductions:
+        formula, aliases = reduction_formulas[name]
+        reductions[key] = pktorch.Genred(formula, [alias.format(dimension) for alias in aliases],
+                                         reduction_op='Sum', axis=1, cuda_type=cuda_type)
+    return reductions[key]
+
+
 class KeopsKernel(AbstractKernel):
+    # Maximum number of terms of the partial sums computed in float32, with float64 accumulation.
+    accumulation_tile_size = 4096
+
     def __init__(self, kernel_width=None, gpu_mode=default.gpu_mode, cuda_type=None, **kwargs):
         super().__init__(kernel_width, 'keops', gpu_mode)
 
@@ -20,47 +55,6 @@ class KeopsKernel(AbstractKernel):
 
         self.gamma = 1. / default.tensor_scalar_type([self.kernel_width ** 2])
 
-        self.gaussian_convolve = []
-        self.point_cloud_convolve = []
-        self.varifold_convolve = []
-        self.gaussian_convolve_gradient_x = []
-
-        for dimension in [2, 3]:
-            self.gaussian_convolve.append(pktorch.Genred(
-                "Exp(-G*SqDist(X,Y)) * P",
-                ["G = Pm(1)",
-                 "X = Vi(" + str(dimension) + ")",
-                 "Y = Vj(" + str(dimension) + ")",
-                 "P = Vj(" + str(dimension) + ")"],
-                reduction_op='Sum', axis=1, cuda_type=cuda_type))
-
-            self.point_cloud_convolve.append(pktorch.Genred(
-                "Exp(-G*SqDist(X,Y)) * P",
-                ["G = Pm(1)",
-                 "X = Vi(" + str(dimension) + ")",
-                 "Y = Vj(" + str(dimension) + ")",
-                 "P = Vj(1)"],
-                reduction_op='Sum', axis=1, cuda_type=cuda_type))
-
-            self.varifold_convolve.append(pktorch.Genred(
-                "Exp(-(WeightedSqDist(G, X, Y))) * Square((Nx|Ny)) * P",
-                ["G = Pm(1)",
-                 "X = Vi(" + str(dimension) + ")",
-                 "Y = Vj(" + str(dimension) + ")",
-                 "Nx = Vi(" + str(dimension) + ")",
-                 "Ny = Vj(" + str(dimension) + ")",
-                 "P = Vj(1)"],
-                reduction_op='Sum', axis=1, cuda_type=cuda_type))
-
-            self.gaussian_convolve_gradient_x.append(pktorch.Genred(
-                "(Px|Py) * Exp(-G*SqDist(X,Y)) * (X-Y)",
-                ["G = Pm(1)",
-                 "X = Vi(" + str(dimension) + ")",
-                 "Y = Vj(" + str(dimension) + ")",
-                 "Px = Vi(" + str(dimension) + ")",
-                 "Py = Vj(" + str(dimension) + ")"],
-                reduction_op='Sum', axis=1, cuda_type=cuda_type))
-
     def __eq__(self, other):
         return AbstractKernel.__eq__(self, other) and self.cuda_type == other.cuda_type
 
@@ -75,11 +69,12 @@ class KeopsKernel(AbstractKernel):
             assert x.device == y.device == p.device, 'tensors must be on the same device. x.device=' + str(x.device) \
                                                      + ', y.device=' + str(y.device) + ', p.device=' + str(p.device)
 
-            d = x.size(1)
+            d = x.size(-1)
             gamma = self.gamma.to(x.device, dtype=x.dtype)
+            (x, y, p), ranges, batch_shape = self._flatten_batch_dimension([x], [y, p])
 
-            device_id = x.device.index if x.device.index is not None else -1
-            res = self.gaussian_convolve[d - 2](gamma, x.contiguous(), y.contiguous(), p.contiguous(), device_id=device_id)
+            res = self._reduce('gaussian_convolve', d, gamma, x, y, p, ranges=ranges)
+            res = res.view(batch_shape + res.size()[-1:])
             return res.cpu() if self.gpu_mode is GpuMode.KERNEL else res
 
         elif mode == 'pointcloud':
@@ -92,11 +87,12 @@ class KeopsKernel(AbstractKernel):
             assert x.device == y.device == p.device, 'tensors must be on the same device. x.device=' + str(x.device) \
                                                      + ', y.device=' + str(y.device) + ', p.device=' + str(p.device)
 
-            d = x.size(1)
+            d = x.size(-1)
             gamma = self.gamma.to(x.device, dtype=x.dtype)
+            (x, y, p), ranges, batch_shape = self._flatten_batch_dimension([x], [y, p])
 
-            device_id = x.device.index if x.device.index is not None else -1
-            res = self.point_cloud_convolve[d - 2](gamma, x.contiguous(), y.contiguous(), p.contiguous(), device_id=device_id)
+            res = self._reduce('point_cloud_convolve', d, gamma, x, y, p, ranges=ranges)
+            res = res.view(batch_shape + res.size()[-1:])
             return res.cpu() if self.gpu_mode is GpuMode.KERNEL else res
 
         elif mode == 'varifold':
@@ -116,11 +112,12 @@ class KeopsKernel(AbstractKernel):
 
             x, nx = x
             y, ny = y
-            d = x.size(1)
+            d = x.size(-1)
             gamma = self.gamma.to(x.device, dtype=x.dtype)
+            (x, nx, y, ny, p), ranges, batch_shape = self._flatten_batch_dimension([x, nx], [y, ny, p])
 
-            device_id = x.device.index if x.device.index is not None else -1
-            res = self.varifold_convolve[d - 2](gamma, x.contiguous(), y.contiguous(), nx.contiguous(), ny.contiguous(), p.contiguous(), device_id=device_id)
+            res = self._reduce('varifold_convolve', d, gamma, x, y, nx, ny, p, ranges=ranges)
+            res = res.view(batch_shape + res.size()[-1:])
             return res.cpu() if self.gpu_mode is GpuMode.KERNEL else res
 
         else:
@@ -141,15 +138,90 @@ class KeopsKernel(AbstractKernel):
         x, px, y, py = (self._move_to_device(t, gpu_mode=self.gpu_mode) for t in [x, px, y, py])
         assert px.device == x.device == y.device == py.device, 'tensors must be on the same device'
 
-        d = x.size(1)
+        d = x.size(-1)
         gamma = self.gamma.to(x.device, dtype=x.dtype)
+        (x, px, y, py), ranges, batch_shape = self._flatten_batch_dimension([x, px], [y, py])
 
-        device_id = x.device.index if x.device.index is not None else -1
-        res = (-2 * gamma * self.gaussian_convolve_gradient_x[d - 2](gamma, x, y, px, py, device_id=device_id))
+        res = -2 * gamma * self._reduce('gaussian_convolve_gradient_x', d, gamma, x, y, px, py, ranges=ranges)
+        res = res.view(batch_shape + res.size()[-1:])
         return res.cpu() if self.gpu_mode is GpuMode.KERNEL else res
 
+    def convolve_and_gradient(self, x, p):
+        assert isinstance(x, torch.Tensor), 'x variable must be a torch Tensor'
+        assert isinstance(p, torch.Tensor), 'p variable must be a torch Tensor'
+
+        # move tensors with respect to gpu_mode
+        x, p = (self._move_to_device(t, gpu_mode=self.gpu_mode) for t in [x, p])
+        assert x.device == p.device, 'tensors must be on the same device'
+
+        d = x.size(-1)
+        gamma = self.gamma.to(x.device, dtype=x.dtype)
+        (x, p), ranges, batch_shape = self._flatten_batch_dimension([x, p], [])
+
+        res = self._reduce('gaussian_convolve_and_gradient', d, gamma, x, x, p, p, ranges=ranges)
+        res = res.view(batch_shape + res.size()[-1:])
+        res = res.cpu() if self.gpu_mode is GpuMode.KERNEL else res
+        return res[..., :d], -2 * gamma.to(res.device) * res[..., d:]
+
+    def _get_reduction(self, name, dimension):
+        return get_reduction(name, dimension, self.cuda_type)
+
+    def _reduce(self, name, dimension, gamma, *args, ranges=None):
+        """
+        Calls the reduction on args. With float64 accumulation of float32 tensors, the "j" variables are split in
+        chunks of accumulation_tile_size, whose partial sums are accumulated in float64. Batched calls are not split.
+        """
+        reduction = self._get_reduction(name, dimension)
+        device_id = args[0].device.index if args[0].device.index is not None else -1
+        accumulation_dtype = utilities.get_accumulation_dtype(args[0].dtype)
+        if accumulation_dtype == args[0].dtype or ranges is not None:
+            return reduction(gamma, *args, device_id=device_id, ranges=ranges)
+
+        # aliases of the args, after the G parameter.
+        j_indices = [k for k, alias in enumerate(reduction_formulas[name][1][1:]) if 'Vj' in alias]
+        n = args[j_indices[0]].size(0)
+        res = None
+        for start in range(0, n, self.accumulation_tile_size):
+            chunk = [arg[start:start + self.accumulation_tile_size] if k in j_indices else arg
+                     for k, arg in enumerate(args)]
+            partial_res = reduction(gamma, *chunk, device_id=device_id).to(accumulation_dtype)
+            res = partial_res if res is None else res + partial_res
+        return res.to(args[0].dtype)
+
+    def _flatten_batch_dimension(self, i_tensors, j_tensors):
+        """
+        KeOps reductions are two-dimensional: (B, M, D) "i" and (B, N, D) "j" tensors are flattened into (B.M, D) and
+        (B.N, D) ones, and the block-diagonal ranges restrict each row block b to the column block b.
+        Returns the contiguous tensors, the ranges (None without batch dimension) and the (B, M) or (M,) output shape.
+        """
+        tensors = self._broadcast_batch_dimension(*(i_tensors + j_tensors))
+        if tensors[0].dim() == 2:
+            return [t.contiguous() for t in tensors], None, tensors[0].size()[:1]
+
+        batch_size, m = tensors[0].size()[:2]
+        n = tensors[len(i_tensors)].size(1) if len(j_tensors) > 0 else m
+
+        batch_indices = torch.arange(batch_size, dtype=torch.int32, device=tensors[0].device)
+        slices = batch_indices + 1
+        ranges_i = torch.stack([batch_indices * m, (batch_indices + 1) * m], 1)
+        ranges_j = torch.stack([batch_indices * n, (batch_indices + 1) * n], 1)
+        ranges = (ranges_i, slices, ranges_j, ranges_j, slices, ranges_i)
+
+        return [t.contiguous().view(-1, t.size(-1)) for t in tensors], ranges, tensors[0].size()[:2]
+
+
+# result of the keops setup test, run at most once per process.
+keops_setup_status = None
+
 
 def test_keops_setup(verbose=False):
+    global keops_setup_status
+    if keops_setup_status is None:
+        keops_setup_status = _run_keops_setup_test(verbose)
+    return keops_setup_status
+
+
+def _run_keops_setup_test(verbose):
     try:
         # test from https://www.kernel-operations.io/keops/python/installation.html#testing-your-installation
         x = torch.arange(1, 10, dtype=torch.float32).view(-1, 3)
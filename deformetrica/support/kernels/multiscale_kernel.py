@@ -0,0 +1,68 @@
+import logging
+
+from ...core import default
+from ...support.kernels.abstract_kernel import AbstractKernel
+from ...support.kernels.torch_kernel import TorchKernel, gaussian
+
+logger = logging.getLogger(__name__)
+
+
+class MultiScaleKernel(TorchKernel):
+    """
+    Sum of gaussian kernels: k(x, y) = sum_k w_k exp(-|x-y|^2/s_k^2), the weights summing to one by default.
+    All the scales are evaluated in a single pass over the point pairs: squared distances, differences and matrix
+    products are shared, only the exponentials are computed once per scale. Tiling and analytic backward passes are
+    the ones of TorchKernel.
+    kernel_width defaults to the smallest of the kernel_widths, e.g. for the control points spacing.
+    """
+
+    ####################################################################################################################
+    ### Constructor:
+    ####################################################################################################################
+
+    def __init__(self, kernel_width=None, gpu_mode=default.gpu_mode, kernel_widths=None, weights=None,
+                 memory_budget=None, **kwargs):
+        if kernel_widths is None:
+            logger.info('No kernel_widths given to the multiscale kernel: it reduces to a single gaussian of width %s.'
+                        % kernel_width)
+            kernel_widths = [kernel_width]
+        if kernel_width is None:
+            kernel_width = min(kernel_widths)
+        if weights is None:
+            weights = [1. / len(kernel_widths)] * len(kernel_widths)
+        assert len(weights) == len(kernel_widths), 'there must be one weight per kernel width'
+
+        AbstractKernel.__init__(self, kernel_width, 'multiscale', gpu_mode)
+        self.kernel_widths = tuple(kernel_widths)
+        self.weights = tuple(weights)
+        self.memory_budget = memory_budget
+
+    def __eq__(self, other):
+        return TorchKernel.__eq__(self, other) \
+               and self.kernel_widths == other.kernel_widths \
+               and self.weights == other.weights
+
+    def __hash__(self, **kwargs):
+        return TorchKernel.__hash__(self, kernel_widths=self.kernel_widths, weights=self.weights, **kwargs)
+
+    ####################################################################################################################
+    ### Public methods:
+    ####################################################################################################################
+
+    def get_kernel_matrix(self, x, y=None):
+        if y is None:
+            y = x
+        return self._kernel_and_derivatives(self._squared_distances(x, y))[0]
+
+    ####################################################################################################################
+    ### Auxiliary methods:
+    ####################################################################################################################
+
+    def _kernel_and_derivatives(self, sq, order=0):
+        res = [0.] * (order + 1)
+        for kernel_width, weight in zip(self.kernel_widths, self.weights):
+            A = weight * gaussian(sq, kernel_width)
+            res[0] = res[0] + A
+            for k in range(1, order + 1):
+                res[k] = res[k] + A * (- 1. / kernel_width ** 2) ** k
+        return res
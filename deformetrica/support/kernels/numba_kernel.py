@@ -0,0 +1,384 @@
+import logging
+import math
+import numpy as np
+import torch
+
+from ...core import default, GpuMode
+from ...support.kernels.abstract_kernel import AbstractKernel, loop_over_batch_dimension
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+logger = logging.getLogger(__name__)
+
+
+def jit(function):
+    """
+    Compiles function with numba, on first call, with parallel loops. Compiled functions are cached on disk.
+    """
+    return numba.njit(parallel=True, cache=True)(function) if numba is not None else function
+
+
+prange = numba.prange if numba is not None else range
+
+# Side of the square tiles of (x, y) point pairs: the loops run in parallel over tiles of rows, and each thread sweeps
+# the tiles of columns, so that the columns of a tile stay in cache while all the rows of the tile are visited.
+tile_size = 128
+
+
+def test_numba_setup():
+    return numba is not None
+
+
+class NumbaKernel(AbstractKernel):
+    """
+    Gaussian kernel evaluated on cpu by numba-compiled loops, parallel over tiles of output points and tiled over the
+    input points. The kernel is computed on the fly and never stored: memory is linear in the number of points, and
+    reductions are accumulated in float64. convolve_and_gradient computes both reductions of a shooting step in a
+    single pass. Backward passes are analytic, and evaluated with the same loops. The gpu mode is not used: tensors on
+    gpu are moved to cpu for the computation and the results moved back.
+    """
+
+    ####################################################################################################################
+    ### Constructor:
+    ####################################################################################################################
+
+    def __init__(self, kernel_width=None, gpu_mode=default.gpu_mode, **kwargs):
+        if numba is None:
+            raise RuntimeError('The numba kernel type requires the numba package.')
+        super().__init__(kernel_width, 'numba', gpu_mode)
+        if gpu_mode in [GpuMode.FULL, GpuMode.KERNEL] and torch.cuda.is_available():
+            logger.warning('The numba kernel only runs on cpu: the %s gpu mode is ignored.' % gpu_mode.name)
+
+    ####################################################################################################################
+    ### Public methods:
+    ####################################################################################################################
+
+    @loop_over_batch_dimension
+    def convolve(self, x, y, p, mode='gaussian'):
+        if mode in ['gaussian', 'pointcloud']:
+            return NumbaGaussianConvolution.apply(x, y, p, self)
+
+        elif mode == 'varifold':
+            assert isinstance(x, tuple), 'x must be a tuple'
+            assert len(x) == 2, 'tuple length must be 2'
+            assert isinstance(y, tuple), 'y must be a tuple'
+            assert len(y) == 2, 'tuple length must be 2'
+            return NumbaVarifoldConvolution.apply(x[0], x[1], y[0], y[1], p, self)
+
+        else:
+            raise RuntimeError('Unknown kernel mode.')
+
+    @loop_over_batch_dimension
+    def convolve_gradient(self, px, x, y=None, py=None):
+        if y is None:
+            y = x
+        if py is None:
+            py = px
+        return NumbaGaussianConvolutionGradient.apply(px, x, y, py, self)
+
+    @loop_over_batch_dimension
+    def convolve_and_gradient(self, x, p):
+        return NumbaGaussianConvolutionAndGradient.apply(x, p, self)
+
+    ####################################################################################################################
+    ### Auxiliary methods:
+    ####################################################################################################################
+
+    def _call(self, function, *tensors):
+        """
+        Calls a compiled function on the cpu numpy arrays of tensors. Results are converted back to tensors of the
+        dtype and device of the first one.
+        """
+        dtype, device = tensors[0].dtype, tensors[0].device
+        arrays = [np.ascontiguousarray(t.detach().cpu().numpy()) for t in tensors]
+        res = function(*arrays, 1. / self.kernel_width ** 2)
+        if isinstance(res, tuple):
+            return tuple(torch.from_numpy(r).to(dtype=dtype, device=device) for r in res)
+        return torch.from_numpy(res).to(dtype=dtype, device=device)
+
+
+class NumbaGaussianConvolution(torch.autograd.Function):
+    """
+    sum_j k(x_i, y_j) p_j. The objective sum_ij k(x_i, y_j) <g_i, p_j> is symmetric in (x, g) and (y, p): the
+    gradients with respect to x and y are both convolution gradients.
+    """
+
+    @staticmethod
+    def forward(ctx, x, y, p, kernel):
+        ctx.save_for_backward(x, y, p)
+        ctx.kernel = kernel
+        return kernel._call(gaussian_convolve, x, y, p)
+
+    @staticmethod
+    @torch.autograd.function.once_differentiable
+    def backward(ctx, grad_output):
+        x, y, p = ctx.saved_tensors
+        kernel = ctx.kernel
+        needs_grad = ctx.needs_input_grad
+        g = grad_output.contiguous()
+        grad_x = kernel._call(gaussian_convolve_gradient, g, x, y, p) if needs_grad[0] else None
+        grad_y = kernel._call(gaussian_convolve_gradient, p, y, x, g) if needs_grad[1] else None
+        grad_p = kernel._call(gaussian_convolve, y, x, g) if needs_grad[2] else None
+        return grad_x, grad_y, grad_p, None
+
+
+class NumbaVarifoldConvolution(torch.autograd.Function):
+    """
+    sum_j k(x_i, y_j) <nx_i, ny_j>^2 p_j. The objective is symmetric in (x, nx, g) and (y, ny, p).
+    """
+
+    @staticmethod
+    def forward(ctx, x, nx, y, ny, p, kernel):
+        ctx.save_for_backward(x, nx, y, ny, p)
+        ctx.kernel = kernel
+        return kernel._call(varifold_convolve, x, nx, y, ny, p)
+
+    @staticmethod
+    @torch.autograd.function.once_differentiable
+    def backward(ctx, grad_output):
+        x, nx, y, ny, p = ctx.saved_tensors
+        kernel = ctx.kernel
+        needs_grad = ctx.needs_input_grad
+        g = grad_output.contiguous()
+        grad_x, grad_nx, grad_y, grad_ny, grad_p = None, None, None, None, None
+        if needs_grad[0] or needs_grad[1]:
+            grad_x, grad_nx = kernel._call(varifold_convolve_backward, x, nx, g, y, ny, p)
+        if needs_grad[2] or needs_grad[3]:
+            grad_y, grad_ny = kernel._call(varifold_convolve_backward, y, ny, p, x, nx, g)
+        if needs_grad[4]:
+            grad_p = kernel._call(varifold_convolve, y, ny, x, nx, g)
+        return grad_x, grad_nx, grad_y, grad_ny, grad_p, None
+
+
+class NumbaGaussianConvolutionGradient(torch.autograd.Function):
+    """
+    Gradient of sum_j k(x_i, y_j) <px_i, py_j> with respect to x_i.
+    """
+
+    @staticmethod
+    def forward(ctx, px, x, y, py, kernel):
+        ctx.save_for_backward(px, x, y, py)
+        ctx.kernel = kernel
+        return kernel._call(gaussian_convolve_gradient, px, x, y, py)
+
+    @staticmethod
+    @torch.autograd.function.once_differentiable
+    def backward(ctx, grad_output):
+        px, x, y, py = ctx.saved_tensors
+        kernel = ctx.kernel
+        needs_grad = ctx.needs_input_grad
+        g = grad_output.contiguous()
+        grad_px, grad_x, grad_y, grad_py = None, None, None, None
+        if needs_grad[0] or needs_grad[1]:
+            grad_px, grad_x = kernel._call(gaussian_convolve_gradient_backward_rows, px, x, y, py, g)
+        if needs_grad[2] or needs_grad[3]:
+            grad_py, grad_y = kernel._call(gaussian_convolve_gradient_backward_columns, px, x, y, py, g)
+        return grad_px, grad_x, grad_y, grad_py, None
+
+
+class NumbaGaussianConvolutionAndGradient(torch.autograd.Function):
+    """
+    Both sum_j k(x_i, x_j) p_j and the gradient of sum_ij k(x_i, x_j) <p_i, p_j> / 2 with respect to x_i, computed in a
+    single pass. The backward pass sums the ones of the two reductions.
+    """
+
+    @staticmethod
+    def forward(ctx, x, p, kernel):
+        ctx.save_for_backward(x, p)
+        ctx.kernel = kernel
+        return kernel._call(gaussian_convolve_and_gradient, x, p)
+
+    @staticmethod
+    @torch.autograd.function.once_differentiable
+    def backward(ctx, grad_velocity, grad_gradient):
+        x, p = ctx.saved_tensors
+        kernel = ctx.kernel
+        grad_x, grad_p = torch.zeros_like(x), torch.zeros_like(p)
+        if grad_velocity is not None:
+            g = grad_velocity.contiguous()
+            grad_x = grad_x + kernel._call(gaussian_convolve_gradient, g, x, x, p) \
+                     + kernel._call(gaussian_convolve_gradient, p, x, x, g)
+            grad_p = grad_p + kernel._call(gaussian_convolve, x, x, g)
+        if grad_gradient is not None:
+            g = grad_gradient.contiguous()
+            grad_px, grad_x_rows = kernel._call(gaussian_convolve_gradient_backward_rows, p, x, x, p, g)
+            grad_py, grad_x_columns = kernel._call(gaussian_convolve_gradient_backward_columns, p, x, x, p, g)
+            grad_x = grad_x + grad_x_rows + grad_x_columns
+            grad_p = grad_p + grad_px + grad_py
+        return grad_x, grad_p, None
+
+
+########################################################################################################################
+### Compiled reductions, on (M, D) and (N, D) arrays, with c = 1 / kernel_width^2. Each thread owns a tile of rows,
+### and sweeps it tile of columns by tile of columns.
+########################################################################################################################
+
+@jit
+def gaussian_convolve(x, y, p, c):
+    m, n, d, dp = x.shape[0], y.shape[0], x.shape[1], p.shape[1]
+    res = np.zeros((m, dp))
+    for row_tile in prange((m + tile_size - 1) // tile_size):
+        for column_start in range(0, n, tile_size):
+            for i in range(row_tile * tile_size, min(m, (row_tile + 1) * tile_size)):
+                for j in range(column_start, min(n, column_start + tile_size)):
+                    sq = 0.
+                    for k in range(d):
+                        sq += (x[i, k] - y[j, k]) ** 2
+                    a = math.exp(- c * sq)
+                    for k in range(dp):
+                        res[i, k] += a * p[j, k]
+    return res
+
+
+@jit
+def varifold_convolve(x, nx, y, ny, p, c):
+    m, n, d, dp = x.shape[0], y.shape[0], x.shape[1], p.shape[1]
+    res = np.zeros((m, dp))
+    for row_tile in prange((m + tile_size - 1) // tile_size):
+        for column_start in range(0, n, tile_size):
+            for i in range(row_tile * tile_size, min(m, (row_tile + 1) * tile_size)):
+                for j in range(column_start, min(n, column_start + tile_size)):
+                    sq = 0.
+                    prs = 0.
+                    for k in range(d):
+                        sq += (x[i, k] - y[j, k]) ** 2
+                        prs += nx[i, k] * ny[j, k]
+                    a = math.exp(- c * sq) * prs * prs
+                    for k in range(dp):
+                        res[i, k] += a * p[j, k]
+    return res
+
+
+@jit
+def gaussian_convolve_gradient(px, x, y, py, c):
+    """
+    -2c sum_j k(x_i, y_j) <px_i, py_j> (x_i - y_j)
+    """
+    m, n, d, dp = x.shape[0], y.shape[0], x.shape[1], px.shape[1]
+    res = np.zeros((m, d))
+    for row_tile in prange((m + tile_size - 1) // tile_size):
+        for column_start in range(0, n, tile_size):
+            for i in range(row_tile * tile_size, min(m, (row_tile + 1) * tile_size)):
+                for j in range(column_start, min(n, column_start + tile_size)):
+                    sq = 0.
+                    for k in range(d):
+                        sq += (x[i, k] - y[j, k]) ** 2
+                    prs = 0.
+                    for k in range(dp):
+                        prs += px[i, k] * py[j, k]
+                    a = - 2. * c * math.exp(- c * sq) * prs
+                    for k in range(d):
+                        res[i, k] += a * (x[i, k] - y[j, k])
+    return res
+
+
+@jit
+def gaussian_convolve_and_gradient(x, p, c):
+    """
+    sum_j k(x_i, x_j) p_j and -2c sum_j k(x_i, x_j) <p_i, p_j> (x_i - x_j), sharing the kernel evaluations.
+    """
+    m, d, dp = x.shape[0], x.shape[1], p.shape[1]
+    velocity = np.zeros((m, dp))
+    gradient = np.zeros((m, d))
+    for row_tile in prange((m + tile_size - 1) // tile_size):
+        for column_start in range(0, m, tile_size):
+            for i in range(row_tile * tile_size, min(m, (row_tile + 1) * tile_size)):
+                for j in range(column_start, min(m, column_start + tile_size)):
+                    sq = 0.
+                    for k in range(d):
+                        sq += (x[i, k] - x[j, k]) ** 2
+                    a = math.exp(- c * sq)
+                    prs = 0.
+                    for k in range(dp):
+                        velocity[i, k] += a * p[j, k]
+                        prs += p[i, k] * p[j, k]
+                    b = - 2. * c * a * prs
+                    for k in range(d):
+                        gradient[i, k] += b * (x[i, k] - x[j, k])
+    return velocity, gradient
+
+
+@jit
+def varifold_convolve_backward(x, nx, g, y, ny, p, c):
+    """
+    Gradients of sum_ij k(x_i, y_j) <nx_i, ny_j>^2 <g_i, p_j> with respect to x_i and nx_i.
+    """
+    m, n, d, dp = x.shape[0], y.shape[0], x.shape[1], p.shape[1]
+    grad_x = np.zeros((m, d))
+    grad_nx = np.zeros((m, d))
+    for row_tile in prange((m + tile_size - 1) // tile_size):
+        for column_start in range(0, n, tile_size):
+            for i in range(row_tile * tile_size, min(m, (row_tile + 1) * tile_size)):
+                for j in range(column_start, min(n, column_start + tile_size)):
+                    sq = 0.
+                    prs = 0.
+                    for k in range(d):
+                        sq += (x[i, k] - y[j, k]) ** 2
+                        prs += nx[i, k] * ny[j, k]
+                    w = 0.
+                    for k in range(dp):
+                        w += g[i, k] * p[j, k]
+                    a = math.exp(- c * sq) * w
+                    for k in range(d):
+                        grad_x[i, k] += - 2. * c * a * prs * prs * (x[i, k] - y[j, k])
+                        grad_nx[i, k] += 2. * a * prs * ny[j, k]
+    return grad_x, grad_nx
+
+
+@jit
+def gaussian_convolve_gradient_backward_rows(px, x, y, py, g, c):
+    """
+    Gradients of sum_ij -2c k(x_i, y_j) <px_i, py_j> <g_i, x_i - y_j> with respect to px_i and x_i.
+    """
+    m, n, d, dp = x.shape[0], y.shape[0], x.shape[1], px.shape[1]
+    grad_px = np.zeros((m, dp))
+    grad_x = np.zeros((m, d))
+    for row_tile in prange((m + tile_size - 1) // tile_size):
+        for column_start in range(0, n, tile_size):
+            for i in range(row_tile * tile_size, min(m, (row_tile + 1) * tile_size)):
+                for j in range(column_start, min(n, column_start + tile_size)):
+                    sq = 0.
+                    gd = 0.
+                    for k in range(d):
+                        sq += (x[i, k] - y[j, k]) ** 2
+                        gd += g[i, k] * (x[i, k] - y[j, k])
+                    prs = 0.
+                    for k in range(dp):
+                        prs += px[i, k] * py[j, k]
+                    a = - 2. * c * math.exp(- c * sq)
+                    for k in range(dp):
+                        grad_px[i, k] += a * gd * py[j, k]
+                    for k in range(d):
+                        grad_x[i, k] += a * prs * (g[i, k] - 2. * c * gd * (x[i, k] - y[j, k]))
+    return grad_px, grad_x
+
+
+@jit
+def gaussian_convolve_gradient_backward_columns(px, x, y, py, g, c):
+    """
+    Gradients of sum_ij -2c k(x_i, y_j) <px_i, py_j> <g_i, x_i - y_j> with respect to py_j and y_j.
+    """
+    m, n, d, dp = x.shape[0], y.shape[0], x.shape[1], px.shape[1]
+    grad_py = np.zeros((n, dp))
+    grad_y = np.zeros((n, d))
+    for column_tile in prange((n + tile_size - 1) // tile_size):
+        for row_start in range(0, m, tile_size):
+            for j in range(column_tile * tile_size, min(n, (column_tile + 1) * tile_size)):
+                for i in range(row_start, min(m, row_start + tile_size)):
+                    sq = 0.
+                    gd = 0.
+                    for k in range(d):
+                        sq += (x[i, k] - y[j, k]) ** 2
+                        gd += g[i, k] * (x[i, k] - y[j, k])
+                    prs = 0.
+                    for k in range(dp):
+                        prs += px[i, k] * py[j, k]
+                    a = - 2. * c * math.exp(- c * sq)
+                    for k in range(dp):
+                        grad_py[j, k] += a * gd * px[i, k]
+                    for k in range(d):
+                        grad_y[j, k] += - a * prs * (g[i, k] - 2. * c * gd * (x[i, k] - y[j, k]))
+    return grad_py, grad_y
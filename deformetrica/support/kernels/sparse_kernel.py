@@ -0,0 +1,208 @@
+import itertools
+import logging
+import torch
+
+from ...core import GpuMode, default
+from ...support.kernels.abstract_kernel import AbstractKernel, loop_over_batch_dimension
+
+logger = logging.getLogger(__name__)
+
+
+class SparseKernel(AbstractKernel):
+    """
+    Gaussian kernel truncated at truncation_sigmas * kernel_width. Interacting pairs are found with a uniform grid of
+    cells (cell list), so that convolutions cost O(number of neighbors) instead of O(N.M).
+    Neighbor lists are built with an extra skin and reused until some point has moved by more than half of it, which
+    avoids rebuilding them at every step of a shooting.
+    """
+
+    ####################################################################################################################
+    ### Constructor:
+    ####################################################################################################################
+
+    def __init__(self, kernel_width=None, gpu_mode=default.gpu_mode, truncation_sigmas=3., neighbor_skin=0.5,
+                 **kwargs):
+        super().__init__(kernel_width, 'sparse', gpu_mode)
+        self.truncation_sigmas = truncation_sigmas
+        # Skin of the neighbor lists, in kernel width units.
+        self.neighbor_skin = neighbor_skin
+        # (x size, y size, device) -> (x, y, i, j): reference positions and pairs of the last built neighbor list.
+        self._neighbor_lists = {}
+
+    def __eq__(self, other):
+        return AbstractKernel.__eq__(self, other) \
+               and self.truncation_sigmas == other.truncation_sigmas \
+               and self.neighbor_skin == other.neighbor_skin
+
+    def __hash__(self, **kwargs):
+        return AbstractKernel.__hash__(self, truncation_sigmas=self.truncation_sigmas,
+                                       neighbor_skin=self.neighbor_skin, **kwargs)
+
+    ####################################################################################################################
+    ### Public methods:
+    ####################################################################################################################
+
+    @loop_over_batch_dimension
+    def convolve(self, x, y, p, mode='gaussian'):
+        res = None
+
+        if mode in ['gaussian', 'pointcloud']:
+            # move tensors with respect to gpu_mode
+            x, y, p = (self._move_to_device(t, gpu_mode=self.gpu_mode) for t in [x, y, p])
+            assert x.device == y.device == p.device, 'x, y and p must be on the same device'
+
+            i, j, k = self._get_neighbor_weights(x, y)
+            res = torch.zeros((x.size(0), p.size(1)), dtype=p.dtype, device=p.device) \
+                .index_add(0, i, k.unsqueeze(1) * p[j])
+
+        elif mode == 'varifold':
+            assert isinstance(x, tuple), 'x must be a tuple'
+            assert len(x) == 2, 'tuple length must be 2'
+            assert isinstance(y, tuple), 'y must be a tuple'
+            assert len(y) == 2, 'tuple length must be 2'
+
+            # tuples are immutable, mutability is needed to mode to device
+            x = list(x)
+            y = list(y)
+
+            # move tensors with respect to gpu_mode
+            x[0], x[1], y[0], y[1], p = (self._move_to_device(t, gpu_mode=self.gpu_mode) for t in [x[0], x[1], y[0], y[1], p])
+            assert x[0].device == y[0].device == p.device, 'x, y and p must be on the same device'
+            assert x[1].device == y[1].device == p.device, 'x, y and p must be on the same device'
+
+            i, j, k = self._get_neighbor_weights(x[0], y[0])
+            prs = torch.sum(x[1][i] * y[1][j], 1)
+            res = torch.zeros((x[0].size(0), p.size(1)), dtype=p.dtype, device=p.device) \
+                .index_add(0, i, (k * prs * prs).unsqueeze(1) * p[j])
+        else:
+            raise RuntimeError('Unknown kernel mode.')
+
+        return res.cpu() if self.gpu_mode is GpuMode.KERNEL else res
+
+    @loop_over_batch_dimension
+    def convolve_gradient(self, px, x, y=None, py=None):
+        if y is None:
+            y = x
+        if py is None:
+            py = px
+
+        # move tensors with respect to gpu_mode
+        x, px, y, py = (self._move_to_device(t, gpu_mode=self.gpu_mode) for t in [x, px, y, py])
+        assert px.device == x.device == y.device == py.device, 'tensors must be on the same device'
+
+        i, j, k = self._get_neighbor_weights(x, y)
+        weights = - 2 * k * torch.sum(px[i] * py[j], 1) / (self.kernel_width ** 2)
+        res = torch.zeros_like(x).index_add(0, i, weights.unsqueeze(1) * (x[i] - y[j]))
+        return res.cpu() if self.gpu_mode is GpuMode.KERNEL else res
+
+    @loop_over_batch_dimension
+    def convolve_and_gradient(self, x, p):
+        # move tensors with respect to gpu_mode
+        x, p = (self._move_to_device(t, gpu_mode=self.gpu_mode) for t in [x, p])
+        assert x.device == p.device, 'x and p must be on the same device'
+
+        # The neighbor pairs and weights are shared by both reductions.
+        i, j, k = self._get_neighbor_weights(x, x)
+        velocity = torch.zeros_like(p).index_add(0, i, k.unsqueeze(1) * p[j])
+        weights = - 2 * k * torch.sum(p[i] * p[j], 1) / (self.kernel_width ** 2)
+        gradient = torch.zeros_like(x).index_add(0, i, weights.unsqueeze(1) * (x[i] - x[j]))
+
+        if self.gpu_mode is GpuMode.KERNEL:
+            velocity, gradient = velocity.cpu(), gradient.cpu()
+        return velocity, gradient
+
+    ####################################################################################################################
+    ### Auxiliary methods:
+    ####################################################################################################################
+
+    def _get_neighbor_weights(self, x, y):
+        """
+        Returns the (i, j) indices of the pairs within the truncation radius, and the corresponding kernel values.
+        """
+        i, j = self._get_neighbor_list(x, y)
+        sq = torch.sum((x[i] - y[j]) ** 2, 1)
+        k = torch.exp(-sq / (self.kernel_width ** 2))
+        # pairs of the skin are zeroed: results do not depend on when the neighbor list was built.
+        k = k * (sq < (self.truncation_sigmas * self.kernel_width) ** 2).type(k.dtype)
+        return i, j, k
+
+    def _get_neighbor_list(self, x, y):
+        """
+        Returns a neighbor list that contains all the pairs within the truncation radius, reusing the previous one
+        built for points of the same sizes when no point has moved by more than half of the skin since then.
+        """
+        key = (x.size(0), y.size(0), x.device)
+        skin = self.neighbor_skin * self.kernel_width
+
+        if key in self._neighbor_lists:
+            x_ref, y_ref, i, j = self._neighbor_lists[key]
+            with torch.no_grad():
+                max_displacement = max(self._max_displacement(x, x_ref), self._max_displacement(y, y_ref))
+            if max_displacement < 0.5 * skin:
+                return i, j
+
+        with torch.no_grad():
+            x_ref, y_ref = x.detach().clone(), y.detach().clone()
+            i, j = self._build_neighbor_list(x_ref, y_ref, self.truncation_sigmas * self.kernel_width + skin)
+        self._neighbor_lists[key] = (x_ref, y_ref, i, j)
+        return i, j
+
+    @staticmethod
+    def _max_displacement(t, t_ref):
+        if t.dtype != t_ref.dtype:
+            return float('inf')
+        return float(torch.max(torch.sqrt(torch.sum((t.detach() - t_ref) ** 2, 1)))) if t.size(0) > 0 else 0.
+
+    @staticmethod
+    def _build_neighbor_list(x, y, cutoff):
+        """
+        Cell list: y is sorted by cell index, and each x is paired with the y of the 3^D cells around its own.
+        """
+        dimension = x.size(1)
+        origin = torch.min(torch.min(x, 0)[0], torch.min(y, 0)[0])
+
+        # cells are shifted by one, so that the neighbors of any cell have non-negative coordinates.
+        x_cells = torch.floor((x - origin) / cutoff).long() + 1
+        y_cells = torch.floor((y - origin) / cutoff).long() + 1
+        grid_size = torch.max(torch.max(x_cells, 0)[0], torch.max(y_cells, 0)[0]) + 2
+        strides = torch.ones(dimension, dtype=torch.long, device=x.device)
+        for d in range(1, dimension):
+            strides[d] = strides[d - 1] * grid_size[d - 1]
+
+        y_keys, y_order = torch.sort(torch.sum(y_cells * strides, 1))
+
+        offsets = torch.tensor(list(itertools.product([-1, 0, 1], repeat=dimension)), dtype=torch.long,
+                               device=x.device)
+        neighbor_keys = torch.sum((x_cells.unsqueeze(1) + offsets.unsqueeze(0)) * strides, 2).view(-1)
+        starts = SparseKernel._searchsorted(y_keys, neighbor_keys)
+        counts = SparseKernel._searchsorted(y_keys, neighbor_keys, right=True) - starts
+
+        # expands every (x, neighbor cell) block into its candidate pairs.
+        if hasattr(torch, 'repeat_interleave'):
+            blocks = torch.repeat_interleave(torch.arange(neighbor_keys.size(0), device=x.device), counts)
+        else:
+            # torch.repeat_interleave appeared in torch 1.1.
+            blocks = SparseKernel._searchsorted(torch.cumsum(counts, 0),
+                                                torch.arange(int(torch.sum(counts)), device=x.device), right=True)
+        positions = torch.arange(blocks.size(0), device=x.device) - (torch.cumsum(counts, 0) - counts)[blocks]
+        i = blocks // offsets.size(0)
+        j = y_order[starts[blocks] + positions]
+
+        within_cutoff = torch.sum((x[i] - y[j]) ** 2, 1) < cutoff ** 2
+        return i[within_cutoff], j[within_cutoff]
+
+    @staticmethod
+    def _searchsorted(sorted_sequence, values, right=False, chunk_size=2 ** 24):
+        """
+        Indices of insertion of the values in the sorted_sequence, before (or after when right is set) equal elements.
+        """
+        if hasattr(torch, 'searchsorted'):
+            return torch.searchsorted(sorted_sequence, values, right=right)
+
+        # torch.searchsorted appeared in torch 1.6: the elements before each value are counted instead, by chunks of
+        # values whose comparison matrices have at most chunk_size elements.
+        number_of_values = max(1, chunk_size // max(1, sorted_sequence.size(0)))
+        return torch.cat([torch.sum((sorted_sequence.unsqueeze(0) <= chunk.unsqueeze(1)) if right
+                                    else (sorted_sequence.unsqueeze(0) < chunk.unsqueeze(1)), 1)
+                          for chunk in torch.split(values, number_of_values)]) if values.size(0) > 0 \
+            else values.new_zeros(0)
@@ -2,6 +2,7 @@ import logging
 import torch
 
 from ...core import GpuMode, default
+from ...support import utilities
 from ...support.kernels.abstract_kernel import AbstractKernel
 
 logger = logging.getLogger(__name__)
@@ -16,12 +17,24 @@ def binet(prs):
 
 
 class TorchKernel(AbstractKernel):
+    # Maximum number of terms of the partial sums computed in float32, with float64 accumulation.
+    accumulation_tile_size = 1024
+
     ####################################################################################################################
     ### Constructor:
     ####################################################################################################################
 
-    def __init__(self, kernel_width=None, gpu_mode=default.gpu_mode, **kwargs):
+    def __init__(self, kernel_width=None, gpu_mode=default.gpu_mode, memory_budget=None, **kwargs):
         super().__init__(kernel_width, 'torch', gpu_mode)
+        # Maximum size in bytes of the pairwise temporaries. When None, the full kernel matrix is materialized, but it is
+        # never saved for backward: the autograd functions below recompute it.
+        self.memory_budget = memory_budget
+
+    def __eq__(self, other):
+        return AbstractKernel.__eq__(self, other) and self.memory_budget == other.memory_budget
+
+    def __hash__(self, **kwargs):
+        return AbstractKernel.__hash__(self, memory_budget=self.memory_budget, **kwargs)
 
     ####################################################################################################################
     ### Public methods:
@@ -34,10 +47,9 @@ class TorchKernel(AbstractKernel):
             # move tensors with respect to gpu_mode
             x, y, p = (self._move_to_device(t, gpu_mode=self.gpu_mode) for t in [x, y, p])
             assert x.device == y.device == p.device, 'x, y and p must be on the same device'
+            x, y, p = self._broadcast_batch_dimension(x, y, p)
 
-            sq = self._squared_distances(x, y)
-            res = torch.mm(torch.exp(-sq / (self.kernel_width ** 2)), p)
-            # res = torch.mm(1.0 / (1 + sq / self.kernel_width ** 2), p)
+            res = GaussianConvolution.apply(x, y, p, self)
 
         elif mode == 'varifold':
             assert isinstance(x, tuple), 'x must be a tuple'
@@ -53,9 +65,9 @@ class TorchKernel(AbstractKernel):
             x[0], x[1], y[0], y[1], p = (self._move_to_device(t, gpu_mode=self.gpu_mode) for t in [x[0], x[1], y[0], y[1], p])
             assert x[0].device == y[0].device == p.device, 'x, y and p must be on the same device'
             assert x[1].device == y[1].device == p.device, 'x, y and p must be on the same device'
+            x[0], x[1], y[0], y[1], p = self._broadcast_batch_dimension(x[0], x[1], y[0], y[1], p)
 
-            sq = self._squared_distances(x[0], y[0])
-            res = torch.mm(gaussian(sq, self.kernel_width) * binet(torch.mm(x[1], torch.t(y[1]))), p)
+            res = VarifoldConvolution.apply(x[0], x[1], y[0], y[1], p, self)
         else:
             raise RuntimeError('Unknown kernel mode.')
 
@@ -70,28 +82,297 @@ class TorchKernel(AbstractKernel):
         # move tensors with respect to gpu_mode
         x, px, y, py = (self._move_to_device(t, gpu_mode=self.gpu_mode) for t in [x, px, y, py])
         assert px.device == x.device == y.device == py.device, 'tensors must be on the same device'
+        px, x, y, py = self._broadcast_batch_dimension(px, x, y, py)
+
+        res = GaussianConvolutionGradient.apply(px, x, y, py, self)
+        return res.cpu() if self.gpu_mode is GpuMode.KERNEL else res
 
-        # A=exp(-(x_i - y_j)^2/(ker^2)).
-        sq = self._squared_distances(x, y)
-        A = torch.exp(-sq / (self.kernel_width ** 2))
-        # A = 1.0 / (1 + sq / self.kernel_width ** 2) ** 2
+    def convolve_and_gradient(self, x, p):
+        # move tensors with respect to gpu_mode
+        x, p = (self._move_to_device(t, gpu_mode=self.gpu_mode) for t in [x, p])
+        assert x.device == p.device, 'x and p must be on the same device'
+        x, p = self._broadcast_batch_dimension(x, p)
 
-        # B=(x_i - y_j)*exp(-(x_i - y_j)^2/(ker^2))/(ker^2).
-        B = self._differences(x, y) * A
+        if torch.is_grad_enabled() and (x.requires_grad or p.requires_grad):
+            # Each reduction goes through its own autograd function, so that no pairwise matrix is saved for backward.
+            velocity = GaussianConvolution.apply(x, x, p, self)
+            gradient = GaussianConvolutionGradient.apply(p, x, x, p, self)
+            if self.gpu_mode is GpuMode.KERNEL:
+                velocity, gradient = velocity.cpu(), gradient.cpu()
+            return velocity, gradient
 
-        res = (- 2 * torch.sum(px * (torch.matmul(B, py)), 2) / (self.kernel_width ** 2)).t()
-        return res.cpu() if self.gpu_mode is GpuMode.KERNEL else res
+        def convolve_and_gradient_tile(rows, columns):
+            # The kernel matrix is shared by both reductions.
+            sq = self._squared_distances(x[..., rows, :], x[..., columns, :])
+            A, dA = self._kernel_and_derivatives(sq, 1)
+            B = self._differences(x[..., rows, :], x[..., columns, :]) * dA
+
+            velocity = torch.matmul(A, p[..., columns, :])
+            gradient = 2 * torch.sum(p[..., rows, :] * (torch.matmul(B, p[..., columns, :])), -1)
+            return torch.cat([velocity, self._move_first_dimension_last(gradient)], -1)
+
+        res = self._reduce_by_tiles(convolve_and_gradient_tile, x.size(-2), x.size(-2), 2 * x.size(-1) + 3, x)
+        res = res.cpu() if self.gpu_mode is GpuMode.KERNEL else res
+        return res[..., :p.size(-1)], res[..., p.size(-1):]
+
+    ####################################################################################################################
+    ### Reductions, on tensors that are already on the computation device:
+    ####################################################################################################################
+
+    def _gaussian_convolve(self, x, y, p):
+        def convolve_tile(rows, columns):
+            sq = self._squared_distances(x[..., rows, :], y[..., columns, :])
+            return torch.matmul(self._kernel_and_derivatives(sq)[0], p[..., columns, :])
+            # return torch.matmul(1.0 / (1 + sq / self.kernel_width ** 2), p[..., columns, :])
+
+        return self._reduce_by_tiles(convolve_tile, x.size(-2), y.size(-2), 3, x)
+
+    def _varifold_convolve(self, x, nx, y, ny, p):
+        def varifold_convolve_tile(rows, columns):
+            sq = self._squared_distances(x[..., rows, :], y[..., columns, :])
+            prs = torch.matmul(nx[..., rows, :], ny[..., columns, :].transpose(-1, -2))
+            return torch.matmul(self._kernel_and_derivatives(sq)[0] * binet(prs), p[..., columns, :])
+
+        return self._reduce_by_tiles(varifold_convolve_tile, x.size(-2), y.size(-2), 5, x)
+
+    def _gaussian_convolve_gradient(self, px, x, y, py):
+        def convolve_gradient_tile(rows, columns):
+            # dA=k'(|x_i - y_j|^2), i.e. -exp(-(x_i - y_j)^2/(ker^2))/(ker^2) for the gaussian kernel.
+            sq = self._squared_distances(x[..., rows, :], y[..., columns, :])
+            dA = self._kernel_and_derivatives(sq, 1)[1]
+
+            # B=(x_i - y_j)*k'(|x_i - y_j|^2).
+            B = self._differences(x[..., rows, :], y[..., columns, :]) * dA
+
+            return self._move_first_dimension_last(
+                2 * torch.sum(px[..., rows, :] * (torch.matmul(B, py[..., columns, :])), -1))
+
+        return self._reduce_by_tiles(convolve_gradient_tile, x.size(-2), y.size(-2), 2 * x.size(-1) + 3, x)
+
+    def _gaussian_convolve_backward(self, x, y, p, g):
+        """
+        Gradients of sum_i <g_i, sum_j k(x_i, y_j) p_j> with respect to x, y and p, k being a function of |x-y|^2.
+        """
+        def backward_tile(rows, columns):
+            sq = self._squared_distances(x[..., rows, :], y[..., columns, :])
+            A, dA = self._kernel_and_derivatives(sq, 1)
+            # S_ij = k'(|x_i - y_j|^2) <g_i, p_j>
+            S = dA * torch.matmul(g[..., rows, :], p[..., columns, :].transpose(-1, -2))
+
+            grad_x = 2 * (x[..., rows, :] * torch.sum(S, -1, keepdim=True) - torch.matmul(S, y[..., columns, :]))
+            grad_y = - 2 * (torch.matmul(S.transpose(-1, -2), x[..., rows, :])
+                            - y[..., columns, :] * torch.sum(S, -2).unsqueeze(-1))
+            grad_p = torch.matmul(A.transpose(-1, -2), g[..., rows, :])
+            return grad_x, torch.cat([grad_y, grad_p], -1)
+
+        grad_x, grad_yp = self._reduce_by_tiles_on_both_sides(backward_tile, x.size(-2), y.size(-2), 4, x)
+        return grad_x, grad_yp[..., :y.size(-1)], grad_yp[..., y.size(-1):]
+
+    def _varifold_convolve_backward(self, x, nx, y, ny, p, g):
+        """
+        Gradients of sum_i <g_i, sum_j k(x_i, y_j) <nx_i, ny_j>^2 p_j> with respect to x, nx, y, ny and p.
+        """
+        d = x.size(-1)
+
+        def backward_tile(rows, columns):
+            sq = self._squared_distances(x[..., rows, :], y[..., columns, :])
+            A, dA = self._kernel_and_derivatives(sq, 1)
+            prs = torch.matmul(nx[..., rows, :], ny[..., columns, :].transpose(-1, -2))
+            AB = A * binet(prs)
+            W = torch.matmul(g[..., rows, :], p[..., columns, :].transpose(-1, -2))
+            # derivative of the kernel term, k'(|x_i - y_j|^2) <nx_i, ny_j>^2 <g_i, p_j>
+            S = dA * binet(prs) * W
+            # derivative of the binet term, 2 k(x_i, y_j) <nx_i, ny_j> <g_i, p_j>
+            Q = 2 * A * prs * W
+
+            grad_x = 2 * (x[..., rows, :] * torch.sum(S, -1, keepdim=True) - torch.matmul(S, y[..., columns, :]))
+            grad_nx = torch.matmul(Q, ny[..., columns, :])
+            grad_y = - 2 * (torch.matmul(S.transpose(-1, -2), x[..., rows, :])
+                            - y[..., columns, :] * torch.sum(S, -2).unsqueeze(-1))
+            grad_ny = torch.matmul(Q.transpose(-1, -2), nx[..., rows, :])
+            grad_p = torch.matmul(AB.transpose(-1, -2), g[..., rows, :])
+            return torch.cat([grad_x, grad_nx], -1), torch.cat([grad_y, grad_ny, grad_p], -1)
+
+        grad_rows, grad_columns = self._reduce_by_tiles_on_both_sides(backward_tile, x.size(-2), y.size(-2), 7, x)
+        return (grad_rows[..., :d], grad_rows[..., d:],
+                grad_columns[..., :d], grad_columns[..., d:2 * d], grad_columns[..., 2 * d:])
+
+    def _gaussian_convolve_gradient_backward(self, px, x, y, py, g):
+        """
+        Gradients of sum_i <g_i, 2 sum_j k'(|x_i - y_j|^2) <px_i, py_j> (x_i - y_j)> with respect to px, x, y and py.
+        """
+        d = x.size(-1)
+
+        def backward_tile(rows, columns):
+            sq = self._squared_distances(x[..., rows, :], y[..., columns, :])
+            _, dA, ddA = self._kernel_and_derivatives(sq, 2)
+            # <g_i, x_i - y_j>
+            gd = torch.sum(g[..., rows, :] * x[..., rows, :], -1, keepdim=True) \
+                 - torch.matmul(g[..., rows, :], y[..., columns, :].transpose(-1, -2))
+            prs = torch.matmul(px[..., rows, :], py[..., columns, :].transpose(-1, -2))
+            As = dA * prs
+            Ag = dA * gd
+            T = ddA * prs * gd
+
+            grad_px = 2 * torch.matmul(Ag, py[..., columns, :])
+            grad_x = 2 * g[..., rows, :] * torch.sum(As, -1, keepdim=True) \
+                     + 4 * (x[..., rows, :] * torch.sum(T, -1, keepdim=True) - torch.matmul(T, y[..., columns, :]))
+            grad_py = 2 * torch.matmul(Ag.transpose(-1, -2), px[..., rows, :])
+            grad_y = - 2 * torch.matmul(As.transpose(-1, -2), g[..., rows, :]) \
+                     - 4 * (torch.matmul(T.transpose(-1, -2), x[..., rows, :])
+                            - y[..., columns, :] * torch.sum(T, -2).unsqueeze(-1))
+            return torch.cat([grad_px, grad_x], -1), torch.cat([grad_y, grad_py], -1)
+
+        grad_rows, grad_columns = self._reduce_by_tiles_on_both_sides(backward_tile, x.size(-2), y.size(-2), 7, x)
+        return grad_rows[..., :d], grad_rows[..., d:], grad_columns[..., :d], grad_columns[..., d:]
 
     ####################################################################################################################
     ### Auxiliary methods:
     ####################################################################################################################
 
+    def _kernel_and_derivatives(self, sq, order=0):
+        """
+        Returns the kernel matrix k(|x_i - y_j|^2) and its first order derivatives with respect to the squared
+        distances. Subclasses for other radial kernels only need to override this method.
+        """
+        A = gaussian(sq, self.kernel_width)
+        return [A] + [A * (- 1. / self.kernel_width ** 2) ** k for k in range(1, order + 1)]
+
+    def _get_tile_sizes(self, m, n, number_of_temporaries, element_size):
+        """
+        Returns the (rows, columns) tile sizes such that number_of_temporaries pairwise matrices of the tile size fit in
+        the memory budget. Full rows are favoured, as they do not require any accumulation.
+        """
+        if self.memory_budget is None:
+            return m, n
+
+        max_tile_elements = max(1, int(self.memory_budget // (number_of_temporaries * element_size)))
+        tile_n = min(n, max_tile_elements)
+        tile_m = min(m, max(1, max_tile_elements // tile_n))
+        return tile_m, tile_n
+
+    def _reduce_by_tiles(self, convolve_tile, m, n, number_of_temporaries, x):
+        """
+        Evaluates a kernel reduction tile by tile: convolve_tile(rows, columns) returns the contribution of the columns
+        slice to the rows slice. Contributions are summed over column tiles and concatenated over row tiles.
+        With float64 accumulation of float32 tensors, column tiles have at most accumulation_tile_size columns.
+        """
+        accumulation_dtype = utilities.get_accumulation_dtype(x.dtype)
+        tile_m, tile_n = self._get_tile_sizes(m, n, number_of_temporaries, self._get_element_size(x))
+        if accumulation_dtype != x.dtype:
+            tile_n = min(tile_n, self.accumulation_tile_size)
+
+        res = []
+        for i in range(0, m, tile_m):
+            rows = slice(i, min(i + tile_m, m))
+            res_rows = None
+            for j in range(0, n, tile_n):
+                res_tile = convolve_tile(rows, slice(j, min(j + tile_n, n))).to(accumulation_dtype)
+                res_rows = res_tile if res_rows is None else res_rows + res_tile
+            res.append(res_rows.to(x.dtype))
+
+        return res[0] if len(res) == 1 else torch.cat(res, -2)
+
+    def _reduce_by_tiles_on_both_sides(self, tile_fn, m, n, number_of_temporaries, x):
+        """
+        Same as _reduce_by_tiles, for tile_fn(rows, columns) returning a (rows contribution, columns contribution)
+        pair: the former is summed over column tiles, the latter over row tiles.
+        """
+        accumulation_dtype = utilities.get_accumulation_dtype(x.dtype)
+        tile_m, tile_n = self._get_tile_sizes(m, n, number_of_temporaries, self._get_element_size(x))
+        if accumulation_dtype != x.dtype:
+            tile_m, tile_n = min(tile_m, self.accumulation_tile_size), min(tile_n, self.accumulation_tile_size)
+        column_starts = range(0, n, tile_n)
+
+        res_rows = []
+        res_columns = [None] * len(column_starts)
+        for i in range(0, m, tile_m):
+            rows = slice(i, min(i + tile_m, m))
+            res_row = None
+            for k, j in enumerate(column_starts):
+                row_tile, column_tile = tile_fn(rows, slice(j, min(j + tile_n, n)))
+                row_tile, column_tile = row_tile.to(accumulation_dtype), column_tile.to(accumulation_dtype)
+                res_row = row_tile if res_row is None else res_row + row_tile
+                res_columns[k] = column_tile if res_columns[k] is None else res_columns[k] + column_tile
+            res_rows.append(res_row.to(x.dtype))
+        res_columns = [res_column.to(x.dtype) for res_column in res_columns]
+
+        return (res_rows[0] if len(res_rows) == 1 else torch.cat(res_rows, -2),
+                res_columns[0] if len(res_columns) == 1 else torch.cat(res_columns, -2))
+
+    @staticmethod
+    def _get_element_size(x):
+        """
+        Size in bytes of an element of the pairwise matrices, accounting for the batch dimensions of x.
+        """
+        return x.element_size() * x[..., 0, 0].numel()
+
+    @staticmethod
+    def _move_first_dimension_last(t):
+        return t.permute(*range(1, t.dim()), 0)
+
     @staticmethod
     def _differences(x, y):
         """
         Returns the matrix of $(x_i - y_j)$.
-        Output is of size (D, M, N).
+        Output is of size (D, M, N), or (D, B, M, N) for batched inputs.
         """
-        x_col = x.t().unsqueeze(2)  # (M,D) -> (D,M,1)
-        y_lin = y.t().unsqueeze(1)  # (N,D) -> (D,1,N)
+        x_col = x.permute(x.dim() - 1, *range(x.dim() - 1)).unsqueeze(-1)  # (...,M,D) -> (D,...,M,1)
+        y_lin = y.permute(y.dim() - 1, *range(y.dim() - 1)).unsqueeze(-2)  # (...,N,D) -> (D,...,1,N)
         return x_col - y_lin
+
+
+class GaussianConvolution(torch.autograd.Function):
+    """
+    Gaussian convolution sum_j k(x_i, y_j) p_j, whose backward pass recomputes the kernel tile by tile instead of
+    saving it: only x, y and p are kept for backward, so that the saved memory stays linear in the number of points.
+    The transient pairwise matrices are also linear with a memory budget, and N x M ones without.
+    """
+
+    @staticmethod
+    def forward(ctx, x, y, p, kernel):
+        ctx.kernel = kernel
+        ctx.save_for_backward(x, y, p)
+        return kernel._gaussian_convolve(x, y, p)
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        x, y, p = ctx.saved_tensors
+        grads = ctx.kernel._gaussian_convolve_backward(x, y, p, grad_output)
+        return tuple(grad if needed else None for grad, needed in zip(grads, ctx.needs_input_grad)) + (None,)
+
+
+class VarifoldConvolution(torch.autograd.Function):
+    """
+    Varifold convolution sum_j k(x_i, y_j) <nx_i, ny_j>^2 p_j, with a recomputing backward pass.
+    """
+
+    @staticmethod
+    def forward(ctx, x, nx, y, ny, p, kernel):
+        ctx.kernel = kernel
+        ctx.save_for_backward(x, nx, y, ny, p)
+        return kernel._varifold_convolve(x, nx, y, ny, p)
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        x, nx, y, ny, p = ctx.saved_tensors
+        grads = ctx.kernel._varifold_convolve_backward(x, nx, y, ny, p, grad_output)
+        return tuple(grad if needed else None for grad, needed in zip(grads, ctx.needs_input_grad)) + (None,)
+
+
+class GaussianConvolutionGradient(torch.autograd.Function):
+    """
+    Gradient of the gaussian convolution with respect to x, with a recomputing backward pass.
+    """
+
+    @staticmethod
+    def forward(ctx, px, x, y, py, kernel):
+        ctx.kernel = kernel
+        ctx.save_for_backward(px, x, y, py)
+        return kernel._gaussian_convolve_gradient(px, x, y, py)
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        px, x, y, py = ctx.saved_tensors
+        grads = ctx.kernel._gaussian_convolve_gradient_backward(px, x, y, py, grad_output)
+        return tuple(grad if needed else None for grad, needed in zip(grads, ctx.needs_input_grad)) + (None,)
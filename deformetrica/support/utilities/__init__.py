@@ -13,6 +13,7 @@ def get_torch_scalar_type(dtype):
             'torch.float16': torch.HalfTensor,
             'float32': torch.FloatTensor,
             'torch.float32': torch.FloatTensor,
+            'mixed': torch.FloatTensor,
             'float64': torch.DoubleTensor,
             'torch.float64': torch.DoubleTensor}[dtype]
 
@@ -31,6 +32,7 @@ def get_torch_integer_type(dtype):
             'torch.float16': torch.ShortTensor,
             'float32': torch.LongTensor,        # IntTensor
             'torch.float32': torch.LongTensor,  # IntTensor
+            'mixed': torch.LongTensor,
             'float64': torch.LongTensor,
             'torch.float64': torch.LongTensor}[dtype]
 
@@ -72,6 +74,17 @@ def get_torch_dtype(t):
     return t
 
 
+def get_accumulation_dtype(dtype):
+    """
+    Returns the torch dtype in which reductions of dtype tensors are accumulated: float64 for float32 tensors with the
+    'mixed' dtype policy, dtype otherwise.
+    """
+    from ...core import default
+    if dtype == torch.float32 and default.dtype == 'float32' and default.accumulation_dtype == 'float64':
+        return torch.float64
+    return dtype
+
+
 def move_data(data, device='cpu', dtype=None, requires_grad=None):
     """
     Move given data to target Torch Tensor to the given device
@@ -115,6 +115,37 @@ class API(unittest.TestCase):
     def test_estimate_deterministic_atlas_landmark_2d_skulls(self):
         self.__test_all(self._test_estimate_deterministic_atlas_landmark_2d_skulls)
 
+    def test_estimate_deterministic_atlas_landmark_2d_skulls_with_control_point_updates(self):
+        dataset_specifications = {
+            'dataset_filenames': [
+                [{'skull': example_data_dir + '/atlas/landmark/2d/skulls/data/skull_australopithecus.vtk'}],
+                [{'skull': example_data_dir + '/atlas/landmark/2d/skulls/data/skull_erectus.vtk'}],
+                [{'skull': example_data_dir + '/atlas/landmark/2d/skulls/data/skull_habilis.vtk'}]],
+            'subject_ids': ['australopithecus', 'erectus', 'habilis'],
+        }
+        template_specifications = {
+            'skull': {'deformable_object_type': 'polyline',
+                      'kernel_type': 'torch', 'kernel_width': 20.0,
+                      'noise_std': 1.0,
+                      'filename': example_data_dir + '/atlas/landmark/2d/skulls/data/template.vtk',
+                      'attachment_type': 'varifold'}}
+
+        for optimization_method_type in ['GradientAscent', 'ScipyLBFGS']:
+            statistical_model = self.deformetrica.estimate_deterministic_atlas(
+                template_specifications,
+                dataset_specifications,
+                estimator_options={'optimization_method_type': optimization_method_type, 'initial_step_size': 1.,
+                                   'max_iterations': 3, 'max_line_search_iterations': 10,
+                                   'update_control_points_every_n_iters': 1},
+                model_options={'deformation_kernel_type': 'torch', 'deformation_kernel_width': 40.0,
+                               'dtype': self.dtype})
+
+            # The kernel width of 40 initially yields 16 control points, of which some cells have been refined.
+            control_points = statistical_model.get_control_points()
+            momenta = statistical_model.get_momenta()
+            self.assertGreater(len(control_points), 16)
+            self.assertEqual(momenta.shape, (3, len(control_points), 2))
+
     def _test_estimate_deterministic_atlas_landmark_3d_brain_structure(self, dtype, gpu_mode):
         dataset_specifications = {
             'dataset_filenames': [
@@ -4,8 +4,12 @@ logger = logging.getLogger(__name__)
 import deformetrica as dfca
 import pykeops
 
+import json
+import os
 import pickle
+import tempfile
 import unittest
+import unittest.mock
 import torch
 import numpy as np
 
@@ -180,6 +184,496 @@ class TorchKernelTest(KernelTestBase):
             self.assertEqual('cpu', res.device.type)
             self._assert_tensor_close(res, self.expected_convolve_res)
 
+    def test_convolve_and_gradient(self):
+        for memory_budget in [None, 100]:
+            kernel_instance = dfca.kernels.factory(dfca.kernels.Type.TORCH, kernel_width=1.,
+                                                   memory_budget=memory_budget)
+            velocity, gradient = kernel_instance.convolve_and_gradient(self.x, self.p)
+            self._assert_tensor_close(velocity, kernel_instance.convolve(self.x, self.x, self.p))
+            self._assert_tensor_close(gradient, kernel_instance.convolve_gradient(self.p, self.x))
+
+    def test_tiled_convolve_equals_dense(self):
+        dense_kernel = dfca.kernels.factory(dfca.kernels.Type.TORCH, kernel_width=0.5)
+        # budget of a few dozen pairwise terms: forces tiling over both rows and columns.
+        tiled_kernel = dfca.kernels.factory(dfca.kernels.Type.TORCH, kernel_width=0.5, memory_budget=600)
+        self.assertNotEqual(dense_kernel, tiled_kernel)
+        self.assertEqual((1, 25), tiled_kernel._get_tile_sizes(50, 40, 3, 8))
+
+        x = torch.rand((50, 3), dtype=self.torch_dtype, requires_grad=True)
+        y = torch.rand((40, 3), dtype=self.torch_dtype, requires_grad=True)
+        p = torch.rand((40, 3), dtype=self.torch_dtype, requires_grad=True)
+        nx = torch.rand((50, 3), dtype=self.torch_dtype)
+        ny = torch.rand((40, 3), dtype=self.torch_dtype)
+        a = torch.rand((40, 1), dtype=self.torch_dtype)
+
+        for kernel_function in [lambda k: k.convolve(x, y, p),
+                                lambda k: k.convolve(x, y, p[:, :1], mode='pointcloud'),
+                                lambda k: k.convolve((x, nx), (y, ny), a, mode='varifold'),
+                                lambda k: k.convolve_gradient(p[:30], x[:30]),
+                                lambda k: k.convolve_gradient(p[:30], x[:30], y, p)]:
+            dense_res = kernel_function(dense_kernel)
+            tiled_res = kernel_function(tiled_kernel)
+            self._assert_tensor_close(tiled_res, dense_res, precision=1e-12)
+
+            dense_grads = torch.autograd.grad(torch.sum(dense_res ** 2), [x, y, p], allow_unused=True)
+            tiled_grads = torch.autograd.grad(torch.sum(tiled_res ** 2), [x, y, p], allow_unused=True)
+            for dense_grad, tiled_grad in zip(dense_grads, tiled_grads):
+                self.assertEqual(dense_grad is None, tiled_grad is None)
+                if dense_grad is not None:
+                    self._assert_tensor_close(tiled_grad, dense_grad, precision=1e-12)
+
+    def test_memory_budget_reaches_the_model_kernels(self):
+        from deformetrica.in_out.xml_parameters import XmlParameters, get_model_options
+        from . import example_data_dir
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            model_xml_path = os.path.join(tmp_dir, 'model.xml')
+            with open(model_xml_path, 'w') as f:
+                f.write('<?xml version="1.0"?><model><model-type>DeterministicAtlas</model-type><template>'
+                        '<object id="skull"><deformable-object-type>Polyline</deformable-object-type>'
+                        '<attachment-type>Varifold</attachment-type><kernel-type>torch</kernel-type>'
+                        '<kernel-width>20</kernel-width><kernel-memory-budget>2e6</kernel-memory-budget>'
+                        '<filename>template.vtk</filename></object></template><deformation-parameters>'
+                        '<kernel-type>torch</kernel-type><kernel-width>40</kernel-width>'
+                        '<kernel-memory-budget>1000000</kernel-memory-budget></deformation-parameters></model>')
+            xml_parameters = XmlParameters()
+            xml_parameters._read_model_xml(model_xml_path)
+
+        model_options = get_model_options(xml_parameters)
+        self.assertEqual({'memory_budget': 1000000}, model_options['deformation_kernel_options'])
+        model = dfca.models.DeterministicAtlas(
+            {'skull': dict(xml_parameters.template_specifications['skull'], noise_std=1.,
+                           filename=example_data_dir + '/atlas/landmark/2d/skulls/data/template.vtk')},
+            1, dimension=2, deformation_kernel_type='torch', deformation_kernel_width=40.,
+            initial_cp_spacing=40., deformation_kernel_options=model_options['deformation_kernel_options'])
+        self.assertEqual(1000000, model.exponential.kernel.memory_budget)
+        self.assertEqual(2000000, model.multi_object_attachment.kernels[0].memory_budget)
+
+    def test_tiled_analytic_backward(self):
+        for memory_budget in [300, None]:
+            self._test_analytic_backward(memory_budget)
+
+    def test_no_kernel_matrix_is_saved_for_backward(self):
+        # the pairwise matrices are recomputed by the backward passes, with or without memory budget.
+        kernel_instance = dfca.kernels.factory(dfca.kernels.Type.TORCH, kernel_width=0.7)
+        x = torch.rand((70, 3), dtype=self.torch_dtype, requires_grad=True)
+        y = torch.rand((50, 3), dtype=self.torch_dtype, requires_grad=True)
+        p = torch.rand((50, 3), dtype=self.torch_dtype, requires_grad=True)
+        for res in [kernel_instance.convolve(x, y, p), kernel_instance.convolve((x, x), (y, y), p, mode='varifold'),
+                    kernel_instance.convolve_gradient(p, y)] + list(kernel_instance.convolve_and_gradient(y, p)):
+            self.assertTrue(all(t.numel() <= 70 * 3 for t in res.grad_fn.saved_tensors))
+
+    def _test_analytic_backward(self, memory_budget):
+        kernel_instance = dfca.kernels.factory(dfca.kernels.Type.TORCH, kernel_width=0.7, memory_budget=memory_budget)
+
+        x = torch.rand((7, 3), dtype=self.torch_dtype, requires_grad=True)
+        nx = torch.rand((7, 3), dtype=self.torch_dtype, requires_grad=True)
+        px = torch.rand((7, 3), dtype=self.torch_dtype, requires_grad=True)
+        y = torch.rand((5, 3), dtype=self.torch_dtype, requires_grad=True)
+        ny = torch.rand((5, 3), dtype=self.torch_dtype, requires_grad=True)
+        py = torch.rand((5, 3), dtype=self.torch_dtype, requires_grad=True)
+        a = torch.rand((5, 1), dtype=self.torch_dtype, requires_grad=True)
+
+        self.assertTrue(torch.autograd.gradcheck(kernel_instance.convolve, (x, y, py)))
+        self.assertTrue(torch.autograd.gradgradcheck(kernel_instance.convolve, (x, y, py)))
+        self.assertTrue(torch.autograd.gradcheck(
+            lambda x, nx, y, ny, a: kernel_instance.convolve((x, nx), (y, ny), a, mode='varifold'), (x, nx, y, ny, a)))
+        self.assertTrue(torch.autograd.gradcheck(kernel_instance.convolve_gradient, (px, x, y, py)))
+        self.assertTrue(torch.autograd.gradcheck(kernel_instance.convolve_and_gradient, (y, py)))
+        self.assertTrue(torch.autograd.gradcheck(lambda y, py: kernel_instance.convolve_and_gradient(y, py)[1],
+                                                 (y, py)))
+
+    def test_batched_convolutions_equal_loops(self):
+        x = torch.rand((4, 20, 3), dtype=self.torch_dtype)
+        nx = torch.rand((4, 20, 3), dtype=self.torch_dtype)
+        p = torch.rand((4, 20, 3), dtype=self.torch_dtype)
+        # shared by the whole batch.
+        y = torch.rand((15, 3), dtype=self.torch_dtype, requires_grad=True)
+        ny = torch.rand((15, 3), dtype=self.torch_dtype)
+        a = torch.rand((15, 1), dtype=self.torch_dtype)
+
+        for kernel_instance in [dfca.kernels.factory(dfca.kernels.Type.TORCH, kernel_width=0.5),
+                                dfca.kernels.factory(dfca.kernels.Type.TORCH, kernel_width=0.5, memory_budget=600),
+                                dfca.kernels.factory(dfca.kernels.Type.SPARSE, kernel_width=0.5)]:
+            for kernel_function in [lambda k, b: k.convolve(x[b], y, p[b, :15]),
+                                    lambda k, b: k.convolve((x[b], nx[b]), (y, ny), a, mode='varifold'),
+                                    lambda k, b: k.convolve_gradient(p[b], x[b]),
+                                    lambda k, b: k.convolve_and_gradient(x[b], p[b])[1]]:
+                batched_res = kernel_function(kernel_instance, slice(None))
+                looped_res = torch.stack([kernel_function(kernel_instance, b) for b in range(4)])
+                self._assert_tensor_close(batched_res, looped_res, precision=1e-12)
+
+            batched_grad = torch.autograd.grad(torch.sum(kernel_instance.convolve(x, y, p[:, :15]) ** 2), y)[0]
+            looped_grad = torch.autograd.grad(
+                sum(torch.sum(kernel_instance.convolve(x[b], y, p[b, :15]) ** 2) for b in range(4)), y)[0]
+            self._assert_tensor_close(batched_grad, looped_grad, precision=1e-12)
+
+    def test_mixed_precision_accumulation(self):
+        generator = torch.Generator().manual_seed(0)
+        x = torch.rand((20, 3), dtype=torch.float64, generator=generator)
+        y = torch.rand((100000, 3), dtype=torch.float64, generator=generator)
+        p = torch.rand((100000, 1), dtype=torch.float64, generator=generator) + 1.
+        kernel_instance = dfca.kernels.factory(dfca.kernels.Type.TORCH, kernel_width=10.)
+        reference = kernel_instance.convolve(x, y, p)
+        float32_res = kernel_instance.convolve(x.float(), y.float(), p.float())
+
+        try:
+            dfca.default.update_dtype('mixed')
+            self.assertEqual('float32', dfca.default.dtype)
+            self.assertEqual(torch.float64, dfca.utils.get_accumulation_dtype(torch.float32))
+            mixed_res = kernel_instance.convolve(x.float(), y.float(), p.float())
+        finally:
+            dfca.default.update_dtype('float64')
+
+        self.assertEqual(torch.float32, mixed_res.dtype)
+        float32_error = torch.max(torch.abs(float32_res.double() - reference) / reference).item()
+        mixed_error = torch.max(torch.abs(mixed_res.double() - reference) / reference).item()
+        self.assertLess(mixed_error, 1e-7)
+        self.assertLess(mixed_error, float32_error)
+
+
+class SparseKernelTest(KernelTestBase):
+    def setUp(self):
+        super().setUp()
+
+    def test_convolve_cpu(self):
+        # all the points are within the truncation radius.
+        kernel_instance = dfca.kernels.factory(dfca.kernels.Type.SPARSE, kernel_width=1.)
+        res = kernel_instance.convolve(self.x, self.y, self.p)
+        self._assert_tensor_close(res, self.expected_convolve_res)
+
+    def test_convolve_gradient_cpu(self):
+        kernel_instance = dfca.kernels.factory(dfca.kernels.Type.SPARSE, kernel_width=1.)
+        res = kernel_instance.convolve_gradient(self.x, self.x)
+        self._assert_tensor_close(res, self.expected_convolve_gradient_res)
+
+    def test_sparse_and_torch_are_close(self):
+        sparse_kernel = dfca.kernels.factory(dfca.kernels.Type.SPARSE, kernel_width=0.1, truncation_sigmas=5.)
+        torch_kernel = dfca.kernels.factory(dfca.kernels.Type.TORCH, kernel_width=0.1)
+
+        x = torch.rand((500, 3), dtype=self.torch_dtype, requires_grad=True)
+        nx = torch.rand((500, 3), dtype=self.torch_dtype)
+        y = torch.rand((400, 3), dtype=self.torch_dtype)
+        ny = torch.rand((400, 3), dtype=self.torch_dtype)
+        p = torch.rand((400, 3), dtype=self.torch_dtype)
+
+        # truncation error is of the order of exp(-25).
+        for kernel_function in [lambda k: k.convolve(x, y, p),
+                                lambda k: k.convolve((x, nx), (y, ny), p[:, :1], mode='varifold'),
+                                lambda k: k.convolve_gradient(p, y),
+                                lambda k: k.convolve_gradient(nx, x, y, ny)]:
+            self._assert_tensor_close(kernel_function(sparse_kernel), kernel_function(torch_kernel), precision=1e-8)
+
+        sparse_grad = torch.autograd.grad(torch.sum(sparse_kernel.convolve(x, y, p) ** 2), x)[0]
+        torch_grad = torch.autograd.grad(torch.sum(torch_kernel.convolve(x, y, p) ** 2), x)[0]
+        self._assert_tensor_close(sparse_grad, torch_grad, precision=1e-6)
+
+        sparse_velocity, sparse_gradient = sparse_kernel.convolve_and_gradient(y, p)
+        self._assert_tensor_close(sparse_velocity, torch_kernel.convolve(y, y, p), precision=1e-8)
+        self._assert_tensor_close(sparse_gradient, torch_kernel.convolve_gradient(p, y), precision=1e-8)
+
+    def test_neighbor_list_without_searchsorted(self):
+        # torch.searchsorted and torch.repeat_interleave are missing from the older supported torch versions.
+        x = torch.rand((300, 3), dtype=self.torch_dtype)
+        y = torch.rand((200, 3), dtype=self.torch_dtype)
+        expected_pairs = set(zip(*[t.tolist() for t in dfca.kernels.Type.SPARSE.value._build_neighbor_list(x, y, 0.2)]))
+
+        with unittest.mock.patch.dict(torch.__dict__):
+            del torch.searchsorted, torch.repeat_interleave
+            pairs = set(zip(*[t.tolist() for t in dfca.kernels.Type.SPARSE.value._build_neighbor_list(x, y, 0.2)]))
+        self.assertEqual(pairs, expected_pairs)
+
+    def test_neighbor_list_is_reused(self):
+        kernel_instance = dfca.kernels.factory(dfca.kernels.Type.SPARSE, kernel_width=0.2, neighbor_skin=0.5)
+        x = torch.rand((100, 2), dtype=self.torch_dtype)
+        p = torch.rand((100, 2), dtype=self.torch_dtype)
+
+        i, j = kernel_instance._get_neighbor_list(x, x)
+        # displacements below half the skin: the list is reused, and results are the same as with a new one.
+        moved_x = x + 0.03
+        self.assertIs(i, kernel_instance._get_neighbor_list(moved_x, moved_x)[0])
+        res = kernel_instance.convolve(moved_x, moved_x, p)
+        kernel_instance._neighbor_lists.clear()
+        self._assert_tensor_close(res, kernel_instance.convolve(moved_x, moved_x, p))
+
+        # larger displacements: the list is rebuilt.
+        self.assertIsNot(kernel_instance._get_neighbor_list(moved_x, moved_x)[0],
+                         kernel_instance._get_neighbor_list(x + 0.1, x + 0.1)[0])
+
+
+class GridKernelTest(KernelTestBase):
+    def setUp(self):
+        super().setUp()
+        grid = torch.arange(0., 6., dtype=self.torch_dtype)
+        self.control_points = torch.stack([c.contiguous().view(-1) for c in torch.meshgrid(grid, grid)], 1)
+        self.momenta = torch.rand(self.control_points.size(), dtype=self.torch_dtype)
+
+    def test_grid_aligned_points_are_exact(self):
+        grid_kernel = dfca.kernels.factory(dfca.kernels.Type.GRID, kernel_width=2., grid_spacing=0.25)
+        torch_kernel = dfca.kernels.factory(dfca.kernels.Type.TORCH, kernel_width=2.)
+
+        # control points are on the grid nodes: splatting, convolution and interpolation are exact up to truncation.
+        velocity, gradient = grid_kernel.convolve_and_gradient(self.control_points, self.momenta)
+        self._assert_tensor_close(velocity, torch_kernel.convolve(self.control_points, self.control_points,
+                                                                  self.momenta), precision=1e-6)
+        self._assert_tensor_close(gradient, torch_kernel.convolve_gradient(self.momenta, self.control_points),
+                                  precision=1e-6)
+        self._assert_tensor_close(grid_kernel.convolve(self.control_points, self.control_points, self.momenta),
+                                  velocity)
+
+    def test_grid_and_torch_are_close(self):
+        grid_kernel = dfca.kernels.factory(dfca.kernels.Type.GRID, kernel_width=1.5, grid_spacing=0.1)
+        torch_kernel = dfca.kernels.factory(dfca.kernels.Type.TORCH, kernel_width=1.5)
+
+        x = 5 * torch.rand((200, 2), dtype=self.torch_dtype)
+        nx = torch.rand((200, 2), dtype=self.torch_dtype)
+        ny = torch.rand(self.control_points.size(), dtype=self.torch_dtype)
+        a = torch.rand((self.control_points.size(0), 1), dtype=self.torch_dtype)
+
+        for kernel_function in [lambda k: k.convolve(x, self.control_points, self.momenta),
+                                lambda k: k.convolve((x, nx), (self.control_points, ny), a, mode='varifold'),
+                                lambda k: k.convolve_gradient(nx, x, self.control_points, self.momenta)]:
+            grid_res = kernel_function(grid_kernel)
+            torch_res = kernel_function(torch_kernel)
+            # multilinear interpolation error, in O((grid_spacing)^2).
+            self.assertLess(float(torch.norm(grid_res - torch_res) / torch.norm(torch_res)), 1e-2)
+
+
+class FourierKernelTest(KernelTestBase):
+    def setUp(self):
+        super().setUp()
+
+    def test_gradient_is_exact_for_the_approximate_kernel(self):
+        kernel_instance = dfca.kernels.factory(dfca.kernels.Type.FOURIER, kernel_width=0.5, rank=256)
+        x = torch.rand((30, 3), dtype=self.torch_dtype, requires_grad=True)
+        y = torch.rand((20, 3), dtype=self.torch_dtype)
+        px = torch.rand((30, 3), dtype=self.torch_dtype)
+        py = torch.rand((20, 3), dtype=self.torch_dtype)
+
+        expected = torch.autograd.grad(torch.sum(px * kernel_instance.convolve(x, y, py)), x)[0]
+        self._assert_tensor_close(kernel_instance.convolve_gradient(px, x, y, py), expected, precision=1e-12)
+
+        velocity, gradient = kernel_instance.convolve_and_gradient(y, py)
+        self._assert_tensor_close(velocity, kernel_instance.convolve(y, y, py), precision=1e-12)
+        self._assert_tensor_close(gradient, kernel_instance.convolve_gradient(py, y), precision=1e-12)
+
+    def test_relative_error_is_reached(self):
+        kernel_instance = dfca.kernels.factory(dfca.kernels.Type.FOURIER, kernel_width=0.5, relative_error=0.02)
+        torch_kernel = dfca.kernels.factory(dfca.kernels.Type.TORCH, kernel_width=0.5)
+
+        # the whole point sets are used to select the rank.
+        x = torch.rand((200, 2), dtype=self.torch_dtype)
+        nx = torch.rand((200, 2), dtype=self.torch_dtype)
+        y = torch.rand((100, 2), dtype=self.torch_dtype)
+        ny = torch.rand((100, 2), dtype=self.torch_dtype)
+        p = torch.randn((100, 2), dtype=self.torch_dtype)
+
+        fourier_res = kernel_instance.convolve(x, y, p)
+        torch_res = torch_kernel.convolve(x, y, p)
+        self.assertLessEqual(float(torch.norm(fourier_res - torch_res) / torch.norm(torch_res)), 0.02)
+        self.assertLess(kernel_instance._ranks[2], kernel_instance.max_rank)
+
+        fourier_res = kernel_instance.convolve((x, nx), (y, ny), p[:, :1] ** 2, mode='varifold')
+        torch_res = torch_kernel.convolve((x, nx), (y, ny), p[:, :1] ** 2, mode='varifold')
+        self.assertLess(float(torch.norm(fourier_res - torch_res) / torch.norm(torch_res)), 0.05)
+
+
+class MultiScaleKernelTest(KernelTestBase):
+    def setUp(self):
+        super().setUp()
+
+    def test_convolve_cpu(self):
+        # a single scale is the gaussian kernel.
+        kernel_instance = dfca.kernels.factory(dfca.kernels.Type.MULTISCALE, kernel_width=1.)
+        self._assert_tensor_close(kernel_instance.convolve(self.x, self.y, self.p), self.expected_convolve_res)
+        self._assert_tensor_close(kernel_instance.convolve_gradient(self.x, self.x),
+                                  self.expected_convolve_gradient_res)
+
+    def test_multiscale_is_the_weighted_sum_of_scales(self):
+        kernel_widths, weights = [0.3, 0.6, 1.2], [0.5, 0.3, 0.2]
+        torch_kernels = [dfca.kernels.factory(dfca.kernels.Type.TORCH, kernel_width=w) for w in kernel_widths]
+
+        x = torch.rand((20, 3), dtype=self.torch_dtype)
+        nx = torch.rand((20, 3), dtype=self.torch_dtype)
+        y = torch.rand((15, 3), dtype=self.torch_dtype)
+        ny = torch.rand((15, 3), dtype=self.torch_dtype)
+        p = torch.rand((15, 3), dtype=self.torch_dtype)
+
+        for memory_budget in [None, 600]:
+            kernel_instance = dfca.kernels.factory(dfca.kernels.Type.MULTISCALE, kernel_widths=kernel_widths,
+                                                   weights=weights, memory_budget=memory_budget)
+            self.assertEqual(0.3, kernel_instance.kernel_width)
+
+            for kernel_function in [lambda k: k.convolve(x, y, p),
+                                    lambda k: k.convolve((x, nx), (y, ny), p[:, :1], mode='varifold'),
+                                    lambda k: k.convolve_gradient(p, y),
+                                    lambda k: k.convolve_gradient(nx, x, y, ny),
+                                    lambda k: torch.cat(k.convolve_and_gradient(y, p), 1)]:
+                expected_res = sum(w * kernel_function(k) for w, k in zip(weights, torch_kernels))
+                self._assert_tensor_close(kernel_function(kernel_instance), expected_res, precision=1e-12)
+
+    def test_kernel_options_are_read_from_the_model_xml(self):
+        from deformetrica.in_out.xml_parameters import XmlParameters, get_model_options
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            model_xml_path = os.path.join(tmp_dir, 'model.xml')
+            with open(model_xml_path, 'w') as f:
+                f.write('<?xml version="1.0"?><model><model-type>Shooting</model-type><template>'
+                        '<object id="skull"><deformable-object-type>Polyline</deformable-object-type>'
+                        '<kernel-type>multiscale</kernel-type><kernel-width>2</kernel-width>'
+                        '<kernel-widths>2 4</kernel-widths><kernel-weights>0.7, 0.3</kernel-weights>'
+                        '<filename>skull.vtk</filename></object></template><deformation-parameters>'
+                        '<kernel-type>multiscale</kernel-type><kernel-width>0.5</kernel-width>'
+                        '<kernel-widths>0.5 1 2</kernel-widths></deformation-parameters></model>')
+            xml_parameters = XmlParameters()
+            xml_parameters._read_model_xml(model_xml_path)
+
+        self.assertEqual({'kernel_widths': [2., 4.], 'weights': [0.7, 0.3]},
+                         xml_parameters.template_specifications['skull']['kernel_options'])
+        model_options = get_model_options(xml_parameters)
+        self.assertEqual({'kernel_widths': [0.5, 1., 2.]}, model_options['deformation_kernel_options'])
+
+        # the shoot kernel is built with the options of the deformation kernel.
+        kernel_instance = dfca.kernels.factory(model_options['deformation_kernel_type'],
+                                               kernel_width=model_options['deformation_kernel_width'],
+                                               **model_options['deformation_kernel_options'])
+        self.assertEqual((0.5, 1., 2.), kernel_instance.kernel_widths)
+        exponential = dfca.deformations.Exponential(kernel=kernel_instance, shoot_kernel_type='multiscale')
+        self.assertEqual((0.5, 1., 2.), exponential.shoot_kernel.kernel_widths)
+        self.assertEqual((0.5, 1., 2.), exponential.light_copy().shoot_kernel.kernel_widths)
+
+    def test_tiled_analytic_backward(self):
+        kernel_instance = dfca.kernels.factory(dfca.kernels.Type.MULTISCALE, kernel_widths=[0.5, 1.],
+                                               memory_budget=300)
+
+        x = torch.rand((7, 2), dtype=self.torch_dtype, requires_grad=True)
+        nx = torch.rand((7, 2), dtype=self.torch_dtype, requires_grad=True)
+        px = torch.rand((7, 2), dtype=self.torch_dtype, requires_grad=True)
+        y = torch.rand((5, 2), dtype=self.torch_dtype, requires_grad=True)
+        ny = torch.rand((5, 2), dtype=self.torch_dtype, requires_grad=True)
+        py = torch.rand((5, 2), dtype=self.torch_dtype, requires_grad=True)
+        a = torch.rand((5, 1), dtype=self.torch_dtype, requires_grad=True)
+
+        self.assertTrue(torch.autograd.gradgradcheck(kernel_instance.convolve, (x, y, py)))
+        self.assertTrue(torch.autograd.gradcheck(
+            lambda x, nx, y, ny, a: kernel_instance.convolve((x, nx), (y, ny), a, mode='varifold'), (x, nx, y, ny, a)))
+        self.assertTrue(torch.autograd.gradcheck(kernel_instance.convolve_gradient, (px, x, y, py)))
+
+
+@unittest.skipIf(not dfca.kernels.test_numba_setup(), 'numba is not installed')
+class NumbaKernelTest(KernelTestBase):
+    def setUp(self):
+        super().setUp()
+
+    def test_convolve_cpu(self):
+        kernel_instance = dfca.kernels.factory(dfca.kernels.Type.NUMBA, kernel_width=1.)
+        self._assert_tensor_close(kernel_instance.convolve(self.x, self.y, self.p), self.expected_convolve_res,
+                                  precision=1e-14)
+        self._assert_tensor_close(kernel_instance.convolve_gradient(self.x, self.x),
+                                  self.expected_convolve_gradient_res, precision=1e-14)
+
+    def test_numba_and_torch_are_equal(self):
+        numba_kernel = dfca.kernels.factory(dfca.kernels.Type.NUMBA, kernel_width=0.5)
+        torch_kernel = dfca.kernels.factory(dfca.kernels.Type.TORCH, kernel_width=0.5)
+
+        # more points than the tile size, in both dimensions.
+        x = torch.rand((300, 3), dtype=self.torch_dtype, requires_grad=True)
+        nx = torch.rand((300, 3), dtype=self.torch_dtype)
+        y = torch.rand((260, 3), dtype=self.torch_dtype, requires_grad=True)
+        ny = torch.rand((260, 3), dtype=self.torch_dtype)
+        p = torch.rand((260, 3), dtype=self.torch_dtype, requires_grad=True)
+
+        for kernel_function in [lambda k: k.convolve(x, y, p),
+                                lambda k: k.convolve(x, y, p[:, :1], mode='pointcloud'),
+                                lambda k: k.convolve((x, nx), (y, ny), p[:, :1], mode='varifold'),
+                                lambda k: k.convolve_gradient(p, y),
+                                lambda k: k.convolve_gradient(nx, x, y, ny),
+                                lambda k: torch.cat(k.convolve_and_gradient(y, p), 1)]:
+            numba_res = kernel_function(numba_kernel)
+            torch_res = kernel_function(torch_kernel)
+            self._assert_tensor_close(numba_res, torch_res, precision=1e-12)
+
+            numba_grads = torch.autograd.grad(torch.sum(numba_res ** 2), [x, y, p], allow_unused=True)
+            torch_grads = torch.autograd.grad(torch.sum(torch_res ** 2), [x, y, p], allow_unused=True)
+            for numba_grad, torch_grad in zip(numba_grads, torch_grads):
+                self.assertEqual(numba_grad is None, torch_grad is None)
+                if numba_grad is not None:
+                    # the gradients grow with the number of points: compare them relatively to their scale.
+                    scale = torch.max(torch.abs(torch_grad))
+                    self._assert_tensor_close(numba_grad / scale, torch_grad / scale, precision=1e-12)
+
+    def test_analytic_backward(self):
+        kernel_instance = dfca.kernels.factory(dfca.kernels.Type.NUMBA, kernel_width=0.7)
+
+        x = torch.rand((7, 3), dtype=self.torch_dtype, requires_grad=True)
+        nx = torch.rand((7, 3), dtype=self.torch_dtype, requires_grad=True)
+        px = torch.rand((7, 3), dtype=self.torch_dtype, requires_grad=True)
+        y = torch.rand((5, 3), dtype=self.torch_dtype, requires_grad=True)
+        ny = torch.rand((5, 3), dtype=self.torch_dtype, requires_grad=True)
+        py = torch.rand((5, 3), dtype=self.torch_dtype, requires_grad=True)
+        a = torch.rand((5, 1), dtype=self.torch_dtype, requires_grad=True)
+
+        self.assertTrue(torch.autograd.gradcheck(kernel_instance.convolve, (x, y, py)))
+        self.assertTrue(torch.autograd.gradcheck(
+            lambda x, nx, y, ny, a: kernel_instance.convolve((x, nx), (y, ny), a, mode='varifold'), (x, nx, y, ny, a)))
+        self.assertTrue(torch.autograd.gradcheck(kernel_instance.convolve_gradient, (px, x, y, py)))
+
+
+class AutoKernelTest(KernelTestBase):
+    def setUp(self):
+        super().setUp()
+        self.cache_path = os.path.join(tempfile.mkdtemp(), 'kernel_autotuner.json')
+        self.candidates = ('torch', 'torch_tiled')
+
+    def test_convolve_cpu(self):
+        kernel_instance = dfca.kernels.factory(dfca.kernels.Type.AUTO, kernel_width=1., cache_path=self.cache_path,
+                                               candidates=self.candidates, tiled_memory_budget=600)
+        self._assert_tensor_close(kernel_instance.convolve(self.x, self.y, self.p), self.expected_convolve_res)
+        self._assert_tensor_close(kernel_instance.convolve_gradient(self.x, self.x),
+                                  self.expected_convolve_gradient_res)
+
+    def test_winners_are_cached(self):
+        kernel_instance = dfca.kernels.factory(dfca.kernels.Type.AUTO, kernel_width=1., cache_path=self.cache_path,
+                                               candidates=self.candidates, tiled_memory_budget=600)
+        x = torch.rand((50, 3), dtype=self.torch_dtype, requires_grad=True)
+        p = torch.rand((50, 3), dtype=self.torch_dtype)
+        velocity, gradient = kernel_instance.convolve_and_gradient(x, p)
+        self.assertEqual(1, len(kernel_instance._winners))
+        # benchmark runs are detached: the result still has a gradient.
+        self.assertIsNotNone(torch.autograd.grad(torch.sum(velocity), x)[0])
+
+        with open(self.cache_path, 'r') as f:
+            cache = json.load(f)
+        self.assertEqual(kernel_instance._winners, cache)
+
+        # a new instance reads the winner from the cache instead of benchmarking the candidates again.
+        other_instance = dfca.kernels.factory(dfca.kernels.Type.AUTO, kernel_width=1., cache_path=self.cache_path,
+                                              candidates=self.candidates, tiled_memory_budget=600,
+                                              benchmark_repetitions=1)
+        other_instance._benchmark = None
+        other_velocity, other_gradient = other_instance.convolve_and_gradient(x, p)
+        self._assert_tensor_close(other_velocity, velocity)
+        self._assert_tensor_close(other_gradient, gradient)
+
+        # same bucket for sizes rounded up to the same power of two.
+        kernel_instance.convolve_and_gradient(x[:40], p[:40])
+        self.assertEqual(1, len(kernel_instance._winners))
+
+        # the cache file is replaced, without leftover temporary files.
+        self.assertEqual(['kernel_autotuner.json'], os.listdir(os.path.dirname(self.cache_path)))
+
+    def test_worker_threads_do_not_benchmark(self):
+        from concurrent.futures import ThreadPoolExecutor
+        kernel_instance = dfca.kernels.factory(dfca.kernels.Type.AUTO, kernel_width=1., cache_path=self.cache_path,
+                                               candidates=self.candidates, tiled_memory_budget=600)
+        kernel_instance._benchmark = None
+
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            res = executor.submit(kernel_instance.convolve, self.x, self.y, self.p).result()
+        self._assert_tensor_close(res, self.expected_convolve_res)
+        self.assertEqual({}, kernel_instance._winners)
+        self.assertFalse(os.path.exists(self.cache_path))
+
 
 class KeopsKernelTest(KernelTestBase):
     def setUp(self):
@@ -265,7 +759,17 @@ class KeopsKernelTest(KernelTestBase):
 
     def test_keops_setup(self):
         self.assertTrue(dfca.kernels.test_keops_setup(verbose=True))
-        dfca.kernels.kernel_selector()
+
+    def test_reductions_are_shared_and_lazy(self):
+        from deformetrica.support.kernels import keops_kernel
+        k1 = dfca.kernels.factory(dfca.kernels.Type.KEOPS, kernel_width=1.)
+        k2 = dfca.kernels.factory(dfca.kernels.Type.KEOPS, kernel_width=2.)
+        self.assertNotIn(('varifold_convolve', 3, k1.cuda_type), keops_kernel.reductions)
+        self.assertIs(k1._get_reduction('varifold_convolve', 3), k2._get_reduction('varifold_convolve', 3))
+        self.assertIsNot(k1._get_reduction('varifold_convolve', 3), k1._get_reduction('varifold_convolve', 2))
+
+        # kernel instances do not hold any reduction, and are cheap to send to the worker processes.
+        self.assertEqual(k1, pickle.loads(pickle.dumps(k1)))
 
 
 class KeopsVersusCuda(unittest.TestCase):
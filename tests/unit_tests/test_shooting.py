@@ -1,8 +1,10 @@
 import unittest
+import unittest.mock
 import numpy as np
 import torch
 
 import deformetrica as dfca
+from deformetrica.core.model_tools.deformations.exponential import checkpoint_kwargs
 
 from torch.autograd import Variable
 
@@ -80,3 +82,682 @@ class ShootingTests(unittest.TestCase):
         for (cp, mom, time) in zip(cp_traj, mom_traj, times_traj):
             self.assertTrue(np.allclose(cp.detach().numpy(), control_points + time * momenta))
             self.assertTrue(np.allclose(mom.detach().numpy(), momenta))
+
+    def test_batched_exponential_equals_separate_shootings(self):
+        """
+        Shoot and flow three subjects at once, along a leading batch dimension, and compare with separate shootings.
+        """
+        torch.manual_seed(42)
+        control_points = torch.rand((6, 2), dtype=torch.float64)
+        momenta = torch.rand((3, 6, 2), dtype=torch.float64) - 0.5
+        template_points = torch.rand((10, 2), dtype=torch.float64)
+
+        def shoot(control_points, momenta, template_points):
+            exponential = dfca.deformations.Exponential(
+                kernel=dfca.kernels.factory('torch', kernel_width=0.5), number_of_time_points=5,
+                use_rk2_for_shoot=True, use_rk2_for_flow=True)
+            exponential.set_initial_control_points(control_points)
+            exponential.set_initial_momenta(momenta)
+            exponential.set_initial_template_points({'landmark_points': template_points})
+            exponential.update()
+            return exponential.get_template_points()['landmark_points'], exponential.get_norm_squared()
+
+        batched_points, batched_norm = shoot(control_points.expand(momenta.size()), momenta,
+                                             template_points.expand((3,) + template_points.size()))
+        norm = 0.
+        for i in range(3):
+            points, norm_i = shoot(control_points, momenta[i], template_points)
+            self.assertTrue(np.allclose(batched_points[i].numpy(), points.numpy()))
+            norm += norm_i
+        self.assertTrue(np.allclose(batched_norm.numpy(), norm.numpy()))
+
+    def test_checkpointed_gradients_equal_autograd(self):
+        """
+        Gradients with respect to the control points, momenta and template points, through all the time points of the
+        shoot and the flow, do not depend on the gradient mode.
+        """
+        torch.manual_seed(42)
+        initial_control_points = torch.rand((6, 2), dtype=torch.float64)
+        initial_momenta = torch.rand((6, 2), dtype=torch.float64) - 0.5
+        initial_template_points = torch.rand((10, 2), dtype=torch.float64)
+        image_points = torch.rand((5, 4, 2), dtype=torch.float64)
+
+        def gradients(use_rk2, gradient_mode, checkpoint_interval=None, use_autograd_grad=False):
+            control_points = initial_control_points.clone().requires_grad_(True)
+            momenta = initial_momenta.clone().requires_grad_(True)
+            template_points = initial_template_points.clone().requires_grad_(True)
+            exponential = dfca.deformations.Exponential(
+                kernel=dfca.kernels.factory('torch', kernel_width=0.5), number_of_time_points=8,
+                use_rk2_for_shoot=use_rk2, use_rk2_for_flow=use_rk2,
+                gradient_mode=gradient_mode, checkpoint_interval=checkpoint_interval)
+            exponential.set_initial_control_points(control_points)
+            exponential.set_initial_momenta(momenta)
+            exponential.set_initial_template_points({'landmark_points': template_points, 'image_points': image_points})
+            exponential.update()
+            loss = sum(torch.sum(points ** 2) for points in exponential.template_points_t['landmark_points']) \
+                   + torch.sum(exponential.template_points_t['image_points'][-1] ** 3) \
+                   + torch.sum(exponential.momenta_t[3] ** 2)
+            if use_autograd_grad:
+                return torch.autograd.grad(loss, [control_points, momenta, template_points])
+            # the reentrant checkpointing, before torch 1.11, is not compatible with torch.autograd.grad.
+            loss.backward()
+            return control_points.grad, momenta.grad, template_points.grad
+
+        # the non-reentrant checkpointing is used when available.
+        use_autograd_grad_cases = [False, True] if checkpoint_kwargs else [False]
+        for use_rk2 in [False, True]:
+            expected_gradients = gradients(use_rk2, 'autograd')
+            for checkpoint_interval in [None, 1, 3]:
+                for use_autograd_grad in use_autograd_grad_cases:
+                    for expected, actual in zip(expected_gradients, gradients(use_rk2, 'checkpoint', checkpoint_interval,
+                                                                              use_autograd_grad)):
+                        self.assertTrue(np.allclose(expected.numpy(), actual.numpy(), rtol=1e-12, atol=1e-12))
+
+    def test_adjoint_gradients_are_close_to_autograd(self):
+        """
+        Adjoint gradients are computed along states reconstructed backward in time, without saving the intermediate
+        states: they match the autograd ones, including for large deformations of many control points over few time
+        points, whose states are re-anchored to the initial ones.
+        """
+        for number_of_control_points, momenta_scale, number_of_time_points in [(6, 1., 11), (30, 3., 6)]:
+            self._test_adjoint_gradients_are_close_to_autograd(number_of_control_points, momenta_scale,
+                                                               number_of_time_points)
+
+    def _test_adjoint_gradients_are_close_to_autograd(self, number_of_control_points, momenta_scale,
+                                                      number_of_time_points):
+        torch.manual_seed(42)
+        initial_control_points = torch.rand((number_of_control_points, 2), dtype=torch.float64)
+        initial_momenta = momenta_scale * (torch.rand((number_of_control_points, 2), dtype=torch.float64) - 0.5)
+        initial_template_points = torch.rand((10, 2), dtype=torch.float64)
+        image_points = torch.rand((5, 4, 2), dtype=torch.float64)
+
+        def gradients(use_rk2, gradient_mode):
+            control_points = initial_control_points.clone().requires_grad_(True)
+            momenta = initial_momenta.clone().requires_grad_(True)
+            template_points = initial_template_points.clone().requires_grad_(True)
+            exponential = dfca.deformations.Exponential(
+                kernel=dfca.kernels.factory('torch', kernel_width=0.5), number_of_time_points=number_of_time_points,
+                use_rk2_for_shoot=use_rk2, use_rk2_for_flow=use_rk2, gradient_mode=gradient_mode)
+            exponential.set_initial_control_points(control_points)
+            exponential.set_initial_momenta(momenta)
+            exponential.set_initial_template_points({'landmark_points': template_points, 'image_points': image_points})
+            exponential.update()
+            if gradient_mode == 'adjoint':
+                # the initial and final states only.
+                self.assertEqual(len(exponential.momenta_t[-1].grad_fn.saved_tensors), 4)
+            loss = sum(torch.sum(points ** 2) for points in exponential.template_points_t['landmark_points']) \
+                   + torch.sum(exponential.template_points_t['image_points'][-1] ** 3) \
+                   + torch.sum(exponential.momenta_t[3] ** 2)
+            return torch.autograd.grad(loss, [control_points, momenta, template_points])
+
+        for use_rk2 in [False, True]:
+            for expected, actual in zip(gradients(use_rk2, 'autograd'), gradients(use_rk2, 'adjoint')):
+                self.assertTrue(np.allclose(expected.numpy(), actual.numpy(), rtol=1e-8, atol=1e-8))
+
+    def test_integrators_converge_to_the_geodesic(self):
+        """
+        Higher order integrators reach the geodesic computed with a fine rk4 discretization with few time points.
+        """
+        torch.manual_seed(42)
+        control_points = torch.rand((6, 2), dtype=torch.float64)
+        momenta = torch.rand((6, 2), dtype=torch.float64) - 0.5
+        template_points = torch.rand((10, 2), dtype=torch.float64)
+
+        def shoot(number_of_time_points, shoot_integrator, flow_integrator):
+            exponential = dfca.deformations.Exponential(
+                kernel=dfca.kernels.factory('torch', kernel_width=0.5), number_of_time_points=number_of_time_points,
+                shoot_integrator=shoot_integrator, flow_integrator=flow_integrator, integrator_tolerance=1e-6)
+            exponential.set_initial_control_points(control_points)
+            exponential.set_initial_momenta(momenta)
+            exponential.set_initial_template_points({'landmark_points': template_points})
+            exponential.update()
+            return (exponential.control_points_t[-1], exponential.momenta_t[-1],
+                    exponential.get_template_points()['landmark_points'])
+
+        expected = shoot(201, 'rk4', 'rk4')
+        for number_of_time_points, shoot_integrator, flow_integrator, precision in [
+                (6, 'rk4', 'rk4', 1e-4), (3, 'adaptive', 'adaptive', 1e-5), (11, 'leapfrog', 'rk2', 1e-2)]:
+            for e, a in zip(expected, shoot(number_of_time_points, shoot_integrator, flow_integrator)):
+                self.assertTrue(np.allclose(e.numpy(), a.numpy(), rtol=0., atol=precision))
+
+        # the symplectic integrator nearly preserves the hamiltonian.
+        exponential = dfca.deformations.Exponential(
+            kernel=dfca.kernels.factory('torch', kernel_width=0.5), number_of_time_points=11,
+            shoot_integrator='leapfrog')
+        exponential.set_initial_control_points(control_points)
+        exponential.set_initial_momenta(momenta)
+        exponential.update()
+        hamiltonians = [exponential.scalar_product(cp, mom, mom).item()
+                        for cp, mom in zip(exponential.control_points_t, exponential.momenta_t)]
+        self.assertTrue(np.allclose(hamiltonians, hamiltonians[0], rtol=1e-3))
+
+        # its implicit stages are solved to a tolerance: stepping back from the end point recovers the initial state.
+        kernel = dfca.kernels.factory('torch', kernel_width=0.5)
+        cp, mom = dfca.deformations.Exponential._leapfrog_step(kernel, control_points, momenta, 0.1)
+        cp, mom = dfca.deformations.Exponential._leapfrog_step(kernel, cp, mom, -0.1)
+        self.assertTrue(np.allclose(cp.numpy(), control_points.numpy(), rtol=0., atol=1e-9))
+        self.assertTrue(np.allclose(mom.numpy(), momenta.numpy(), rtol=0., atol=1e-9))
+
+    def test_parallel_transport_solvers_equal_kernel_matrix_inversion(self):
+        """
+        The cholesky and conjugate gradient solves of the kernel systems give the transport, and its gradients, obtained
+        with the inverse kernel matrices.
+        """
+        torch.manual_seed(42)
+        initial_control_points = torch.rand((8, 2), dtype=torch.float64)
+        initial_momenta = (torch.rand((8, 2), dtype=torch.float64) - 0.5) * 0.5
+        initial_momenta_to_transport = torch.rand((8, 2), dtype=torch.float64) - 0.5
+
+        class InverseExponential(dfca.deformations.Exponential):
+            def _apply_cometric(self, i, velocity, initial_guess):
+                return torch.matmul(torch.inverse(self.shoot_kernel.get_kernel_matrix(self.control_points_t[i])), velocity)
+
+        def transport(exponential_class, conjugate_gradient_threshold):
+            control_points = initial_control_points.clone().requires_grad_(True)
+            momenta_to_transport = initial_momenta_to_transport.clone().requires_grad_(True)
+            exponential = exponential_class(
+                kernel=dfca.kernels.factory('torch', kernel_width=0.3), number_of_time_points=11,
+                use_rk2_for_shoot=True)
+            exponential.conjugate_gradient_threshold = conjugate_gradient_threshold
+            exponential.conjugate_gradient_tolerance = 1e-12
+            exponential.set_initial_control_points(control_points)
+            exponential.set_initial_momenta(initial_momenta)
+            exponential.update()
+            transported_momenta = exponential.parallel_transport(momenta_to_transport)
+            # the factorizations are cached, and reused by the next transports.
+            cholesky_matrices = dict(exponential.cholesky_matrices)
+            exponential.parallel_transport(momenta_to_transport)
+            self.assertTrue(all(exponential.cholesky_matrices[i] is factor for i, factor in cholesky_matrices.items()))
+            if exponential_class is dfca.deformations.Exponential:
+                self.assertEqual(len(cholesky_matrices), 0 if conjugate_gradient_threshold == 0 else 10)
+            loss = sum(torch.sum(momenta ** 2 * (i + 1)) for i, momenta in enumerate(transported_momenta))
+            return [transported_momenta[-1]] + list(torch.autograd.grad(loss, [control_points, momenta_to_transport]))
+
+        expected = transport(InverseExponential, 2000)
+        for conjugate_gradient_threshold in [2000, 0]:
+            for e, a in zip(expected, transport(dfca.deformations.Exponential, conjugate_gradient_threshold)):
+                self.assertTrue(torch.allclose(a, e, rtol=1e-6, atol=1e-8))
+
+    def test_batched_parallel_transport_equals_separate_transports(self):
+        """
+        A batch of momenta, containing a zero one, is transported as each of them separately.
+        """
+        torch.manual_seed(42)
+        control_points = torch.rand((8, 2), dtype=torch.float64)
+        momenta = (torch.rand((8, 2), dtype=torch.float64) - 0.5) * 0.5
+        momenta_to_transport = torch.rand((3, 8, 2), dtype=torch.float64) - 0.5
+        momenta_to_transport[1] = 0.
+
+        exponential = dfca.deformations.Exponential(
+            kernel=dfca.kernels.factory('torch', kernel_width=0.3), number_of_time_points=11, use_rk2_for_shoot=True)
+        exponential.set_initial_control_points(control_points)
+        exponential.set_initial_momenta(momenta)
+        exponential.update()
+
+        for conjugate_gradient_threshold in [2000, 0]:
+            exponential.conjugate_gradient_threshold = conjugate_gradient_threshold
+            exponential.conjugate_gradient_tolerance = 1e-12
+            for initial_time_point in [0, 4]:
+                transported_momenta = exponential.parallel_transport(momenta_to_transport, initial_time_point)
+                self.assertEqual(len(transported_momenta), 11 - initial_time_point)
+                for s in range(3):
+                    expected = exponential.parallel_transport(momenta_to_transport[s], initial_time_point)
+                    for e, a in zip(expected, transported_momenta):
+                        self.assertTrue(torch.allclose(a[s], e, rtol=1e-8, atol=1e-10))
+
+    def test_parallel_transport_uses_the_shoot_integrator(self):
+        """
+        The perturbed geodesics of the parallel transport are shot with the step of the shoot integrator, without any
+        rk2 step for the other integrators: the transports are then closer than the rk2 one to a transport along a fine
+        discretization.
+        """
+        torch.manual_seed(42)
+        control_points = torch.rand((8, 2), dtype=torch.float64)
+        momenta = (torch.rand((8, 2), dtype=torch.float64) - 0.5) * 0.5
+        momenta_to_transport = torch.rand((8, 2), dtype=torch.float64) - 0.5
+
+        def transport(shoot_integrator, number_of_time_points=11):
+            exponential = dfca.deformations.Exponential(
+                kernel=dfca.kernels.factory('torch', kernel_width=0.3), number_of_time_points=number_of_time_points,
+                shoot_integrator=shoot_integrator, integrator_tolerance=1e-6)
+            exponential.set_initial_control_points(control_points)
+            exponential.set_initial_momenta(momenta)
+            exponential.update()
+            return exponential.parallel_transport(momenta_to_transport)[-1]
+
+        expected = transport('rk4', 201)
+        rk2_error = torch.max(torch.abs(transport('rk2') - expected))
+        for shoot_integrator in ['rk4', 'leapfrog', 'adaptive']:
+            with unittest.mock.patch.object(dfca.deformations.Exponential, '_rk2_step',
+                                            side_effect=AssertionError('unexpected rk2 step')):
+                error = torch.max(torch.abs(transport(shoot_integrator) - expected))
+            self.assertLess(error, rk2_error)
+
+    def test_semi_lagrangian_image_flow_follows_the_characteristics(self):
+        """
+        The semi-lagrangian image flow, with the midpoint rule, is closer to the inverse map obtained by integrating the
+        characteristics backward in time than the finite difference one. With small displacements per time step, its
+        adjoint gradients match the autograd ones.
+        """
+        torch.manual_seed(1)
+        grid = torch.stack(torch.meshgrid(*[torch.linspace(0., 31., 32, dtype=torch.float64)] * 2), -1)
+        control_points = torch.rand((10, 2), dtype=torch.float64) * 20. + 6.
+        momenta = (torch.rand((10, 2), dtype=torch.float64) - 0.5) * 8.
+        kernel = dfca.kernels.factory('torch', kernel_width=8.)
+
+        def flow(number_of_time_points, image_flow, flow_integrator):
+            exponential = dfca.deformations.Exponential(
+                kernel=kernel, number_of_time_points=number_of_time_points, use_rk2_for_shoot=True,
+                flow_integrator=flow_integrator, image_flow=image_flow)
+            exponential.set_initial_control_points(control_points)
+            exponential.set_initial_momenta(momenta)
+            exponential.set_initial_template_points({'image_points': grid})
+            exponential.update()
+            return exponential
+
+        # backward integration of the characteristics, along a finely discretized geodesic.
+        reference = flow(201, 'finite_difference', 'euler')
+        points, dt = grid.view(-1, 2), 1. / 200.
+        for i in range(200, 0, -1):
+            mid_points = points - dt / 2. * kernel.convolve(points, reference.control_points_t[i],
+                                                            reference.momenta_t[i])
+            points = points - dt / 2. * (
+                    kernel.convolve(mid_points, reference.control_points_t[i], reference.momenta_t[i])
+                    + kernel.convolve(mid_points, reference.control_points_t[i - 1], reference.momenta_t[i - 1]))
+        expected = points.view(grid.size())[4:-4, 4:-4]
+
+        def error(exponential):
+            return torch.max(torch.abs(exponential.get_template_points()['image_points'][4:-4, 4:-4] - expected)).item()
+
+        finite_difference_error = error(flow(11, 'finite_difference', 'euler'))
+        semi_lagrangian_error = error(flow(11, 'semi_lagrangian', 'rk2'))
+        self.assertLess(semi_lagrangian_error, 0.3)
+        self.assertLess(semi_lagrangian_error, finite_difference_error / 2.)
+
+        intensities = torch.rand(grid.size(), dtype=torch.float64)
+
+        def gradient(gradient_mode):
+            small_momenta = (0.2 * momenta).requires_grad_(True)
+            exponential = dfca.deformations.Exponential(
+                kernel=kernel, number_of_time_points=6, use_rk2_for_shoot=True, flow_integrator='rk2',
+                image_flow='semi_lagrangian', gradient_mode=gradient_mode)
+            exponential.set_initial_control_points(control_points)
+            exponential.set_initial_momenta(small_momenta)
+            exponential.set_initial_template_points({'image_points': grid})
+            exponential.update()
+            loss = torch.sum(intensities * exponential.get_template_points()['image_points'])
+            return torch.autograd.grad(loss, small_momenta)[0]
+
+        expected_gradient = gradient('autograd')
+        self.assertLess(torch.max(torch.abs(gradient('adjoint') - expected_gradient)).item(),
+                        1e-4 * torch.max(torch.abs(expected_gradient)).item())
+
+    def test_streamed_states_equal_the_updated_trajectories(self):
+        """
+        Stream the states of exponentials and of a geodesic, without storing their trajectories, and compare with the
+        trajectories of updated copies.
+        """
+        torch.manual_seed(42)
+        control_points = torch.rand((6, 2), dtype=torch.float64)
+        momenta = (torch.rand((6, 2), dtype=torch.float64) - 0.5).requires_grad_(True)
+        template_points = {'landmark_points': torch.rand((10, 2), dtype=torch.float64),
+                           'image_points': torch.stack(torch.meshgrid(
+                               *[torch.linspace(0., 1., 8, dtype=torch.float64)] * 2), -1)}
+        kernel = dfca.kernels.factory('torch', kernel_width=0.5)
+
+        for flow_integrator in ['euler', 'rk2', 'rk4']:
+            exponential = dfca.deformations.Exponential(
+                kernel=kernel, number_of_time_points=6, use_rk2_for_shoot=True, flow_integrator=flow_integrator,
+                image_flow='semi_lagrangian')
+            exponential.set_initial_control_points(control_points)
+            exponential.set_initial_momenta(momenta)
+            exponential.set_initial_template_points(template_points)
+            updated_exponential = exponential.light_copy()
+            updated_exponential.update()
+
+            states = list(exponential.stream())
+            self.assertEqual(len(states), 6)
+            self.assertIsNone(exponential.control_points_t)
+            for j, (cp, mom, points) in enumerate(states):
+                self.assertFalse(mom.requires_grad)
+                self.assertTrue(torch.allclose(cp, updated_exponential.control_points_t[j]))
+                self.assertTrue(torch.allclose(mom, updated_exponential.momenta_t[j]))
+                for key, value in updated_exponential.get_template_points(j).items():
+                    self.assertTrue(torch.allclose(points[key], value))
+
+            # without gradient, the final template points are streamed.
+            with torch.no_grad():
+                final_template_points = exponential.get_final_template_points()
+            self.assertTrue(exponential.shoot_is_modified)
+            for key, value in updated_exponential.get_template_points().items():
+                self.assertTrue(torch.allclose(final_template_points[key], value))
+
+        geodesic = dfca.deformations.Geodesic(kernel=kernel, t0=0., concentration_of_time_points=4,
+                                              use_rk2_for_shoot=True, use_rk2_for_flow=True)
+        geodesic.set_tmin(-1.)
+        geodesic.set_tmax(2.)
+        geodesic.set_control_points_t0(control_points)
+        geodesic.set_momenta_t0(momenta)
+        geodesic.set_template_points_t0({'landmark_points': template_points['landmark_points']})
+        states = sorted(geodesic.stream(), key=lambda state: state[0])
+        geodesic.update()
+        times = geodesic.get_times()
+        self.assertEqual([state[0] for state in states], list(range(len(times))))
+        for (t, time, cp, mom, points), expected_cp, expected_mom in zip(
+                states, geodesic.get_control_points_trajectory(), geodesic.get_momenta_trajectory()):
+            self.assertEqual(time, times[t])
+            self.assertTrue(torch.allclose(cp, expected_cp))
+            self.assertTrue(torch.allclose(mom, expected_mom))
+            self.assertTrue(torch.allclose(points['landmark_points'],
+                                           geodesic.get_template_points(time)['landmark_points']))
+
+    def test_batched_exponential_equals_separate_shootings_of_ragged_triples(self):
+        """
+        Shoot and flow triples with different numbers of control points and landmark points at once, and compare the
+        deformed points, the norms and the gradients with separate shootings.
+        """
+        torch.manual_seed(42)
+        kernel = dfca.kernels.factory('torch', kernel_width=0.5)
+        control_points = [torch.rand((n, 2), dtype=torch.float64) for n in [4, 7, 5]]
+        momenta = [(torch.rand((n, 2), dtype=torch.float64) - 0.5).requires_grad_(True) for n in [4, 7, 5]]
+        template_points = [{'landmark_points': torch.rand((n, 2), dtype=torch.float64)} for n in [9, 3, 6]]
+
+        def exponential(exponential_class):
+            return exponential_class(kernel=kernel, number_of_time_points=6, use_rk2_for_shoot=True,
+                                     use_rk2_for_flow=True)
+
+        batched_exponential = exponential(dfca.deformations.BatchedExponential)
+        batched_exponential.set_initial_states(template_points, control_points, momenta)
+        batched_exponential.update()
+        batched_points = batched_exponential.get_template_points_list()
+        batched_norms = batched_exponential.get_norms_squared()
+        batched_gradients = torch.autograd.grad(
+            sum(torch.sum(elt['landmark_points'] ** 2) for elt in batched_points) + torch.sum(batched_norms), momenta)
+
+        for i in range(3):
+            separate_exponential = exponential(dfca.deformations.Exponential)
+            separate_exponential.set_initial_control_points(control_points[i])
+            separate_exponential.set_initial_momenta(momenta[i])
+            separate_exponential.set_initial_template_points(template_points[i])
+            separate_exponential.update()
+            points = separate_exponential.get_template_points()['landmark_points']
+            norm = separate_exponential.get_norm_squared()
+            gradient = torch.autograd.grad(torch.sum(points ** 2) + norm, momenta[i])[0]
+
+            self.assertEqual(batched_points[i]['landmark_points'].size(), points.size())
+            self.assertTrue(torch.allclose(batched_points[i]['landmark_points'], points))
+            self.assertTrue(torch.allclose(batched_norms[i], norm))
+            self.assertTrue(torch.allclose(batched_gradients[i], gradient))
+
+    def test_batched_spatiotemporal_reference_frame_exponentials_equal_separate_ones(self):
+        """
+        Deform the template from the spatiotemporal reference frame at several times and sources at once, and compare
+        with separate calls.
+        """
+        torch.manual_seed(42)
+        reference_frame = dfca.deformations.SpatiotemporalReferenceFrame(
+            kernel=dfca.kernels.factory('torch', kernel_width=0.5), t0=1., concentration_of_time_points=5,
+            number_of_time_points=6, use_rk2_for_flow=True)
+        reference_frame.set_template_points_t0({'landmark_points': torch.rand((12, 2), dtype=torch.float64)})
+        reference_frame.set_control_points_t0(torch.rand((6, 2), dtype=torch.float64))
+        reference_frame.set_momenta_t0(torch.rand((6, 2), dtype=torch.float64) - 0.5)
+        reference_frame.set_modulation_matrix_t0(torch.rand((12, 3), dtype=torch.float64) - 0.5)
+        reference_frame.set_tmin(0.)
+        reference_frame.set_tmax(2.)
+        reference_frame.update()
+
+        times = [torch.tensor(t, dtype=torch.float64, requires_grad=True) for t in [0.1, 0.95, 1.5, 2.]]
+        sources = [torch.rand(3, dtype=torch.float64) - 0.5 for _ in times]
+        batched_points = reference_frame.get_template_points(times, sources)
+        batched_gradient = torch.autograd.grad(
+            sum(torch.sum(elt['landmark_points'] ** 2) for elt in batched_points), times[1])[0]
+        for time, sources_i, points in zip(times, sources, batched_points):
+            expected_points = reference_frame.get_template_points(time, sources_i)['landmark_points']
+            self.assertTrue(torch.allclose(points['landmark_points'], expected_points))
+            if time is times[1]:
+                gradient = torch.autograd.grad(torch.sum(expected_points ** 2), time)[0]
+                self.assertTrue(torch.allclose(batched_gradient, gradient))
+
+    def test_spatiotemporal_reference_frame_template_points_batch_interpolates_the_trajectories(self):
+        """
+        Deform the template from the spatiotemporal reference frame at a vector of absolute times and a matrix of
+        sources, and compare with exponentials shot from the linear interpolations of the trajectories.
+        """
+        torch.manual_seed(42)
+        reference_frame = dfca.deformations.SpatiotemporalReferenceFrame(
+            kernel=dfca.kernels.factory('torch', kernel_width=0.5), t0=1., concentration_of_time_points=3,
+            number_of_time_points=6, use_rk2_for_shoot=True, use_rk2_for_flow=True)
+        reference_frame.set_template_points_t0({'landmark_points': torch.rand((10, 2), dtype=torch.float64)})
+        reference_frame.set_control_points_t0(torch.rand((6, 2), dtype=torch.float64))
+        reference_frame.set_momenta_t0(torch.rand((6, 2), dtype=torch.float64) - 0.5)
+        reference_frame.set_modulation_matrix_t0(torch.rand((12, 2), dtype=torch.float64) - 0.5)
+        reference_frame.set_tmin(0.)
+        reference_frame.set_tmax(2.5)
+        reference_frame.update()
+
+        times = reference_frame.times
+        query_times = torch.tensor([0., times[1], 0.9, 1., 1.2, 2.2, 2.5], dtype=torch.float64)
+        sources = torch.rand((len(query_times), 2), dtype=torch.float64) - 0.5
+        batch = reference_frame.get_template_points_batch(query_times, sources)['landmark_points']
+        self.assertEqual(batch.size(), (len(query_times), 10, 2))
+
+        exponential = dfca.deformations.Exponential(kernel=dfca.kernels.factory('torch', kernel_width=0.5),
+                                                    number_of_time_points=6, use_rk2_for_shoot=True,
+                                                    use_rk2_for_flow=True)
+        for time, sources_i, points in zip(query_times.tolist(), sources, batch):
+            j = min(max(1, len([elt for elt in times if elt <= time])), len(times) - 1)
+            weight_right = (time - times[j - 1]) / (times[j] - times[j - 1])
+
+            def interpolate(trajectory):
+                return (1. - weight_right) * trajectory[j - 1] + weight_right * trajectory[j]
+
+            exponential.set_initial_template_points(
+                {'landmark_points': interpolate(reference_frame.template_points_t['landmark_points'])})
+            exponential.set_initial_control_points(interpolate(reference_frame.control_points_t))
+            exponential.set_initial_momenta(
+                torch.mv(interpolate(reference_frame.projected_modulation_matrix_t), sources_i).view(6, 2))
+            exponential.update()
+            self.assertTrue(torch.allclose(points, exponential.get_template_points()['landmark_points']))
+
+    def test_reference_frame_set_use_rk2_for_flow(self):
+        """
+        Switch the flow integrator of a spatiotemporal reference frame: it is set on the geodesic and on both
+        exponentials, whose shoot integrators are unchanged.
+        """
+        reference_frame = dfca.deformations.SpatiotemporalReferenceFrame(
+            kernel=dfca.kernels.factory('torch', kernel_width=0.5), t0=1., concentration_of_time_points=3,
+            number_of_time_points=6, use_rk2_for_shoot=True)
+        for flag, flow_integrator in [(True, 'rk2'), (False, 'euler')]:
+            reference_frame.set_use_rk2_for_flow(flag)
+            for exponential in [reference_frame.exponential, reference_frame.batched_exponential,
+                                reference_frame.geodesic.backward_exponential,
+                                reference_frame.geodesic.forward_exponential]:
+                self.assertEqual(exponential.flow_integrator, flow_integrator)
+                self.assertEqual(exponential.shoot_integrator, 'rk2')
+
+    def test_reference_frame_geodesic_uses_the_shoot_integrator(self):
+        """
+        The shoot integrator of a spatiotemporal reference frame reaches the exponentials of its geodesic, that remain
+        rk2 ones for the first order euler integrator.
+        """
+        for shoot_integrator, geodesic_shoot_integrator in [('parareal', 'parareal'), ('rk4', 'rk4'), ('euler', 'rk2'),
+                                                            (None, 'rk2')]:
+            reference_frame = dfca.deformations.SpatiotemporalReferenceFrame(
+                kernel=dfca.kernels.factory('torch', kernel_width=0.5), t0=1., concentration_of_time_points=3,
+                number_of_time_points=6, shoot_integrator=shoot_integrator, parareal_number_of_slices=3)
+            for exponential in [reference_frame.geodesic.backward_exponential,
+                                reference_frame.geodesic.forward_exponential]:
+                self.assertEqual(exponential.shoot_integrator, geodesic_shoot_integrator)
+                self.assertEqual(exponential.parareal_number_of_slices, 3)
+
+    def test_geodesic_template_points_batch_interpolates_the_trajectory(self):
+        """
+        Interpolate the template points trajectory of a geodesic at several times at once, including its time points and
+        bounds, and compare with the linear interpolation between the two closest time points.
+        """
+        torch.manual_seed(42)
+        momenta = (torch.rand((6, 2), dtype=torch.float64) - 0.5).requires_grad_(True)
+        geodesic = dfca.deformations.Geodesic(kernel=dfca.kernels.factory('torch', kernel_width=0.5), t0=1.,
+                                              concentration_of_time_points=3, use_rk2_for_shoot=True,
+                                              use_rk2_for_flow=True)
+        geodesic.set_tmin(0.)
+        geodesic.set_tmax(2.5)
+        geodesic.set_control_points_t0(torch.rand((6, 2), dtype=torch.float64))
+        geodesic.set_momenta_t0(momenta)
+        geodesic.set_template_points_t0({'landmark_points': torch.rand((10, 2), dtype=torch.float64)})
+        geodesic.update()
+
+        times = geodesic.get_times()
+        trajectory = geodesic.get_template_points_trajectory()['landmark_points']
+        query_times = [0., times[1], 0.9, 1., 1.2, 2.2, 2.5]
+        batch = geodesic.get_template_points_batch(query_times)['landmark_points']
+        self.assertEqual(batch.size(), (len(query_times), 10, 2))
+
+        for time, points in zip(query_times, batch):
+            j = min(max(1, len([elt for elt in times if elt <= time])), len(times) - 1)
+            weight_right = (time - times[j - 1]) / (times[j] - times[j - 1])
+            expected_points = (1. - weight_right) * trajectory[j - 1] + weight_right * trajectory[j]
+            self.assertTrue(torch.allclose(points, expected_points))
+            self.assertTrue(torch.allclose(geodesic.get_template_points(time)['landmark_points'], expected_points))
+
+        gradient = torch.autograd.grad(torch.sum(batch[4] ** 2), momenta, retain_graph=True)[0]
+        expected_gradient = torch.autograd.grad(
+            torch.sum(geodesic.get_template_points(1.2)['landmark_points'] ** 2), momenta)[0]
+        self.assertTrue(torch.allclose(gradient, expected_gradient))
+
+    def test_geodesic_image_points_batch_indexes_the_trajectory(self):
+        """
+        Interpolate the image points trajectory of a geodesic at several times at once: it is not stacked in the
+        trajectory store, and only its interpolated time points are gathered.
+        """
+        torch.manual_seed(42)
+        geodesic = dfca.deformations.Geodesic(kernel=dfca.kernels.factory('torch', kernel_width=0.5), t0=1.,
+                                              concentration_of_time_points=3, use_rk2_for_shoot=True)
+        geodesic.set_tmin(0.)
+        geodesic.set_tmax(2.5)
+        geodesic.set_control_points_t0(torch.rand((6, 2), dtype=torch.float64))
+        geodesic.set_momenta_t0(torch.rand((6, 2), dtype=torch.float64) - 0.5)
+        image_points = torch.stack(torch.meshgrid(torch.linspace(0., 1., 8, dtype=torch.float64),
+                                                  torch.linspace(0., 1., 9, dtype=torch.float64)), -1)
+        geodesic.set_template_points_t0({'landmark_points': torch.rand((10, 2), dtype=torch.float64),
+                                         'image_points': image_points})
+        geodesic.update()
+        self.assertIsInstance(geodesic.template_points_store['image_points'], list)
+
+        times = geodesic.get_times()
+        trajectory = geodesic.get_template_points_trajectory()['image_points']
+        query_times = [0., times[1], 0.9, 1.2, 2.5]
+        batch = geodesic.get_template_points_batch(query_times)['image_points']
+        self.assertEqual(batch.size(), (len(query_times), 8, 9, 2))
+
+        for time, points in zip(query_times, batch):
+            j = min(max(1, len([elt for elt in times if elt <= time])), len(times) - 1)
+            weight_right = (time - times[j - 1]) / (times[j] - times[j - 1])
+            self.assertTrue(torch.allclose(points, (1. - weight_right) * trajectory[j - 1]
+                                           + weight_right * trajectory[j]))
+
+    def test_concurrent_geodesic_exponentials_equal_sequential_ones(self):
+        """
+        Update a geodesic and parallel transport along it with concurrent backward and forward exponentials, and compare
+        the trajectories and the gradients with sequential ones.
+        """
+        torch.manual_seed(42)
+        control_points = torch.rand((6, 2), dtype=torch.float64)
+        momenta = (torch.rand((6, 2), dtype=torch.float64) - 0.5).requires_grad_(True)
+        template_points = {'landmark_points': torch.rand((10, 2), dtype=torch.float64)}
+        momenta_to_transport = torch.rand((6, 2), dtype=torch.float64) - 0.5
+
+        def update(concurrent_exponentials):
+            dfca.deformations.Geodesic.concurrent_exponentials = concurrent_exponentials
+            geodesic = dfca.deformations.Geodesic(kernel=dfca.kernels.factory('torch', kernel_width=0.5), t0=1.,
+                                                  concentration_of_time_points=5, use_rk2_for_shoot=True,
+                                                  use_rk2_for_flow=True)
+            geodesic.set_tmin(0.)
+            geodesic.set_tmax(2.5)
+            geodesic.set_control_points_t0(control_points)
+            geodesic.set_momenta_t0(momenta)
+            geodesic.set_template_points_t0(template_points)
+            geodesic.update()
+            trajectory = geodesic.get_template_points_trajectory()['landmark_points']
+            transport = geodesic.parallel_transport(momenta_to_transport)
+            gradient = torch.autograd.grad(torch.sum(trajectory[0] ** 2) + torch.sum(trajectory[-1] ** 2), momenta)[0]
+            with torch.no_grad():
+                geodesic.set_momenta_t0(momenta)
+                geodesic.update()
+                self.assertFalse(geodesic.get_template_points_trajectory()['landmark_points'][-1].requires_grad)
+            return trajectory, transport, gradient
+
+        number_of_threads = torch.get_num_threads()
+        torch.set_num_threads(2)
+        try:
+            trajectory, transport, gradient = update(True)
+            self.assertEqual(torch.get_num_threads(), 2)
+            expected_trajectory, expected_transport, expected_gradient = update(False)
+        finally:
+            dfca.deformations.Geodesic.concurrent_exponentials = False
+            torch.set_num_threads(number_of_threads)
+
+        self.assertEqual(len(trajectory), len(expected_trajectory))
+        for points, expected_points in zip(trajectory, expected_trajectory):
+            self.assertTrue(torch.allclose(points, expected_points))
+        self.assertEqual(len(transport), len(expected_transport))
+        for momenta_t, expected_momenta_t in zip(transport, expected_transport):
+            self.assertTrue(torch.allclose(momenta_t, expected_momenta_t))
+        self.assertTrue(torch.allclose(gradient, expected_gradient))
+
+    def test_parareal_shoot_converges_to_the_serial_trajectory(self):
+        """
+        Shoot with the parareal integrator on concurrent time slices, and compare the trajectories with the serial rk2
+        ones: they are close after the iterations stopped by the tolerance, with steps across the slice bounds that
+        match the rk2 ones, and equal when the tolerance is zero. When gradients are required, the trajectory is the
+        same, and its gradients are close to the serial ones.
+        """
+        torch.manual_seed(42)
+        control_points = torch.rand((10, 2), dtype=torch.float64)
+        momenta = (torch.rand((10, 2), dtype=torch.float64) - 0.5).requires_grad_(True)
+        template_points = torch.rand((12, 2), dtype=torch.float64)
+        kernel = dfca.kernels.factory('torch', kernel_width=0.5)
+
+        def shoot(shoot_integrator, integrator_tolerance):
+            exponential = dfca.deformations.Exponential(
+                kernel=kernel, number_of_time_points=41, shoot_integrator=shoot_integrator, flow_integrator='rk2',
+                integrator_tolerance=integrator_tolerance, parareal_number_of_slices=4)
+            exponential.set_initial_control_points(control_points)
+            exponential.set_initial_momenta(momenta)
+            exponential.set_initial_template_points({'landmark_points': template_points})
+            exponential.update()
+            gradient = None
+            if torch.is_grad_enabled():
+                gradient = torch.autograd.grad(torch.sum(exponential.get_template_points()['landmark_points'] ** 2),
+                                               momenta)[0]
+            return exponential.control_points_t, exponential.momenta_t, gradient
+
+        expected_control_points_t, expected_momenta_t, expected_gradient = shoot('rk2', 1e-4)
+
+        number_of_threads = torch.get_num_threads()
+        torch.set_num_threads(2)
+        try:
+            for integrator_tolerance, precision in [(1e-4, 1e-4), (0., 1e-12)]:
+                with torch.no_grad():
+                    control_points_t, momenta_t, _ = shoot('parareal', integrator_tolerance)
+                self.assertEqual(torch.get_num_threads(), 2)
+                self.assertEqual(len(control_points_t), len(expected_control_points_t))
+                for actual, expected in zip(control_points_t + momenta_t,
+                                            expected_control_points_t + expected_momenta_t):
+                    self.assertTrue(torch.allclose(actual, expected.detach(), rtol=0., atol=precision))
+                for i in range(len(control_points_t) - 1):
+                    next_control_points, next_momenta = dfca.deformations.Exponential._rk2_step(
+                        kernel, control_points_t[i], momenta_t[i], 1. / 40.)
+                    self.assertTrue(torch.allclose(next_control_points, control_points_t[i + 1], rtol=0.,
+                                                   atol=precision))
+                    self.assertTrue(torch.allclose(next_momenta, momenta_t[i + 1], rtol=0., atol=precision))
+
+                # the differentiable trajectory is the same, and its gradients are close to the serial ones.
+                with torch.no_grad():
+                    expected_parareal_trajectory = control_points_t + momenta_t
+                control_points_t, momenta_t, gradient = shoot('parareal', integrator_tolerance)
+                for actual, expected in zip(control_points_t + momenta_t, expected_parareal_trajectory):
+                    self.assertTrue(torch.equal(actual.detach(), expected))
+                self.assertTrue(torch.allclose(gradient, expected_gradient, rtol=precision, atol=precision))
+        finally:
+            torch.set_num_threads(number_of_threads)